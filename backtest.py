@@ -0,0 +1,375 @@
+# اختبار تاريخي (backtest) للاستراتيجيات الأربع على شموع مخزنة
+# الإشارات والثقة والنقاط تُحسب كمصفوفات NumPy على كامل السلسلة دفعة واحدة،
+# ونتيجة كل صفقة (TP / SL) تُحسم من أعلى/أدنى الشموع التالية. إذا لمست الشمعة الهدف والوقف معاً يُحسب الوقف.
+#
+# الاستخدام:
+#   python backtest.py                      # كاش الشموع XAUUSD_15m في CANDLE_CACHE_DIR
+#   python backtest.py gold_15m.csv         # ملف CSV بأعمدة Open,High,Low,Close (+Volume) وفهرس زمني
+#   python backtest.py --overlap --json     # كل شمعة إشارة كصفقة مستقلة، ومخرجات JSON
+#   python backtest.py --verify 200         # مقارنة 200 شمعة عشوائية مع دوال main الأصلية
+
+import os
+import sys
+import json
+import time
+import argparse
+
+import numpy as np
+import pandas as pd
+import ta
+
+# main يتطلب هذه المتغيرات عند الاستيراد؛ الاختبار لا يتصل بتيليجرام ولا بقاعدة البيانات
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "123456:backtest-offline-token")
+os.environ.setdefault("DATABASE_URL", "postgresql://backtest@localhost/backtest")
+
+import main
+import candle_cache
+
+BUY, HOLD, SELL = 1, 0, -1
+STRATEGY_NAMES = ["PRICE_ACTION_BREAKOUT", "RSI_MOMENTUM", "MOVING_AVERAGE", "MACD"]
+TIERS = [
+    {"name": "VIP", "min_filters": main.MIN_FILTERS_FOR_98, "threshold": main.CONFIDENCE_THRESHOLD_98},
+    {"name": "ADMIN", "min_filters": main.MIN_FILTERS_FOR_90, "threshold": main.CONFIDENCE_THRESHOLD_90},
+]
+
+
+# =============== تحميل البيانات ===============
+def load_candles(path=None):
+    """شموع من ملف CSV أو من كاش الشموع (مفتاح مثل XAUUSD_15m)."""
+    if path and path.lower().endswith(".csv"):
+        df = pd.read_csv(path, index_col=0, parse_dates=True)
+        df.columns = [str(c).strip().capitalize() for c in df.columns]
+        missing = [c for c in ['Open', 'High', 'Low', 'Close'] if c not in df.columns]
+        if missing:
+            raise ValueError(f"أعمدة ناقصة في {path}: {missing}")
+        df = df[~df.index.duplicated(keep='last')].sort_index()
+        return df.dropna(subset=['High', 'Low', 'Close'])
+
+    key = path or f"{main.TRADE_SYMBOL}_{main.ANALYSIS_TIMEFRAME}"
+    loaded = candle_cache.load_series(main.CANDLE_CACHE_DIR, key)
+    if loaded is None:
+        raise FileNotFoundError(f"لا يوجد كاش للسلسلة {key} في {main.CANDLE_CACHE_DIR}")
+    return loaded[0]
+
+
+# =============== الإشارات كمصفوفات ===============
+def compute_indicators(df):
+    """نفس المؤشرات التي تستخدمها الاستراتيجيات، لكل الشموع مرة واحدة."""
+    close = df['Close']
+    true_range = np.maximum(np.maximum(df['High'] - df['Low'], np.abs(df['High'] - close.shift())),
+                            np.abs(df['Low'] - close.shift()))
+    macd = ta.trend.MACD(close)
+    rsi = ta.momentum.RSIIndicator(close, window=14).rsi()
+    macd_hist = macd.macd_diff()
+    return {
+        "close": close.to_numpy(dtype=np.float64),
+        "prev_close": close.shift().to_numpy(dtype=np.float64),
+        "high": df['High'].to_numpy(dtype=np.float64),
+        "low": df['Low'].to_numpy(dtype=np.float64),
+        "high_20": df['High'].rolling(20).max().to_numpy(dtype=np.float64),
+        "low_20": df['Low'].rolling(20).min().to_numpy(dtype=np.float64),
+        "rsi": rsi.to_numpy(dtype=np.float64),
+        "prev_rsi": rsi.shift().to_numpy(dtype=np.float64),
+        "ma_20": close.rolling(20).mean().to_numpy(dtype=np.float64),
+        "ma_50": close.rolling(50).mean().to_numpy(dtype=np.float64),
+        "macd": macd.macd().to_numpy(dtype=np.float64),
+        "macd_signal": macd.macd_signal().to_numpy(dtype=np.float64),
+        "macd_hist": macd_hist.to_numpy(dtype=np.float64),
+        "prev_macd_hist": macd_hist.shift().to_numpy(dtype=np.float64),
+        # calculate_atr: متوسط True Range أو متوسط المدى عند نقص البيانات (حتى الشمعة الحالية فقط)
+        "atr": true_range.rolling(14).mean().to_numpy(dtype=np.float64),
+        "mean_range": (df['High'] - df['Low']).expanding().mean().to_numpy(dtype=np.float64),
+    }
+
+
+def strategy_signals(ind):
+    """(actions, confidences) بأبعاد (4 × n) بنفس ترتيب وقواعد دوال *_decision في main."""
+    c, n = ind["close"], len(ind["close"])
+    bars = np.arange(1, n + 1)
+    actions = np.zeros((4, n), dtype=np.int8)
+    confidences = np.zeros((4, n), dtype=np.float64)
+
+    with np.errstate(invalid="ignore"):
+        # Price Action Breakout
+        high_20, low_20 = ind["high_20"], ind["low_20"]
+        buy = c > high_20
+        sell = ~buy & (c < low_20)
+        actions[0] = np.where(buy, BUY, np.where(sell, SELL, HOLD))
+        confidences[0] = np.where(buy, np.where(c - high_20 > high_20 * 0.001, 0.82, 0.75),
+                                  np.where(sell, np.where(low_20 - c > low_20 * 0.001, 0.82, 0.75), 0.0))
+
+        # RSI Momentum
+        rsi, prev_rsi = ind["rsi"], ind["prev_rsi"]
+        buy = (rsi < 30) & (rsi > prev_rsi)
+        sell = ~buy & (rsi > 70) & (rsi < prev_rsi)
+        actions[1] = np.where(buy, BUY, np.where(sell, SELL, HOLD))
+        confidences[1] = np.where(buy, np.where(rsi < 25, 0.78, 0.72),
+                                  np.where(sell, np.where(rsi > 75, 0.78, 0.72), 0.0))
+
+        # Moving Average: الشروط بالترتيب، أول شرط متحقق يفوز
+        ma_20, ma_50, prev_close = ind["ma_20"], ind["ma_50"], ind["prev_close"]
+        conditions = [
+            (c > ma_20) & (ma_20 > ma_50),
+            (c < ma_20) & (ma_20 < ma_50),
+            (ma_20 > ma_50) & (prev_close <= ma_50),
+            (ma_20 < ma_50) & (prev_close >= ma_50),
+        ]
+        actions[2] = np.select(conditions, [BUY, SELL, BUY, SELL], HOLD)
+        confidences[2] = np.select(conditions, [0.80, 0.80, 0.75, 0.75], 0.0)
+
+        # MACD
+        macd, signal, hist, prev_hist = ind["macd"], ind["macd_signal"], ind["macd_hist"], ind["prev_macd_hist"]
+        buy = (macd > signal) & (prev_hist <= 0) & (hist > 0)
+        sell = ~buy & (macd < signal) & (prev_hist >= 0) & (hist < 0)
+        actions[3] = np.where(buy, BUY, np.where(sell, SELL, HOLD))
+        confidences[3] = np.where(buy | sell, 0.77, 0.0)
+
+    # الحد الأدنى من الشموع لكل استراتيجية
+    for row, min_bars in enumerate([20, 14, 50, 26]):
+        short = bars < min_bars
+        actions[row, short] = HOLD
+        confidences[row, short] = 0.0
+    return actions, confidences
+
+
+def ensemble(actions, confidences):
+    """مكافئ calculate_dynamic_confidence + اختيار أفضل إشارة لكل شمعة."""
+    valid = (actions != HOLD) & (confidences >= 0.65)
+    count = valid.sum(axis=0)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        base = np.where(count > 0, (confidences * valid).sum(axis=0) / count, 0.0)
+    buys = ((actions == BUY) & valid).sum(axis=0)
+    sells = ((actions == SELL) & valid).sum(axis=0)
+    trend_boost = np.where((buys == 0) | (sells == 0), 0.06, -0.08)
+    total_boost = np.maximum(-0.12, (count - 2) * 0.03 + trend_boost)
+    confidence = np.where(count > 0, np.clip(base + total_boost, 0.65, 0.95), 0.0)
+
+    # max(valid_strategies, key=confidence): أول استراتيجية بأعلى ثقة
+    best = np.argmax(np.where(valid, confidences, -np.inf), axis=0)
+    action = np.where(count > 0, actions[best, np.arange(actions.shape[1])], HOLD)
+    return {"count": count, "confidence": confidence, "action": action, "best": best}
+
+
+def trade_levels(ind, action):
+    """مكافئ calculate_levels: (entry, tp, sl) لكل شمعة، الدخول على إغلاق الشمعة."""
+    c = ind["close"]
+    atr = np.where(np.isnan(ind["atr"]), ind["mean_range"], ind["atr"])
+    buy_tp = np.maximum.reduce([ind["high_20"], c + atr * 2.5, c * 1.008])
+    buy_sl = np.minimum.reduce([ind["low_20"], c - atr * 1.5, c * 0.992])
+    sell_tp = np.minimum.reduce([ind["low_20"], c - atr * 2.5, c * 0.992])
+    sell_sl = np.maximum.reduce([ind["high_20"], c + atr * 1.5, c * 1.008])
+    is_buy = action == BUY
+    return c, np.where(is_buy, buy_tp, sell_tp), np.where(is_buy, buy_sl, sell_sl), atr
+
+
+# =============== حسم الصفقات ===============
+def resolve_trades(high, low, entry_idx, direction, tp, sl, window=64):
+    """أول شمعة بعد الدخول تلمس الهدف أو الوقف لكل الصفقات معاً، بنوافذ تتضاعف.
+    يُرجع (exit_idx, outcome) حيث outcome = 1 هدف، -1 وقف، 0 لم تُغلق حتى نهاية البيانات."""
+    n = len(high)
+    exit_idx = np.full(len(entry_idx), -1, dtype=np.int64)
+    outcome = np.zeros(len(entry_idx), dtype=np.int8)
+    pending = np.arange(len(entry_idx))
+    start = entry_idx + 1
+
+    while pending.size:
+        offsets = start[pending, None] + np.arange(window)[None, :]
+        in_range = offsets < n
+        offsets = np.minimum(offsets, n - 1)
+        highs, lows = high[offsets], low[offsets]
+        is_buy = (direction[pending] == BUY)[:, None]
+        tp_p, sl_p = tp[pending, None], sl[pending, None]
+        tp_hit = np.where(is_buy, highs >= tp_p, lows <= tp_p) & in_range
+        sl_hit = np.where(is_buy, lows <= sl_p, highs >= sl_p) & in_range
+        hit = tp_hit | sl_hit
+
+        found = hit.any(axis=1)
+        first = np.argmax(hit, axis=1)
+        rows = pending[found]
+        exit_idx[rows] = offsets[found, first[found]]
+        # الوقف أولاً عند لمس الاثنين في نفس الشمعة
+        outcome[rows] = np.where(sl_hit[found, first[found]], -1, 1)
+
+        exhausted = start[pending] + window >= n
+        pending = pending[~found & ~exhausted]
+        start[pending] += window
+        window *= 2
+    return exit_idx, outcome
+
+
+def select_sequential(entry_idx, exit_idx):
+    """صفقة واحدة في كل وقت كما في send_vip_trade_signal_98: لا إشارة جديدة قبل إغلاق السابقة."""
+    keep = np.zeros(len(entry_idx), dtype=bool)
+    busy_until = -1
+    for i, (entry, exit_) in enumerate(zip(entry_idx, exit_idx)):
+        if busy_until is None or entry < busy_until:
+            continue
+        keep[i] = True
+        busy_until = None if exit_ < 0 else exit_
+    return keep
+
+
+# =============== الإحصائيات ===============
+def summarize(trades):
+    closed = trades["outcome"] != 0
+    pnl = trades["pnl"][closed]
+    r_multiple = trades["r"][closed]
+    wins = int((trades["outcome"] == 1).sum())
+    losses = int((trades["outcome"] == -1).sum())
+
+    equity = np.concatenate([[0.0], np.cumsum(pnl)])
+    drawdown = np.maximum.accumulate(equity) - equity
+    equity_r = np.concatenate([[0.0], np.cumsum(r_multiple)])
+    drawdown_r = np.maximum.accumulate(equity_r) - equity_r
+    return {
+        "signals": int(len(trades["outcome"])),
+        "closed": int(closed.sum()),
+        "open": int((~closed).sum()),
+        "wins": wins,
+        "losses": losses,
+        "win_rate": wins / closed.sum() if closed.any() else None,
+        "expectancy": float(pnl.mean()) if closed.any() else None,
+        "expectancy_r": float(r_multiple.mean()) if closed.any() else None,
+        "total_pnl": float(pnl.sum()),
+        "max_drawdown": float(drawdown.max()),
+        "max_drawdown_r": float(drawdown_r.max()),
+        "avg_bars_held": float((trades["exit_idx"][closed] - trades["entry_idx"][closed]).mean()) if closed.any() else None,
+        "avg_confidence": float(trades["confidence"].mean()) if len(trades["confidence"]) else None,
+    }
+
+
+def run_backtest(df, tiers=TIERS, overlap=False):
+    """تشغيل الاختبار لكل فئة: مع حد الثقة (كما في الإرسال الفعلي) وبعدد الفلاتر فقط."""
+    ind = compute_indicators(df)
+    actions, confidences = strategy_signals(ind)
+    signal = ensemble(actions, confidences)
+    entry, tp, sl, _ = trade_levels(ind, signal["action"])
+
+    candidates = np.flatnonzero(signal["count"] >= min(t["min_filters"] for t in tiers))
+    exit_idx, outcome = resolve_trades(ind["high"], ind["low"], candidates, signal["action"][candidates],
+                                       tp[candidates], sl[candidates])
+    direction = signal["action"][candidates]
+    exit_price = np.where(outcome == 1, tp[candidates], sl[candidates])
+    pnl = np.where(outcome != 0, direction * (exit_price - entry[candidates]), 0.0)
+    risk = np.abs(entry[candidates] - sl[candidates])
+    r_multiple = np.divide(pnl, risk, out=np.zeros_like(pnl), where=risk > 0)
+
+    results = []
+    for tier in tiers:
+        passes_filters = signal["count"][candidates] >= tier["min_filters"]
+        passes_threshold = passes_filters & (signal["confidence"][candidates] >= tier["threshold"])
+        for gated, mask in (("confidence", passes_threshold), ("filters", passes_filters)):
+            rows = np.flatnonzero(mask)
+            if not overlap:
+                rows = rows[select_sequential(candidates[rows], exit_idx[rows])]
+            trades = {
+                "entry_idx": candidates[rows], "exit_idx": exit_idx[rows], "outcome": outcome[rows],
+                "pnl": pnl[rows], "r": r_multiple[rows], "confidence": signal["confidence"][candidates[rows]],
+            }
+            results.append({"tier": tier["name"], "min_filters": tier["min_filters"], "threshold": tier["threshold"],
+                            "gate": gated, **summarize(trades)})
+
+    distribution = {int(k): int((signal["count"] == k).sum()) for k in range(5)}
+    return {
+        "bars": len(df),
+        "start": str(df.index[0]) if len(df) else None,
+        "end": str(df.index[-1]) if len(df) else None,
+        "overlap": overlap,
+        "max_confidence": float(signal["confidence"].max()) if len(df) else 0.0,
+        "filters_distribution": distribution,
+        "strategy_fires": {name: int((actions[i] != HOLD).sum()) for i, name in enumerate(STRATEGY_NAMES)},
+        "tiers": results,
+    }
+
+
+# =============== التحقق مقابل الدوال الأصلية ===============
+def verify_against_main(df, samples=200, seed=0):
+    """مقارنة الإشارات المتجهة مع استراتيجيات main على بادئات عشوائية من البيانات."""
+    ind = compute_indicators(df)
+    actions, confidences = strategy_signals(ind)
+    signal = ensemble(actions, confidences)
+    entry, tp, sl, _ = trade_levels(ind, signal["action"])
+    action_names = {BUY: "BUY", SELL: "SELL", HOLD: "HOLD"}
+
+    rng = np.random.default_rng(seed)
+    indices = rng.choice(np.arange(min(len(df), 30), len(df)), size=min(samples, max(0, len(df) - 30)), replace=False)
+    mismatches = []
+    for i in sorted(indices):
+        window = df.iloc[:i + 1].copy()
+        strategies = [
+            main.price_action_breakout_strategy(window),
+            main.rsi_momentum_strategy(window),
+            main.moving_average_strategy(window),
+            main.macd_strategy(window),
+        ]
+        expected_actions = [s["action"] for s in strategies]
+        actual_actions = [action_names[int(a)] for a in actions[:, i]]
+        valid = [s for s in strategies if s["action"] != "HOLD" and s["confidence"] >= 0.65]
+        expected_conf = main.calculate_dynamic_confidence(strategies, valid)
+        problems = []
+        if expected_actions != actual_actions:
+            problems.append(f"actions {expected_actions} != {actual_actions}")
+        if not np.isclose(expected_conf, signal["confidence"][i]):
+            problems.append(f"confidence {expected_conf:.4f} != {signal['confidence'][i]:.4f}")
+        if valid:
+            best = max(valid, key=lambda x: x["confidence"])
+            _, exp_tp, exp_sl, _ = main.calculate_dynamic_levels(window, window['Close'].iloc[-1], best["action"])
+            if not (np.isclose(exp_tp, tp[i]) and np.isclose(exp_sl, sl[i])):
+                problems.append(f"levels ({exp_tp:.2f}, {exp_sl:.2f}) != ({tp[i]:.2f}, {sl[i]:.2f})")
+        if problems:
+            mismatches.append((str(df.index[i]), problems))
+    return len(indices), mismatches
+
+
+# =============== التقرير ===============
+def format_report(result, elapsed):
+    pct = lambda v: f"{v * 100:.1f}%" if v is not None else "-"
+    num = lambda v, fmt="{:,.2f}": fmt.format(v) if v is not None else "-"
+    lines = [
+        f"📊 اختبار تاريخي: {result['bars']} شمعة ({result['start']} → {result['end']}) في {elapsed:.2f} ث",
+        f"   الصفقات {'متداخلة (كل شمعة إشارة)' if result['overlap'] else 'صفقة واحدة في كل وقت'}",
+        f"   أعلى ثقة ممكنة في البيانات: {pct(result['max_confidence'])}",
+        "   توزيع عدد الفلاتر المتحققة: " + ", ".join(f"{k}: {v}" for k, v in result["filters_distribution"].items()),
+        "   مرات إطلاق كل استراتيجية: " + ", ".join(f"{k}: {v}" for k, v in result["strategy_fires"].items()),
+        "",
+    ]
+    for row in result["tiers"]:
+        gate = f"ثقة ≥ {row['threshold'] * 100:.0f}%" if row["gate"] == "confidence" else "بدون حد الثقة"
+        lines += [
+            f"🎯 {row['tier']} ({row['min_filters']} فلاتر، {gate})",
+            f"   إشارات: {row['signals']} | مغلقة: {row['closed']} (هدف {row['wins']} / وقف {row['losses']}) | مفتوحة: {row['open']}",
+            f"   نسبة النجاح: {pct(row['win_rate'])} | التوقع: {num(row['expectancy'])}$ ({num(row['expectancy_r'], '{:+.2f}')}R)",
+            f"   صافي: {num(row['total_pnl'])}$ | أقصى تراجع: {num(row['max_drawdown'])}$ ({num(row['max_drawdown_r'], '{:.2f}')}R)"
+            f" | متوسط المدة: {num(row['avg_bars_held'], '{:.1f}')} شمعة",
+            "",
+        ]
+    return "\n".join(lines)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="اختبار تاريخي لاستراتيجيات البوت على شموع مخزنة")
+    parser.add_argument("source", nargs="?", help="ملف CSV أو مفتاح في كاش الشموع (افتراضي XAUUSD_15m)")
+    parser.add_argument("--overlap", action="store_true", help="اعتبار كل شمعة إشارة صفقة مستقلة")
+    parser.add_argument("--json", action="store_true", help="مخرجات JSON")
+    parser.add_argument("--verify", type=int, default=0, metavar="N", help="مقارنة N شمعة مع دوال main الأصلية")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    df = load_candles(args.source)
+
+    if args.verify:
+        checked, mismatches = verify_against_main(df, args.verify)
+        for ts, problems in mismatches[:20]:
+            print(f"❌ {ts}: {'; '.join(problems)}")
+        print(f"{'✅' if not mismatches else '❌'} تطابق {checked - len(mismatches)}/{checked} مع دوال main")
+        sys.exit(0 if not mismatches else 1)
+
+    started = time.perf_counter()
+    result = run_backtest(df, overlap=args.overlap)
+    elapsed = time.perf_counter() - started
+    if args.json:
+        print(json.dumps({**result, "elapsed": elapsed}, ensure_ascii=False, indent=2))
+    else:
+        print(format_report(result, elapsed))
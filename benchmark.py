@@ -0,0 +1,510 @@
+# قياس أداء مسارات التحليل وقاعدة البيانات والـ middleware والإرسال الجماعي بدون اتصال خارجي
+# الشموع اصطناعية (أو من CSV / كاش الشموع) وقاعدة البيانات بديل SQLite في الذاكرة أو PostgreSQL محلي.
+#
+# الاستخدام:
+#   python benchmark.py --out bench.json                       # تشغيل وحفظ النتائج
+#   python benchmark.py --compare bench.json                   # مقارنة مع تشغيل سابق (خروج 1 عند التراجع)
+#   python benchmark.py --db postgresql://localhost/bench_db   # PostgreSQL محلي (يضيف صفوفاً ثم يحذفها)
+#   python benchmark.py --only analysis --data gold_15m.csv
+
+import os
+import sys
+import json
+import time
+import sqlite3
+import asyncio
+import argparse
+import platform
+import statistics
+import subprocess
+from datetime import datetime, timezone
+
+import numpy as np
+import pandas as pd
+
+# main يتطلب هذه المتغيرات عند الاستيراد؛ القياس لا يتصل بتيليجرام
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "123456:benchmark-offline-token")
+os.environ.setdefault("DATABASE_URL", "postgresql://benchmark@localhost/benchmark")
+
+import main
+from aiogram import types
+
+BENCH_USER_BASE = 9_000_000_000  # معرفات مستخدمي القياس (لا تتعارض مع معرفات تيليجرام الحقيقية)
+BENCH_TRADE_PREFIX = "BENCH-"
+
+
+# =============== بيانات اصطناعية ===============
+def synthetic_ohlcv(bars, seed=7, start_price=2350.0, freq="15min"):
+    """شموع ذهب اصطناعية (مشي عشوائي) بتوقيتات UTC منتهية الآن."""
+    rng = np.random.default_rng(seed)
+    close = start_price + np.cumsum(rng.normal(0, 1.8, bars))
+    open_ = np.concatenate([[start_price], close[:-1]])
+    high = np.maximum(open_, close) + rng.exponential(1.2, bars)
+    low = np.minimum(open_, close) - rng.exponential(1.2, bars)
+    end = pd.Timestamp.now(tz="UTC").floor(freq)
+    index = pd.date_range(end=end, periods=bars, freq=freq)
+    return pd.DataFrame({"Open": open_, "High": high, "Low": low, "Close": close,
+                         "Volume": rng.integers(100, 5000, bars).astype(float)}, index=index)
+
+
+# =============== بديل قاعدة البيانات (SQLite) ===============
+class SQLiteCursor:
+    """مؤشر بواجهة psycopg2 فوق sqlite3 (%s ← ?)."""
+
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def execute(self, sql, params=None):
+        self._cursor.execute(sql.replace("%s", "?"), tuple(params or ()))
+
+    def executemany(self, sql, rows):
+        self._cursor.executemany(sql.replace("%s", "?"), rows)
+
+    def fetchone(self):
+        return self._cursor.fetchone()
+
+    def fetchall(self):
+        return self._cursor.fetchall()
+
+    @property
+    def rowcount(self):
+        return self._cursor.rowcount
+
+    def close(self):
+        self._cursor.close()
+
+
+class SQLiteConnection:
+    """اتصال بواجهة psycopg2 الذي يستخدمه DBConnectionPool (closed / status / commit / rollback)."""
+
+    def __init__(self, path=":memory:"):
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self.closed = 0
+
+    @property
+    def status(self):
+        return main.psycopg2.extensions.STATUS_IN_TRANSACTION if self._conn.in_transaction else main.psycopg2.extensions.STATUS_READY
+
+    def cursor(self):
+        return SQLiteCursor(self._conn.cursor())
+
+    def executescript(self, script):
+        self._conn.executescript(script)
+
+    def commit(self):
+        self._conn.commit()
+
+    def rollback(self):
+        self._conn.rollback()
+
+    def close(self):
+        self._conn.close()
+        self.closed = 1
+
+
+class SQLiteStandInPool(main.DBConnectionPool):
+    """نفس مجمع الاتصالات (بعداداته وفحوصه) لكن باتصال SQLite واحد في الذاكرة."""
+
+    def __init__(self):
+        super().__init__("sqlite://standin/bench", min_size=1, max_size=1, checkout_timeout=5.0,
+                         healthcheck_interval=main.DB_POOL_HEALTHCHECK_INTERVAL)
+        self._shared = SQLiteConnection()
+
+    def _connect(self):
+        with self._cond:
+            self.connections_created += 1
+        return self._shared
+
+
+SQLITE_SCHEMA = """
+CREATE TABLE users (user_id INTEGER PRIMARY KEY, username TEXT, joined_at REAL, is_banned INTEGER DEFAULT 0,
+                    vip_until REAL DEFAULT 0.0, is_blocked INTEGER DEFAULT 0);
+CREATE TABLE trades (trade_id TEXT PRIMARY KEY, sent_at REAL, action TEXT, entry_price REAL, take_profit REAL,
+                     stop_loss REAL, status TEXT DEFAULT 'ACTIVE', exit_status TEXT DEFAULT 'NONE',
+                     close_price REAL NULL, user_count INTEGER, trade_type TEXT DEFAULT 'SCALPING',
+                     symbol TEXT DEFAULT 'XAUUSD');
+CREATE TABLE trade_stats_hourly (bucket REAL NOT NULL, trade_type TEXT NOT NULL, sent INTEGER DEFAULT 0,
+                                 hit_tp INTEGER DEFAULT 0, hit_sl INTEGER DEFAULT 0, active INTEGER DEFAULT 0,
+                                 PRIMARY KEY (bucket, trade_type));
+CREATE INDEX idx_trades_sent_at ON trades (sent_at);
+CREATE INDEX idx_trades_active ON trades (sent_at) WHERE status = 'ACTIVE';
+CREATE INDEX idx_users_vip_until ON users (vip_until);
+"""
+
+
+def setup_database(db_url, users, trades, seed=7):
+    """تجهيز قاعدة القياس وملؤها؛ يُرجع اسم الخلفية ودالة التنظيف."""
+    if db_url:
+        main._db_pool = main.DBConnectionPool(db_url, min_size=1, max_size=main.DB_POOL_MAX_SIZE)
+        main.init_db()
+        backend = "postgres"
+    else:
+        main._db_pool = SQLiteStandInPool()
+        conn = main.get_db_connection()
+        with conn:
+            conn.executescript(SQLITE_SCHEMA)
+        backend = "sqlite-standin"
+
+    rng = np.random.default_rng(seed)
+    now = time.time()
+    user_rows = [(BENCH_USER_BASE + i, f"bench_{i}", now - rng.uniform(0, 90 * 86400),
+                  int(rng.random() < 0.02), now + rng.uniform(-30, 60) * 86400 if rng.random() < 0.4 else 0.0)
+                 for i in range(users)]
+    trade_rows = []
+    for i in range(trades):
+        entry = 2350.0 + rng.normal(0, 20)
+        action = "BUY" if rng.random() < 0.5 else "SELL"
+        side = 1 if action == "BUY" else -1
+        tp, sl = entry + side * 12, entry - side * 8
+        active = i >= trades - 3
+        exit_status = "NONE" if active else ("HIT_TP" if rng.random() < 0.55 else "HIT_SL")
+        trade_rows.append((f"{BENCH_TRADE_PREFIX}{i:06d}", now - rng.uniform(0, 30 * 86400), action, entry, tp, sl,
+                           "ACTIVE" if active else "CLOSED", exit_status,
+                           None if active else (tp if exit_status == "HIT_TP" else sl), int(rng.integers(10, 500)), "SCALPING"))
+
+    conn = main.get_db_connection()
+    with conn:
+        cursor = conn.cursor()
+        cursor.executemany("INSERT INTO users (user_id, username, joined_at, is_banned, vip_until) VALUES (%s, %s, %s, %s, %s)", user_rows)
+        cursor.executemany("""
+            INSERT INTO trades (trade_id, sent_at, action, entry_price, take_profit, stop_loss, status, exit_status, close_price, user_count, trade_type)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+        """, trade_rows)
+        conn.commit()
+    main.rebuild_trade_stats()
+
+    def cleanup():
+        if backend == "postgres":
+            conn = main.get_db_connection()
+            if conn is not None:
+                with conn:
+                    cursor = conn.cursor()
+                    cursor.execute("DELETE FROM trades WHERE trade_id LIKE %s", (BENCH_TRADE_PREFIX + "%",))
+                    cursor.execute("DELETE FROM users WHERE user_id >= %s", (BENCH_USER_BASE,))
+                    conn.commit()
+            main.rebuild_trade_stats()
+        main.get_db_pool().closeall()
+        main._db_pool = None
+
+    return backend, cleanup
+
+
+# =============== أداة القياس ===============
+def measure(run_batch, repeat, min_sample_time=0.005, warmup=1):
+    """run_batch(number) ينفذ الاستدعاء number مرة ويعيد الزمن المستغرق بالثواني.
+    يُضبط number تلقائياً حتى تتجاوز كل عينة min_sample_time، والنتائج لكل استدعاء بالميكروثانية."""
+    for _ in range(warmup):
+        run_batch(1)
+    number = 1
+    while True:
+        elapsed = run_batch(number)
+        if elapsed >= min_sample_time or number >= 1 << 16:
+            break
+        number *= 2 if elapsed <= 0 else max(2, min(10, int(min_sample_time / elapsed) + 1))
+
+    samples = [run_batch(number) / number * 1e6 for _ in range(repeat)]
+    samples.sort()
+    return {
+        "median_us": statistics.median(samples),
+        "mean_us": statistics.fmean(samples),
+        "min_us": samples[0],
+        "p95_us": samples[min(len(samples) - 1, int(round(0.95 * (len(samples) - 1))))],
+        "stdev_us": statistics.stdev(samples) if len(samples) > 1 else 0.0,
+        "repeat": repeat,
+        "number": number,
+    }
+
+
+def sync_batch(func):
+    def run_batch(number):
+        started = time.perf_counter()
+        for _ in range(number):
+            func()
+        return time.perf_counter() - started
+    return run_batch
+
+
+def async_batch(loop, coro_func):
+    async def batch(number):
+        started = time.perf_counter()
+        for _ in range(number):
+            await coro_func()
+        return time.perf_counter() - started
+    return lambda number: loop.run_until_complete(batch(number))
+
+
+# =============== الحالات ===============
+def analysis_cases(df):
+    price = float(df['Close'].iloc[-1])
+    engine = main.indicators.IndicatorEngine.from_frame(df)
+    last = df.iloc[-1]
+    last_ts = int(df.index[-1].timestamp())
+    strategies = [main.price_action_breakout_strategy(df), main.rsi_momentum_strategy(df),
+                  main.moving_average_strategy(df), main.macd_strategy(df)]
+    valid = [s for s in strategies if s["action"] != "HOLD"]
+
+    def full_cycle():
+        results = [main.price_action_breakout_strategy(df), main.rsi_momentum_strategy(df),
+                   main.moving_average_strategy(df), main.macd_strategy(df)]
+        ok = [s for s in results if s["action"] != "HOLD" and s["confidence"] >= 0.65]
+        main.calculate_dynamic_confidence(results, ok)
+        main.calculate_dynamic_levels(df, price, "BUY")
+
+    def streaming_cycle():
+        values = engine.values()
+        results = main.strategies_from_indicators(values)
+        ok = [s for s in results if s["action"] != "HOLD" and s["confidence"] >= 0.65]
+        main.calculate_dynamic_confidence(results, ok)
+        main.calculate_levels(values["high_n"], values["low_n"], main.atr_from_indicators(values), price, "BUY")
+
+    # تحليل كامل عبر AnalysisEngine بشموع وسعر محقونين (بدون شبكة)
+    series = main.candle_store.series(main.TRADE_SYMBOL, main.ANALYSIS_TIMEFRAME)
+    with series.lock:
+        series.disk_loaded = True
+        series.df = pd.DataFrame()
+        series.indicators = None
+        main.candle_store.merge(series, df)
+        series.last_refresh = float("inf")
+    main.gold_price_cache = main.PriceCache(lambda: (price, "Benchmark"), float("inf"))
+
+    def professional_analysis_recompute():
+        main.analysis_engine._snapshot = None
+        main.get_professional_analysis(main.MIN_FILTERS_FOR_90)
+
+    return {
+        "strategy.price_action_breakout": lambda: main.price_action_breakout_strategy(df),
+        "strategy.rsi_momentum": lambda: main.rsi_momentum_strategy(df),
+        "strategy.moving_average": lambda: main.moving_average_strategy(df),
+        "strategy.macd": lambda: main.macd_strategy(df),
+        "calculate_atr": lambda: main.calculate_atr(df),
+        "calculate_dynamic_levels": lambda: main.calculate_dynamic_levels(df, price, "BUY"),
+        "calculate_dynamic_confidence": lambda: main.calculate_dynamic_confidence(strategies, valid),
+        "analysis.full_cycle": full_cycle,
+        "analysis.streaming_cycle": streaming_cycle,
+        "indicators.update_forming_bar": lambda: engine.update(last_ts, float(last['High']), float(last['Low']), float(last['Close'])),
+        "get_professional_analysis.recompute": professional_analysis_recompute,
+        "get_professional_analysis.snapshot_hit": lambda: main.get_professional_analysis(main.MIN_FILTERS_FOR_90),
+    }
+
+
+def db_cases(users):
+    def vip_audience_uncached():
+        main.invalidate_vip_audience()
+        main.get_vip_audience()
+
+    def uncached(report):
+        def run():
+            main.invalidate_trade_reports()
+            report()
+        return run
+
+    uid = BENCH_USER_BASE + users // 2
+    return {
+        "db.get_weekly_trade_performance": uncached(main.get_weekly_trade_performance),
+        "db.get_daily_trade_report": uncached(main.get_daily_trade_report),
+        "db.get_daily_trade_report_cached": main.get_daily_trade_report,
+        "db.get_active_trades": main.get_active_trades,
+        "db.get_total_users": main.get_total_users,
+        "db.get_vip_audience": vip_audience_uncached,
+        "db.load_user_status_upsert": lambda: main.load_user_status(uid, f"bench_{users // 2}"),
+    }
+
+
+def trade_index_cases(trades, seed=7):
+    """فحص تيك سعر مقابل فهرس صفقات نشطة بحجم trades (بلا صفقات مضروبة، وهي الحالة الغالبة)."""
+    rng = np.random.default_rng(seed)
+    index = main.ActiveTradeIndex()
+    rows = []
+    for i in range(trades):
+        entry = 2350.0 + rng.normal(0, 20)
+        action = "BUY" if rng.random() < 0.5 else "SELL"
+        side = 1 if action == "BUY" else -1
+        rows.append({"trade_id": f"{BENCH_TRADE_PREFIX}{i:06d}", "action": action, "entry_price": entry,
+                     "take_profit": entry + side * 200, "stop_loss": entry - side * 150, "trade_type": "SCALPING"})
+    index.load(rows)
+    return {f"trades.index_crossed_{trades}": lambda: index.crossed(main.TRADE_SYMBOL, 2350.0)}
+
+
+def make_message(user, text):
+    return types.Message(message_id=1, date=datetime.now(timezone.utc),
+                         chat=types.Chat(id=user.id, type="private"), from_user=user, text=text)
+
+
+def middleware_cases(loop, users):
+    middleware = main.AccessMiddleware()
+
+    async def handler(event, data):
+        return True
+
+    # مستخدم VIP سارٍ ومستخدم عادي يطلب ميزة متاحة للجميع
+    conn = main.get_db_connection()
+    with conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT user_id, username FROM users WHERE vip_until > %s AND is_banned = 0 ORDER BY user_id LIMIT 1", (time.time(),))
+        vip_id, vip_name = cursor.fetchone()
+        cursor.execute("SELECT user_id, username FROM users WHERE vip_until = 0 AND is_banned = 0 ORDER BY user_id LIMIT 1")
+        free_id, free_name = cursor.fetchone()
+
+    vip_user = types.User(id=vip_id, is_bot=False, first_name="vip", username=vip_name)
+    free_user = types.User(id=free_id, is_bot=False, first_name="free", username=free_name)
+    vip_event = make_message(vip_user, "📊 تحليل فوري للسوق")
+    free_event = make_message(free_user, "📈 سعر السوق الحالي")
+
+    async def vip_cached():
+        await middleware(handler, vip_event, {"event_from_user": vip_user, "state": None})
+
+    async def vip_cold():
+        main.user_cache.invalidate(vip_id)
+        await middleware(handler, vip_event, {"event_from_user": vip_user, "state": None})
+
+    async def free_cached():
+        await middleware(handler, free_event, {"event_from_user": free_user, "state": None})
+
+    return {
+        "middleware.vip_cached": async_batch(loop, vip_cached),
+        "middleware.vip_cold": async_batch(loop, vip_cold),
+        "middleware.free_allowed_cached": async_batch(loop, free_cached),
+    }
+
+
+def fanout_cases(loop, recipients, send_latency):
+    """إرسال جماعي بمحرك BroadcastEngine مع send_message بديل (زمن استجابة ثابت بدون شبكة)."""
+    async def fake_send(chat_id, text, parse_mode=None, **kwargs):
+        if send_latency:
+            await asyncio.sleep(send_latency)
+
+    main.bot.send_message = fake_send
+    engine = main.BroadcastEngine(global_rate=1e9, concurrency=main.BROADCAST_CONCURRENCY,
+                                  per_chat_interval=0.0, max_retries=main.BROADCAST_MAX_RETRIES)
+    user_ids = [BENCH_USER_BASE + i for i in range(recipients)]
+
+    async def fanout():
+        await engine.send_many(user_ids, "benchmark")
+
+    return {f"fanout.send_many_{recipients}": async_batch(loop, fanout)}
+
+
+# =============== المقارنة ===============
+def compare_results(current, baseline, threshold):
+    """نسبة الوسيط الحالي إلى السابق لكل حالة؛ التراجع عندما تتجاوز 1 + threshold."""
+    rows, regressions = [], []
+    for name, result in current["results"].items():
+        previous = baseline.get("results", {}).get(name)
+        if previous is None:
+            rows.append((name, None, result["median_us"], None, "جديد"))
+            continue
+        ratio = result["median_us"] / previous["median_us"] if previous["median_us"] else float("inf")
+        status = "🔴 تراجع" if ratio > 1 + threshold else ("🟢 تحسن" if ratio < 1 - threshold else "⚪")
+        if ratio > 1 + threshold:
+            regressions.append(name)
+        rows.append((name, previous["median_us"], result["median_us"], ratio, status))
+    for name in baseline.get("results", {}):
+        if name not in current["results"]:
+            rows.append((name, baseline["results"][name]["median_us"], None, None, "لم يُقس"))
+    return rows, regressions
+
+
+def format_us(value):
+    if value is None:
+        return "-"
+    if value >= 1e6:
+        return f"{value / 1e6:.2f}s"
+    if value >= 1e3:
+        return f"{value / 1e3:.2f}ms"
+    return f"{value:.1f}µs"
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), timeout=5).stdout.strip() or None
+    except Exception:
+        return None
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="قياس أداء مسارات البوت بدون اتصال خارجي")
+    parser.add_argument("--bars", type=int, default=main.CANDLE_STORE_MAX_BARS, help="عدد الشموع الاصطناعية")
+    parser.add_argument("--data", help="ملف CSV أو مفتاح في كاش الشموع بدلاً من الشموع الاصطناعية")
+    parser.add_argument("--db", help="رابط PostgreSQL محلي بدلاً من بديل SQLite")
+    parser.add_argument("--users", type=int, default=5000)
+    parser.add_argument("--trades", type=int, default=2000)
+    parser.add_argument("--recipients", type=int, default=1000, help="عدد المستلمين في قياس الإرسال الجماعي")
+    parser.add_argument("--send-latency", type=float, default=0.0, help="زمن send_message البديل بالثواني")
+    parser.add_argument("--repeat", type=int, default=15, help="عدد العينات لكل حالة")
+    parser.add_argument("--only", action="append", help="تشغيل الحالات التي تبدأ بهذا الاسم فقط (يمكن تكراره)")
+    parser.add_argument("--out", help="حفظ النتائج JSON في ملف")
+    parser.add_argument("--compare", help="ملف نتائج سابق للمقارنة")
+    parser.add_argument("--threshold", type=float, default=0.20, help="نسبة التراجع المسموحة (افتراضي 20%%)")
+    return parser.parse_args(argv)
+
+
+def run(args):
+    if args.data:
+        import backtest
+        df = backtest.load_candles(args.data).tail(args.bars)
+    else:
+        df = synthetic_ohlcv(args.bars)
+
+    selected = lambda name: not args.only or any(name.startswith(prefix) for prefix in args.only)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    backend, cleanup = setup_database(args.db, args.users, args.trades)
+    results = {}
+    try:
+        cases = {name: sync_batch(func) for name, func in analysis_cases(df).items()}
+        cases.update({name: sync_batch(func) for name, func in db_cases(args.users).items()})
+        cases.update({name: sync_batch(func) for name, func in trade_index_cases(args.trades).items()})
+        cases.update(middleware_cases(loop, args.users))
+        cases.update(fanout_cases(loop, args.recipients, args.send_latency))
+
+        for name, run_batch in cases.items():
+            if not selected(name):
+                continue
+            results[name] = measure(run_batch, args.repeat)
+            print(f"  {name:<42} {format_us(results[name]['median_us']):>10}  (p95 {format_us(results[name]['p95_us'])})",
+                  file=sys.stderr)
+    finally:
+        cleanup()
+        main._blocking_executor.shutdown(wait=False)
+        loop.close()
+
+    return {
+        "meta": {
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "git": git_revision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "numpy": np.__version__,
+            "pandas": pd.__version__,
+            "bars": len(df),
+            "db": backend,
+            "users": args.users,
+            "trades": args.trades,
+            "recipients": args.recipients,
+            "send_latency": args.send_latency,
+            "indicator_mode": main.INDICATOR_MODE,
+        },
+        "results": results,
+    }
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    report = run(args)
+    output = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            f.write(output)
+    else:
+        print(output)
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+        rows, regressions = compare_results(report, baseline, args.threshold)
+        print(f"\n📊 مقارنة مع {args.compare} ({baseline.get('meta', {}).get('git')} → {report['meta']['git']})", file=sys.stderr)
+        for name, before, after, ratio, status in rows:
+            ratio_text = f"x{ratio:.2f}" if ratio is not None else ""
+            print(f"  {name:<42} {format_us(before):>10} → {format_us(after):>10} {ratio_text:>7} {status}", file=sys.stderr)
+        sys.exit(1 if regressions else 0)
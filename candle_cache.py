@@ -0,0 +1,140 @@
+# تخزين الشموع على القرص لإعادة التشغيل الدافئ
+# كل سلسلة (رمز/إطار زمني) تُحفظ كمصفوفة NumPy عمودية (6 × n) في ملف .npy
+# تُقرأ بـ memory-map، ومعها ملف manifest (.json) فيه عدد الصفوف و sha256 للتحقق من السلامة.
+
+import os
+import sys
+import json
+import hashlib
+
+import numpy as np
+import pandas as pd
+
+CACHE_VERSION = 1
+COLUMNS = ['Open', 'High', 'Low', 'Close', 'Volume']
+# الصف الأول توقيت الشمعة (ثواني UTC) ثم أعمدة OHLCV
+ROWS = 1 + len(COLUMNS)
+BYTES_PER_BAR = ROWS * 8
+HEADER_BYTES = 128  # حجم ترويسة ملف .npy تقريباً
+
+
+class CacheIntegrityError(Exception):
+    """ملف الكاش تالف أو لا يطابق الـ manifest."""
+
+
+def _paths(directory, key):
+    base = os.path.join(directory, key)
+    return base + ".npy", base + ".json"
+
+
+def _sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _atomic_write(path, write):
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        write(f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def max_bars_for(max_bytes):
+    return max(1, (max_bytes - HEADER_BYTES) // BYTES_PER_BAR)
+
+
+def save_series(directory, key, df, max_bytes, source=None):
+    """حفظ آخر شموع السلسلة بحيث لا يتجاوز الملف max_bytes."""
+    if df.empty:
+        return None
+    os.makedirs(directory, exist_ok=True)
+    df = df.tail(max_bars_for(max_bytes))
+
+    index = df.index.tz_convert("UTC") if df.index.tz is not None else df.index.tz_localize("UTC")
+    array = np.empty((ROWS, len(df)), dtype=np.float64)
+    array[0] = index.as_unit("s").asi8
+    for row, column in enumerate(COLUMNS, start=1):
+        array[row] = df[column].to_numpy(dtype=np.float64)
+
+    data_path, manifest_path = _paths(directory, key)
+    _atomic_write(data_path, lambda f: np.save(f, array, allow_pickle=False))
+    manifest = {
+        "version": CACHE_VERSION,
+        "key": key,
+        "rows": int(array.shape[1]),
+        "first_ts": int(array[0, 0]),
+        "last_ts": int(array[0, -1]),
+        "source": source,
+        "sha256": _sha256(data_path),
+    }
+    _atomic_write(manifest_path, lambda f: f.write(json.dumps(manifest).encode("utf-8")))
+    return manifest
+
+
+def verify_series(directory, key):
+    """التحقق من سلامة ملف السلسلة؛ يُرجع الـ manifest أو يرفع CacheIntegrityError."""
+    data_path, manifest_path = _paths(directory, key)
+    try:
+        with open(manifest_path, encoding="utf-8") as f:
+            manifest = json.load(f)
+    except (OSError, ValueError) as e:
+        raise CacheIntegrityError(f"manifest غير صالح: {e}")
+
+    if manifest.get("version") != CACHE_VERSION:
+        raise CacheIntegrityError(f"إصدار غير مدعوم: {manifest.get('version')}")
+    if not os.path.exists(data_path):
+        raise CacheIntegrityError("ملف البيانات غير موجود")
+    if _sha256(data_path) != manifest.get("sha256"):
+        raise CacheIntegrityError("sha256 لا يطابق (كتابة منقوصة أو ملف تالف)")
+
+    array = np.load(data_path, mmap_mode="r", allow_pickle=False)
+    if array.ndim != 2 or array.shape[0] != ROWS or array.shape[1] != manifest.get("rows"):
+        raise CacheIntegrityError(f"أبعاد غير متوقعة: {array.shape}")
+    if array.shape[1] and (int(array[0, 0]) != manifest["first_ts"] or int(array[0, -1]) != manifest["last_ts"]):
+        raise CacheIntegrityError("توقيتات الشموع لا تطابق الـ manifest")
+    if array.shape[1] > 1 and not np.all(np.diff(array[0]) > 0):
+        raise CacheIntegrityError("توقيتات الشموع غير مرتبة")
+    return manifest
+
+
+def load_series(directory, key):
+    """تحميل السلسلة (memory-mapped) بعد التحقق منها؛ يُرجع (DataFrame, manifest) أو None."""
+    data_path, _ = _paths(directory, key)
+    if not os.path.exists(data_path):
+        return None
+    manifest = verify_series(directory, key)
+    array = np.load(data_path, mmap_mode="r", allow_pickle=False)
+    index = pd.to_datetime(np.asarray(array[0], dtype=np.int64), unit="s", utc=True)
+    df = pd.DataFrame({column: np.array(array[row]) for row, column in enumerate(COLUMNS, start=1)}, index=index)
+    return df, manifest
+
+
+def verify_cache(directory):
+    """فحص كل ملفات الكاش في المجلد: [(key, ok, رسالة)]."""
+    results = []
+    if not os.path.isdir(directory):
+        return results
+    for name in sorted(os.listdir(directory)):
+        if not name.endswith(".json"):
+            continue
+        key = name[:-len(".json")]
+        try:
+            manifest = verify_series(directory, key)
+            results.append((key, True, f"{manifest['rows']} شمعة"))
+        except CacheIntegrityError as e:
+            results.append((key, False, str(e)))
+    return results
+
+
+if __name__ == "__main__":
+    # python candle_cache.py [المجلد]
+    directory = sys.argv[1] if len(sys.argv) > 1 else os.getenv("CANDLE_CACHE_DIR", "candle_cache")
+    results = verify_cache(directory)
+    for key, ok, message in results:
+        print(f"{'✅' if ok else '❌'} {key}: {message}")
+    sys.exit(0 if all(ok for _, ok, _ in results) else 1)
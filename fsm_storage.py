@@ -0,0 +1,202 @@
+# تخزين حالات FSM لـ aiogram في جدول SQL (PostgreSQL المشترك أو SQLite محلي) بدلاً من ذاكرة العملية.
+# الكتابة تُحدّث كاشاً في الذاكرة فوراً وتُجمع في دفعات تُكتب كل flush_interval في معاملة واحدة،
+# والقراءة تُخدم من الكاش لمدة cache_ttl ثم من القاعدة حتى ترى كل عملية ما كتبته العمليات الأخرى.
+
+import asyncio
+import json
+import logging
+import sqlite3
+import time
+from contextlib import closing, contextmanager
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder
+
+logger = logging.getLogger(__name__)
+
+TABLE_DDL = """
+    CREATE TABLE IF NOT EXISTS fsm_storage (
+        key TEXT PRIMARY KEY,
+        state TEXT NULL,
+        data TEXT NOT NULL DEFAULT '{}',
+        updated_at DOUBLE PRECISION
+    )
+"""
+
+
+class SQLStorage(BaseStorage):
+    """connect() يُرجع اتصال DB-API كـ context manager، و run(func) ينفذ الدالة الحاجبة خارج الـ event loop."""
+
+    def __init__(self, connect, run, placeholder="%s", cache_ttl=1.0, flush_interval=0.2, key_builder=None,
+                 max_cached=10000):
+        self._connect = connect
+        self._run = run
+        self.cache_ttl = cache_ttl
+        self.max_cached = max_cached
+        self.flush_interval = flush_interval
+        self.key_builder = key_builder or DefaultKeyBuilder(with_destiny=True)
+        p = placeholder
+        self._select_sql = f"SELECT state, data FROM fsm_storage WHERE key = {p}"
+        self._upsert_sql = (f"INSERT INTO fsm_storage (key, state, data, updated_at) VALUES ({p}, {p}, {p}, {p}) "
+                            "ON CONFLICT (key) DO UPDATE SET state = EXCLUDED.state, data = EXCLUDED.data, "
+                            "updated_at = EXCLUDED.updated_at")
+        self._delete_sql = f"DELETE FROM fsm_storage WHERE key = {p}"
+        self._cache = {}   # key -> [state, data, loaded_at]
+        self._dirty = {}   # key -> (state, data) بانتظار الكتابة
+        self._flushing = {}  # الدفعة الجارية كتابتها: تبقى مرجعية حتى تُثبت في القاعدة
+        self._written_at = {}  # key -> وقت آخر كتابة محلية (monotonic)؛ قراءة بدأت قبله قديمة
+        self._loading = {}   # key -> عدد القراءات الجارية من القاعدة
+        self._flush_task = None
+        self._closed = False
+        self.reads = 0
+        self.cache_hits = 0
+        self.flushes = 0
+        self.rows_written = 0
+        self.flush_errors = 0
+
+    # ---------- القراءة ----------
+    def _load_row(self, key):
+        with self._connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute(self._select_sql, (key,))
+            row = cursor.fetchone()
+            conn.commit()
+        if row is None:
+            return None, {}
+        return row[0], json.loads(row[1]) if row[1] else {}
+
+    def _pending(self, key):
+        return key in self._dirty or key in self._flushing
+
+    async def _entry(self, storage_key):
+        key = self.key_builder.build(storage_key)
+        entry = self._cache.get(key)
+        if entry is not None and (self._pending(key) or time.monotonic() - entry[2] <= self.cache_ttl):
+            self.cache_hits += 1
+            return key, entry
+        self.reads += 1
+        started = time.monotonic()
+        self._loading[key] = self._loading.get(key, 0) + 1
+        try:
+            state, data = await self._run(self._load_row, key)
+        finally:
+            self._loading[key] -= 1
+            if not self._loading[key]:
+                del self._loading[key]
+        if self._written_at.get(key, -1.0) >= started:
+            # كتابة محلية حدثت أثناء القراءة (حتى لو أُفرغت من _dirty بالفعل) أحدث مما في القاعدة
+            return key, self._cache[key]
+        entry = self._cache[key] = [state, data, time.monotonic()]
+        if len(self._cache) > self.max_cached:
+            self._prune()
+        return key, entry
+
+    def _prune(self):
+        """إسقاط المدخلات المنتهية وغير المعلقة؛ كل مستخدم يرسل رسالة يضيف مدخلاً للكاش."""
+        cutoff = time.monotonic() - self.cache_ttl
+        for key in [key for key, entry in self._cache.items()
+                    if entry[2] < cutoff and not self._pending(key) and key not in self._loading]:
+            del self._cache[key]
+            self._written_at.pop(key, None)
+
+    async def get_state(self, key):
+        _, entry = await self._entry(key)
+        return entry[0]
+
+    async def get_data(self, key):
+        _, entry = await self._entry(key)
+        return dict(entry[1])
+
+    # ---------- الكتابة ----------
+    def _write(self, key, state, data):
+        now = time.monotonic()
+        self._cache[key] = [state, data, now]
+        self._written_at[key] = now
+        self._dirty[key] = (state, data)
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.get_running_loop().create_task(self._flush_later())
+
+    async def set_state(self, key, state=None):
+        key, entry = await self._entry(key)
+        self._write(key, state.state if isinstance(state, State) else state, entry[1])
+
+    async def set_data(self, key, data):
+        key, entry = await self._entry(key)
+        self._write(key, entry[0], dict(data))
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.flush_interval)
+        await self.flush()
+
+    def _write_rows(self, batch):
+        now = time.time()
+        upserts = [(key, state, json.dumps(data, ensure_ascii=False), now)
+                   for key, (state, data) in batch.items() if state is not None or data]
+        deletes = [(key,) for key, (state, data) in batch.items() if state is None and not data]
+        with self._connect() as conn:
+            cursor = conn.cursor()
+            if upserts:
+                cursor.executemany(self._upsert_sql, upserts)
+            if deletes:
+                cursor.executemany(self._delete_sql, deletes)
+            conn.commit()
+        return len(upserts) + len(deletes)
+
+    async def flush(self):
+        """كتابة كل التغييرات المعلقة في معاملة واحدة؛ عند الفشل تبقى معلقة للمحاولة التالية."""
+        if not self._dirty:
+            return
+        batch, self._dirty = self._dirty, {}
+        self._flushing.update(batch)
+        try:
+            self.rows_written += await self._run(self._write_rows, batch)
+            self.flushes += 1
+        except Exception as e:
+            self.flush_errors += 1
+            logger.error(f"❌ فشل حفظ حالات FSM ({len(batch)}): {e}")
+            for key, value in batch.items():
+                self._dirty.setdefault(key, value)
+            if not self._closed:
+                self._flush_task = asyncio.get_running_loop().create_task(self._flush_later())
+        finally:
+            for key, value in batch.items():
+                if self._flushing.get(key) is value:
+                    del self._flushing[key]
+
+    async def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        if self._flush_task is not None and not self._flush_task.done():
+            # لا نلغي الدفعة الجارية: قد تكون أُخرجت من _dirty وهي في منتصف الكتابة
+            await self._flush_task
+        await self.flush()
+
+    def stats(self):
+        return {
+            "cached": len(self._cache),
+            "pending": len(self._dirty) + len(self._flushing),
+            "reads": self.reads,
+            "cache_hits": self.cache_hits,
+            "flushes": self.flushes,
+            "rows_written": self.rows_written,
+            "flush_errors": self.flush_errors,
+        }
+
+
+def sqlite_connector(path):
+    """اتصال SQLite جديد لكل عملية (آمن بين الخيوط) مع إنشاء الجدول عند أول استخدام."""
+    with closing(sqlite3.connect(path)) as conn:
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(TABLE_DDL)
+        conn.commit()
+
+    @contextmanager
+    def connect():
+        conn = sqlite3.connect(path, timeout=10)
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    return connect
@@ -0,0 +1,267 @@
+# محرك مؤشرات تزايدي: كل شمعة جديدة تكلف O(1) بدل إعادة الحساب على كامل البيانات
+# يطابق حسابات الاستراتيجيات الحالية (مكتبة ta و pandas rolling) ضمن هامش خطأ صغير.
+
+import math
+from collections import deque
+
+import numpy as np
+import pandas as pd
+import ta
+
+NAN = float("nan")
+
+
+class RollingSum:
+    """مجموع آخر window قيمة؛ يعاد حسابه بالكامل دورياً لمنع تراكم خطأ الفاصلة العائمة."""
+
+    RESUM_EVERY = 1000
+
+    def __init__(self, window):
+        self.window = window
+        self.values = deque()
+        self.total = 0.0
+        self._pushes = 0
+
+    def push(self, value):
+        if self.window == 0:
+            return
+        self.values.append(value)
+        self.total += value
+        if len(self.values) > self.window:
+            self.total -= self.values.popleft()
+        self._pushes += 1
+        if self._pushes % self.RESUM_EVERY == 0:
+            self.total = math.fsum(self.values)
+
+    def __len__(self):
+        return len(self.values)
+
+
+class RollingExtreme:
+    """أعلى (أو أدنى) قيمة في آخر window عنصر عبر deque رتيب؛ O(1) مستهلكة لكل إضافة."""
+
+    def __init__(self, window, is_max=True):
+        self.window = window
+        self.is_max = is_max
+        self._deque = deque()  # (index, value)
+        self._index = 0
+
+    def push(self, value):
+        if self.window == 0:
+            return
+        if self.is_max:
+            while self._deque and self._deque[-1][1] <= value:
+                self._deque.pop()
+        else:
+            while self._deque and self._deque[-1][1] >= value:
+                self._deque.pop()
+        self._deque.append((self._index, value))
+        self._index += 1
+        while self._deque[0][0] <= self._index - 1 - self.window:
+            self._deque.popleft()
+
+    def current(self):
+        return self._deque[0][1] if self._deque else None
+
+
+class IndicatorEngine:
+    """مؤشرات الاستراتيجيات الأربع مع حالة جارية:
+    متوسطات Wilder لـ RSI، حالة EMA لـ MACD وخط الإشارة، مجاميع جارية للمتوسطات،
+    deques رتيبة لأعلى/أدنى 20 شمعة، و ATR كمتوسط True Range.
+
+    الشمعة الأخيرة تعتبر قيد التكوين: تحديثها بنفس التوقيت يعيد حسابها من الحالة المثبتة فقط."""
+
+    def __init__(self, rsi_period=14, macd_fast=12, macd_slow=26, macd_signal=9,
+                 ma_fast=20, ma_slow=50, range_window=20, atr_period=14):
+        self.rsi_period = rsi_period
+        self.macd_fast = macd_fast
+        self.macd_slow = macd_slow
+        self.macd_signal = macd_signal
+        self.ma_fast = ma_fast
+        self.ma_slow = ma_slow
+        self.range_window = range_window
+        self.atr_period = atr_period
+
+        # الحالة المثبتة (كل الشموع عدا الأخيرة)
+        self._state = {
+            "n": 0, "close": NAN, "rsi_up": 0.0, "rsi_dn": 0.0, "ema_fast": NAN, "ema_slow": NAN,
+            "signal": NAN, "signal_n": 0, "hl_sum": 0.0, "tr_n": 0, "rsi": NAN, "hist": NAN,
+        }
+        # النوافذ تحتوي الشموع المثبتة فقط؛ الشمعة الأخيرة تضاف عند الحساب
+        self._closes_fast = RollingSum(ma_fast - 1)
+        self._closes_slow = RollingSum(ma_slow - 1)
+        self._true_ranges = RollingSum(atr_period - 1)
+        self._highs = RollingExtreme(range_window - 1, is_max=True)
+        self._lows = RollingExtreme(range_window - 1, is_max=False)
+
+        self._pending = None  # (ts, high, low, close)
+        self._pending_state = None
+        self._values = None
+        self._closed_values = None  # قيم آخر شمعة مثبتة (قبل الشمعة قيد التكوين)
+
+    @property
+    def last_ts(self):
+        return self._pending[0] if self._pending else None
+
+    @property
+    def bars(self):
+        return self._state["n"] + (1 if self._pending else 0)
+
+    def _step(self, high, low, close):
+        """حساب الحالة بعد إضافة شمعة إلى الحالة المثبتة (بدون تعديلها)."""
+        s = self._state
+        n = s["n"] + 1
+        first = s["n"] == 0
+
+        # RSI (Wilder): الفرق الأول يعامل كصفر كما في ta
+        diff = 0.0 if first else close - s["close"]
+        up, dn = max(diff, 0.0), max(-diff, 0.0)
+        alpha = 1.0 / self.rsi_period
+        rsi_up = up if first else s["rsi_up"] + alpha * (up - s["rsi_up"])
+        rsi_dn = dn if first else s["rsi_dn"] + alpha * (dn - s["rsi_dn"])
+        if n < self.rsi_period:
+            rsi = NAN
+        elif rsi_dn == 0:
+            rsi = 100.0
+        else:
+            rsi = 100.0 - 100.0 / (1.0 + rsi_up / rsi_dn)
+
+        # MACD: EMA(12) - EMA(26) وخط إشارة EMA(9) يبدأ من أول قيمة MACD صالحة
+        a_fast = 2.0 / (self.macd_fast + 1)
+        a_slow = 2.0 / (self.macd_slow + 1)
+        ema_fast = close if first else s["ema_fast"] + a_fast * (close - s["ema_fast"])
+        ema_slow = close if first else s["ema_slow"] + a_slow * (close - s["ema_slow"])
+        macd = ema_fast - ema_slow if n >= max(self.macd_fast, self.macd_slow) else NAN
+        signal, signal_n = s["signal"], s["signal_n"]
+        if not math.isnan(macd):
+            a_sig = 2.0 / (self.macd_signal + 1)
+            signal = macd if signal_n == 0 else signal + a_sig * (macd - signal)
+            signal_n += 1
+        macd_signal = signal if signal_n >= self.macd_signal else NAN
+        hist = macd - macd_signal
+
+        # المتوسطات المتحركة
+        ma_fast = (self._closes_fast.total + close) / self.ma_fast if n >= self.ma_fast else NAN
+        ma_slow = (self._closes_slow.total + close) / self.ma_slow if n >= self.ma_slow else NAN
+
+        # أعلى / أدنى نافذة الكسر
+        if n >= self.range_window:
+            prev_high, prev_low = self._highs.current(), self._lows.current()
+            high_n = high if prev_high is None else max(prev_high, high)
+            low_n = low if prev_low is None else min(prev_low, low)
+        else:
+            high_n = low_n = NAN
+
+        # ATR: أول شمعة بلا True Range (الإغلاق السابق غير موجود)
+        tr = NAN if first else max(high - low, abs(high - s["close"]), abs(low - s["close"]))
+        tr_n = s["tr_n"] + (0 if first else 1)
+        atr = (self._true_ranges.total + tr) / self.atr_period if tr_n >= self.atr_period else NAN
+        hl_sum = s["hl_sum"] + (high - low)
+
+        state = {
+            "n": n, "close": close, "rsi_up": rsi_up, "rsi_dn": rsi_dn, "ema_fast": ema_fast,
+            "ema_slow": ema_slow, "signal": signal, "signal_n": signal_n, "hl_sum": hl_sum,
+            "tr_n": tr_n, "rsi": rsi, "hist": hist,
+        }
+        values = {
+            "bars": n,
+            "close": close,
+            "prev_close": s["close"],
+            "rsi": rsi,
+            "prev_rsi": s["rsi"],
+            "macd": macd,
+            "macd_signal": macd_signal,
+            "macd_hist": hist,
+            "prev_macd_hist": s["hist"],
+            "ma_fast": ma_fast,
+            "ma_slow": ma_slow,
+            "high_n": high_n,
+            "low_n": low_n,
+            "atr": atr,
+            "mean_range": hl_sum / n,
+        }
+        return state, values, tr
+
+    def _commit(self):
+        _, high, low, close = self._pending
+        state, _, tr = self._pending_state
+        self._state = state
+        self._closes_fast.push(close)
+        self._closes_slow.push(close)
+        if not math.isnan(tr):
+            self._true_ranges.push(tr)
+        self._highs.push(high)
+        self._lows.push(low)
+
+    def update(self, ts, high, low, close):
+        """إضافة شمعة جديدة أو تحديث الشمعة الأخيرة (نفس التوقيت). O(1)."""
+        if self._pending is not None:
+            if ts < self._pending[0]:
+                raise ValueError("لا يمكن إضافة شمعة أقدم من آخر شمعة")
+            if ts > self._pending[0]:
+                self._closed_values = self._values
+                self._commit()
+        self._pending = (ts, high, low, close)
+        self._pending_state = self._step(high, low, close)
+        self._values = self._pending_state[1]
+        return self._values
+
+    def values(self):
+        return dict(self._values) if self._values else {"bars": 0}
+
+    def closed_values(self):
+        """القيم كما كانت عند آخر تحديث للشمعة السابقة للشمعة الأخيرة."""
+        return dict(self._closed_values) if self._closed_values else {"bars": 0}
+
+    @classmethod
+    def from_frame(cls, df, **kwargs):
+        engine = cls(**kwargs)
+        engine.extend(df)
+        return engine
+
+    def extend(self, df):
+        timestamps = df.index.as_unit("s").asi8 if isinstance(df.index, pd.DatetimeIndex) else range(len(df))
+        for ts, high, low, close in zip(timestamps, df['High'].to_numpy(), df['Low'].to_numpy(), df['Close'].to_numpy()):
+            if self._pending is None or ts >= self._pending[0]:
+                self.update(int(ts), float(high), float(low), float(close))
+        return self.values()
+
+
+def reference_values(df, range_window=20, ma_fast=20, ma_slow=50, atr_period=14, rsi_period=14):
+    """نفس القيم محسوبة بإعادة الحساب الكاملة كما تفعل الاستراتيجيات (للمقارنة)."""
+    close = df['Close']
+    rsi = ta.momentum.RSIIndicator(close, window=rsi_period).rsi()
+    macd = ta.trend.MACD(close)
+    macd_diff = macd.macd_diff()
+    true_range = np.maximum(np.maximum(df['High'] - df['Low'], np.abs(df['High'] - close.shift())),
+                            np.abs(df['Low'] - close.shift()))
+    last = lambda series, offset=1: float(series.iloc[-offset]) if len(series) >= offset else NAN
+    return {
+        "bars": len(df),
+        "close": last(close),
+        "prev_close": last(close, 2),
+        "rsi": last(rsi),
+        "prev_rsi": last(rsi, 2),
+        "macd": last(macd.macd()),
+        "macd_signal": last(macd.macd_signal()),
+        "macd_hist": last(macd_diff),
+        "prev_macd_hist": last(macd_diff, 2),
+        "ma_fast": last(close.rolling(ma_fast).mean()),
+        "ma_slow": last(close.rolling(ma_slow).mean()),
+        "high_n": last(df['High'].rolling(range_window).max()),
+        "low_n": last(df['Low'].rolling(range_window).min()),
+        "atr": last(true_range.rolling(atr_period).mean()),
+        "mean_range": float((df['High'] - df['Low']).mean()),
+    }
+
+
+def compare_values(streaming, reference, rel_tol=1e-6, abs_tol=1e-6):
+    """أسماء المؤشرات التي يختلف فيها المحرك التزايدي عن إعادة الحساب الكاملة."""
+    mismatches = []
+    for key, expected in reference.items():
+        actual = streaming.get(key, NAN)
+        if math.isnan(expected) and math.isnan(actual):
+            continue
+        if math.isnan(expected) or math.isnan(actual) or not math.isclose(actual, expected, rel_tol=rel_tol, abs_tol=abs_tol):
+            mismatches.append((key, actual, expected))
+    return mismatches
@@ -0,0 +1,55 @@
+# استيراد مؤجل للمكتبات الثقيلة (pandas، yfinance، ta...) حتى يبدأ البوت بالرد قبل تحميلها.
+# LazyModule تستورد الوحدة عند أول وصول لأي خاصية، ثم تستبدل نفسها بالوحدة الحقيقية في globals
+# المالك حتى لا يبقى أي تكلفة إضافية بعد التحميل. preload تُستدعى في الخلفية لتسخين المكتبات مسبقاً.
+
+import importlib
+import sys
+import time
+
+IMPORT_TIMINGS = {}  # اسم الوحدة -> ثواني الاستيراد الفعلي (0 إن كانت محملة مسبقاً)
+
+
+def _import(name):
+    if name in sys.modules:
+        IMPORT_TIMINGS.setdefault(name, 0.0)
+        return sys.modules[name]
+    started = time.perf_counter()
+    module = importlib.import_module(name)
+    IMPORT_TIMINGS[name] = time.perf_counter() - started
+    return module
+
+
+class LazyModule:
+    """وكيل لوحدة لم تُستورد بعد."""
+
+    def __init__(self, name, namespace=None, alias=None):
+        self.__dict__.update(_name=name, _namespace=namespace, _alias=alias or name.rpartition(".")[2], _module=None)
+
+    def load(self):
+        module = self._module
+        if module is None:
+            module = _import(self._name)
+            self.__dict__["_module"] = module
+            if self._namespace is not None and self._namespace.get(self._alias) is self:
+                self._namespace[self._alias] = module
+        return module
+
+    @property
+    def loaded(self):
+        return self._module is not None
+
+    def __getattr__(self, attr):
+        return getattr(self.load(), attr)
+
+    def __setattr__(self, attr, value):
+        setattr(self.load(), attr, value)
+
+    def __repr__(self):
+        return f"<LazyModule {self._name} ({'loaded' if self.loaded else 'not loaded'})>"
+
+
+def preload(*names):
+    """استيراد مجموعة وحدات وإرجاع زمن كل منها (قابلة للتشغيل في خيط أو عملية منفصلة)."""
+    for name in names:
+        _import(name)
+    return {name: IMPORT_TIMINGS[name] for name in names}
@@ -0,0 +1,136 @@
+# مراقب توقف الـ event loop: نبضة دورية داخل الـ loop وخيط مراقبة خارجه.
+# إذا تأخرت النبضة أكثر من الحد يُلتقط stack خيط الـ loop عبر sys._current_frames
+# ويُحدد المتسبب: أعمق دالة من ملفات المشروع (مثل get_yahoo_gold_price) وأعمق دالة عموماً (مثل socket.recv).
+
+import asyncio
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+
+
+class LoopWatchdog:
+    def __init__(self, threshold=0.25, interval=0.1, project_root=None, history=20, lag_window=600, on_stall=None):
+        self.threshold = threshold
+        self.interval = interval
+        self.on_stall = on_stall  # تُستدعى من خيط المراقبة بعد انتهاء كل توقف
+        self.project_root = os.path.abspath(project_root or os.path.dirname(os.path.abspath(__file__)))
+        self._lags = deque(maxlen=lag_window)
+        self._events = deque(maxlen=history)
+        self._by_culprit = {}  # culprit -> {"count", "max", "total"}
+        self._current = None
+        self._last_beat = time.monotonic()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._task = None
+        self._loop_thread_id = None
+        self.stalls = 0
+        self.max_lag = 0.0
+
+    # ---------- داخل الـ loop ----------
+    def start(self, loop=None):
+        """يُستدعى من داخل الـ loop المراد مراقبته."""
+        loop = loop or asyncio.get_running_loop()
+        self._loop_thread_id = threading.get_ident()
+        self._last_beat = time.monotonic()
+        self._stop.clear()
+        self._task = loop.create_task(self._heartbeat())
+        self._thread = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._task is not None:
+            self._task.cancel()
+        if self._thread is not None:
+            self._thread.join(timeout=1.0)
+
+    async def _heartbeat(self):
+        while True:
+            expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            lag = max(0.0, now - expected)
+            with self._lock:
+                self._lags.append(lag)
+                self.max_lag = max(self.max_lag, lag)
+                self._last_beat = now
+
+    # ---------- خيط المراقبة ----------
+    def _watch(self):
+        while not self._stop.wait(self.interval / 2):
+            with self._lock:
+                blocked = time.monotonic() - self._last_beat - self.interval
+                current = self._current
+            if blocked >= self.threshold:
+                if current is None:
+                    self._begin_stall(blocked)
+                else:
+                    current["duration"] = blocked
+            elif current is not None:
+                self._end_stall()
+
+    def _begin_stall(self, blocked):
+        frame = sys._current_frames().get(self._loop_thread_id)
+        stack = traceback.extract_stack(frame) if frame is not None else []
+        event = {
+            "started_at": time.time() - blocked,
+            "duration": blocked,
+            "culprit": self._culprit(stack),
+            "innermost": self._describe(stack[-1]) if stack else "?",
+            "stack": [self._describe(entry) for entry in stack[-12:]],
+        }
+        with self._lock:
+            self._current = event
+
+    def _end_stall(self):
+        with self._lock:
+            event, self._current = self._current, None
+            if self._lags:
+                event["duration"] = max(event["duration"], self._lags[-1])  # المدة الفعلية كما رصدتها النبضة
+            self.stalls += 1
+            self._events.append(event)
+            entry = self._by_culprit.setdefault(event["culprit"], {"count": 0, "max": 0.0, "total": 0.0})
+            entry["count"] += 1
+            entry["max"] = max(entry["max"], event["duration"])
+            entry["total"] += event["duration"]
+        if self.on_stall is not None:
+            try:
+                self.on_stall(event)
+            except Exception:
+                pass
+
+    def _is_project_frame(self, entry):
+        filename = os.path.abspath(entry.filename)
+        return (filename.startswith(self.project_root + os.sep) and filename != os.path.abspath(__file__)
+                and "site-packages" not in filename)
+
+    @staticmethod
+    def _describe(entry):
+        return f"{entry.name} ({os.path.basename(entry.filename)}:{entry.lineno})"
+
+    def _culprit(self, stack):
+        """أعمق دالة من ملفات المشروع؛ وإلا أعمق دالة في الـ stack."""
+        for entry in reversed(stack):
+            if self._is_project_frame(entry):
+                return entry.name
+        return stack[-1].name if stack else "?"
+
+    # ---------- الإحصائيات ----------
+    def stats(self):
+        with self._lock:
+            lags = sorted(self._lags)
+            current = dict(self._current) if self._current else None
+            return {
+                "lag": self._lags[-1] if self._lags else 0.0,
+                "lag_p50": lags[len(lags) // 2] if lags else 0.0,
+                "lag_p99": lags[min(len(lags) - 1, int(len(lags) * 0.99))] if lags else 0.0,
+                "max_lag": self.max_lag,
+                "stalls": self.stalls,
+                "current": current,
+                "recent": [dict(event) for event in self._events],
+                "by_culprit": {name: dict(entry) for name, entry in self._by_culprit.items()},
+            }
@@ -3,19 +3,42 @@
 
 import asyncio
 import time
+STARTUP_STARTED = time.monotonic()  # بداية الإقلاع لتقرير زمن التشغيل
 import os
+import sys
+import importlib.machinery
+import threading
+import functools
+import statistics
+import concurrent.futures
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 import psycopg2
-import pandas as pd
-import numpy as np
+import psycopg2.extensions
 import uuid
-import requests
+import bisect
+from collections import deque
 import json
-import ta
 import logging
-import yfinance as yf
 from datetime import datetime, timedelta, timezone 
 from urllib.parse import urlparse
 
+import metrics
+import loop_watchdog
+import fsm_storage
+from lazy_imports import LazyModule, IMPORT_TIMINGS, preload
+
+# مكتبات التحليل الثقيلة تُستورد عند أول استخدام أو بالتسخين في الخلفية بعد بدء الاستقبال
+pd = LazyModule("pandas", globals(), "pd")
+np = LazyModule("numpy", globals(), "np")
+ta = LazyModule("ta", globals())
+yf = LazyModule("yfinance", globals(), "yf")
+requests = LazyModule("requests", globals())
+candle_cache = LazyModule("candle_cache", globals())
+indicators = LazyModule("indicators", globals())
+ANALYSIS_MODULES = [pd, np, ta, requests, yf, candle_cache, indicators]
+
 from aiogram import Bot, Dispatcher, types, F, BaseMiddleware
 from aiogram.filters import Command
 from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton 
@@ -23,6 +46,8 @@ from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import StatesGroup, State
 from aiogram.client.default import DefaultBotProperties
+from aiogram.methods import GetUpdates
+from aiogram.exceptions import TelegramRetryAfter, TelegramForbiddenError, TelegramNetworkError, TelegramServerError
 from typing import Callable, Dict, Any, Awaitable
 
 # إعدادات اللوجر
@@ -32,7 +57,9 @@ logger = logging.getLogger(__name__)
 # =============== إعدادات محسنة ===============
 BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 ADMIN_ID_STR = os.getenv("ADMIN_ID", "0") 
-TRADE_SYMBOL = "XAUUSD"
+# الرموز التي يحللها البوت ويتابع صفقاتها، مفصولة بفواصل (الأول هو الرمز الأساسي)
+TRADE_SYMBOLS = [s.strip().upper() for s in os.getenv("TRADE_SYMBOLS", "XAUUSD").split(",") if s.strip()] or ["XAUUSD"]
+TRADE_SYMBOL = TRADE_SYMBOLS[0]
 
 # إعدادات الثقة
 CONFIDENCE_THRESHOLD_98 = 0.95
@@ -45,10 +72,37 @@ MIN_FILTERS_FOR_90 = 3
 # الفترات الزمنية
 TRADE_ANALYSIS_INTERVAL_98 = 60
 TRADE_ANALYSIS_INTERVAL_90 = 60
-TRADE_CHECK_INTERVAL = 30
+# المتابعة تقرأ قمم وقيعان شموع الدقيقة منذ آخر فحص فلا تفوتها الذيول بين الفحوصات
+TRADE_CHECK_INTERVAL = int(os.getenv("TRADE_CHECK_INTERVAL", "60"))
+# candle: التحليل بعد إغلاق كل شمعة مباشرة | interval: كل TRADE_ANALYSIS_INTERVAL ثانية
+ANALYSIS_SCHEDULE = os.getenv("ANALYSIS_SCHEDULE", "candle")
+# مهلة بعد الإغلاق حتى تنشر المصادر الشمعة المغلقة (بالثواني)
+ANALYSIS_CLOSE_DELAY = float(os.getenv("ANALYSIS_CLOSE_DELAY", "5"))
+
+# نافذة صلاحية السعر المشترك بين المستخدمين ومتابعة الصفقات والتحليل (بالثواني)
+PRICE_CACHE_TTL = float(os.getenv("PRICE_CACHE_TTL", "10"))
+
+# طريقة جلب السعر: hedged (المصدر التالي يبدأ بعد تأخير قصير) | median (كل المصادر بالتوازي) | sequential
+PRICE_FETCH_MODE = os.getenv("PRICE_FETCH_MODE", "hedged")
+PRICE_HEDGE_DELAY = float(os.getenv("PRICE_HEDGE_DELAY", "1.5"))
+PRICE_FETCH_DEADLINE = float(os.getenv("PRICE_FETCH_DEADLINE", "8"))
+
+# ترتيب المصادر: adaptive (الأسرع والأنجح أولاً حسب القياس) | fixed (الترتيب المكتوب في الكود)
+SOURCE_ORDER_MODE = os.getenv("SOURCE_ORDER_MODE", "adaptive")
+# قاطع الدائرة: بعد عدد فشل متتالٍ يُتخطى المصدر لمدة تتضاعف مع كل فشل عند إعادة التجربة
+SOURCE_BREAKER_FAILURES = int(os.getenv("SOURCE_BREAKER_FAILURES", "3"))
+SOURCE_BREAKER_COOLDOWN = float(os.getenv("SOURCE_BREAKER_COOLDOWN", "60"))
+SOURCE_BREAKER_MAX_COOLDOWN = float(os.getenv("SOURCE_BREAKER_MAX_COOLDOWN", "900"))
+SOURCE_HEALTH_WINDOW = int(os.getenv("SOURCE_HEALTH_WINDOW", "50"))
 
 ADMIN_USERNAME = "I1l_1"
 
+# حدود الإرسال الجماعي (تيليجرام: ~30 رسالة/ثانية إجمالاً و رسالة/ثانية لكل محادثة)
+BROADCAST_GLOBAL_RATE = float(os.getenv("BROADCAST_GLOBAL_RATE", "25"))
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "20"))
+BROADCAST_PER_CHAT_INTERVAL = 1.0
+BROADCAST_MAX_RETRIES = 3
+
 try:
     ADMIN_ID = int(ADMIN_ID_STR)
     if ADMIN_ID == 0:
@@ -63,269 +117,1182 @@ if not BOT_TOKEN:
 bot = Bot(token=BOT_TOKEN, 
           default=DefaultBotProperties(parse_mode="HTML")) 
           
-dp = Dispatcher(storage=MemoryStorage())
-
 # =============== دوال مساعدة ===============
 def h(text):
     """دالة تنظيف HTML بدائية (Escaping)."""
     text = str(text)
     return text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;').replace('"', '&quot;')
 
+# =============== الرموز المدعومة ===============
+# رمز Yahoo لكل زوج، و Bybit للذهب فقط، وعدد الخانات العشرية في عرض الأسعار
+SYMBOL_SOURCES = {
+    "XAUUSD": {"yahoo": "GC=F", "bybit": "XAUUSD", "decimals": 2, "name": "الذهب"},
+    "XAGUSD": {"yahoo": "SI=F", "bybit": None, "decimals": 3, "name": "الفضة"},
+    "EURUSD": {"yahoo": "EURUSD=X", "bybit": None, "decimals": 5, "name": "اليورو/دولار"},
+    "GBPUSD": {"yahoo": "GBPUSD=X", "bybit": None, "decimals": 5, "name": "الجنيه/دولار"},
+    "USDJPY": {"yahoo": "JPY=X", "bybit": None, "decimals": 3, "name": "الدولار/ين"},
+}
+
+def symbol_info(symbol):
+    info = SYMBOL_SOURCES.get(symbol)
+    if info is None:
+        # أي زوج عملات آخر بصيغة Yahoo القياسية
+        info = {"yahoo": f"{symbol}=X", "bybit": None, "decimals": 5, "name": symbol}
+    return info
+
+def format_price(symbol, value):
+    return f"{value:,.{symbol_info(symbol)['decimals']}f}"
+
+# =============== المقاييس (Prometheus) ===============
+# خادم محلي يعرض /metrics بصيغة Prometheus النصية (0 = تعطيل)
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9108"))
+
+SOURCE_LATENCY = metrics.REGISTRY.histogram("alphatrade_source_latency_seconds", "زمن طلب مصدر بيانات خارجي", ["kind", "source"])
+SOURCE_ERRORS = metrics.REGISTRY.counter("alphatrade_source_errors_total", "طلبات مصادر فشلت أو بلا بيانات", ["kind", "source"])
+DB_LATENCY = metrics.REGISTRY.histogram("alphatrade_db_call_seconds", "زمن دوال قاعدة البيانات (شاملاً الانتظار في مجمع الخيوط)", ["helper"])
+DB_ERRORS = metrics.REGISTRY.counter("alphatrade_db_errors_total", "دوال قاعدة بيانات رفعت استثناء أو انتهت مهلتها", ["helper"])
+HANDLER_LATENCY = metrics.REGISTRY.histogram("alphatrade_handler_seconds", "زمن معالجات تيليجرام", ["handler"])
+HANDLER_ERRORS = metrics.REGISTRY.counter("alphatrade_handler_errors_total", "معالجات تيليجرام رفعت استثناء", ["handler"])
+BROADCAST_RECIPIENTS = metrics.REGISTRY.gauge("alphatrade_broadcast_recipients", "مستلمون في إرسال جماعي جارٍ")
+ACTIVE_TRADES_GAUGE = metrics.REGISTRY.gauge("alphatrade_active_trades", "الصفقات النشطة في الذاكرة")
+ANALYSIS_AGE_GAUGE = metrics.REGISTRY.gauge("alphatrade_analysis_age_seconds", "عمر آخر تحليل لكل رمز", ["symbol"])
+
+SOURCE_BREAKER_OPEN = metrics.REGISTRY.gauge("alphatrade_source_breaker_open", "قاطع دائرة المصدر مفتوح (1) أو مغلق (0)", ["kind", "source"])
+
+def observe_source(kind, source, started, ok):
+    latency = time.monotonic() - started
+    SOURCE_LATENCY.observe(latency, kind=kind, source=source)
+    if not ok:
+        SOURCE_ERRORS.inc(kind=kind, source=source)
+    get_source_health(kind, source).record(ok, latency, started)
+
+# =============== صحة المصادر وقواطع الدائرة ===============
+class SourceHealth:
+    """سجل صحة مصدر واحد: نسبة النجاح وزمن الاستجابة في نافذة متحركة، آخر خطأ، وحالة قاطع الدائرة."""
+
+    def __init__(self, kind, name, window=SOURCE_HEALTH_WINDOW):
+        self.kind = kind
+        self.name = name
+        self._lock = threading.Lock()
+        self._samples = deque(maxlen=window)  # (ok, latency)
+        self.calls = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.last_error = None
+        self.last_error_at = None
+        self.last_success_at = None
+        self.open_until = 0.0   # القاطع مفتوح حتى هذا الوقت (monotonic)
+        self.cooldown = SOURCE_BREAKER_COOLDOWN
+        self.trips = 0
+        self.probe_at = 0.0     # بداية تجربة نصف الفتح الجارية (monotonic)؛ 0 = لا تجربة
+
+    def note_error(self, error):
+        with self._lock:
+            self.last_error = f"{type(error).__name__}: {error}"[:200]
+            self.last_error_at = time.monotonic()
+
+    def record(self, ok, latency, started):
+        with self._lock:
+            self.calls += 1
+            self._samples.append((ok, latency))
+            if ok:
+                self.consecutive_failures = 0
+                self.last_success_at = time.monotonic()
+                self.open_until = 0.0
+                self.cooldown = SOURCE_BREAKER_COOLDOWN
+                self.probe_at = 0.0
+                return
+            self.failures += 1
+            self.consecutive_failures += 1
+            if self.last_error_at is None or self.last_error_at < started:
+                self.last_error = "لا توجد بيانات"
+                self.last_error_at = time.monotonic()
+            if self.probe_at and started >= self.probe_at:
+                # فشل تجربة نصف الفتح: إعادة الفتح بمدة مضاعفة
+                self.probe_at = 0.0
+                self.cooldown = min(SOURCE_BREAKER_MAX_COOLDOWN, self.cooldown * 2)
+            elif self.open_until or self.consecutive_failures < SOURCE_BREAKER_FAILURES:
+                # القاطع مفتوح أصلاً (استدعاء عبر مسار "كل القواطع مفتوحة") أو لم يبلغ حد الفشل
+                return
+            self.open_until = time.monotonic() + self.cooldown
+            self.trips += 1
+            logger.warning(f"🔌 قاطع الدائرة مفتوح لـ {self.kind}/{self.name} لمدة {self.cooldown:.0f}s "
+                           f"بعد {self.consecutive_failures} فشل ({self.last_error})")
+
+    def is_open(self):
+        return time.monotonic() < self.open_until
+
+    def _probing(self, now):
+        # التجربة التي لا تُسجل نتيجتها خلال MARKET_CALL_TIMEOUT تُعتبر ضائعة ويُسمح بغيرها
+        return now - self.probe_at < MARKET_CALL_TIMEOUT
+
+    def allow(self):
+        """هل المصدر مؤهل للترتيب؟ مغلق: نعم؛ مفتوح: لا؛ نصف مفتوح: نعم ما لم تكن هناك تجربة جارية.
+        لا يحجز التجربة: الحجز في begin_call قبل الاستدعاء الفعلي."""
+        with self._lock:
+            now = time.monotonic()
+            if not self.open_until:
+                return True
+            return now >= self.open_until and not self._probing(now)
+
+    def begin_call(self):
+        """يُستدعى قبل استدعاء المصدر فعلياً؛ في نصف الفتح يحجز التجربة لمستدعٍ واحد (False = محجوزة لغيره).
+        القاطع المفتوح يُسمح باستدعائه عبر مسار "كل القواطع مفتوحة" بدون اعتباره تجربة."""
+        with self._lock:
+            now = time.monotonic()
+            if not self.open_until or now < self.open_until:
+                return True
+            if self._probing(now):
+                return False
+            self.probe_at = now
+            return True
+
+    def state(self):
+        if not self.open_until:
+            return "closed"
+        return "open" if self.is_open() else "half-open"
+
+    def cost(self):
+        """الزمن المتوقع للحصول على إجابة: وسيط زمن النجاح ÷ نسبة النجاح (None = لا قياسات بعد)."""
+        with self._lock:
+            samples = list(self._samples)
+        if not samples:
+            return None
+        ok_latencies = [latency for ok, latency in samples if ok]
+        if not ok_latencies:
+            return float("inf")
+        return statistics.median(ok_latencies) * len(samples) / len(ok_latencies)
+
+    def stats(self):
+        with self._lock:
+            samples = list(self._samples)
+            latencies = sorted(latency for _, latency in samples)
+            stats = {
+                "calls": self.calls,
+                "failures": self.failures,
+                "success_rate": sum(1 for ok, _ in samples if ok) / len(samples) if samples else None,
+                "p50": latencies[len(latencies) // 2] if latencies else None,
+                "p95": latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] if latencies else None,
+                "last_error": self.last_error,
+                "last_error_age": time.monotonic() - self.last_error_at if self.last_error_at else None,
+                "trips": self.trips,
+                "retry_in": max(0.0, self.open_until - time.monotonic()),
+            }
+        stats["state"] = self.state()
+        return stats
+
+source_health = {}
+_source_health_lock = threading.Lock()
+
+def get_source_health(kind, name):
+    with _source_health_lock:
+        health = source_health.get((kind, name))
+        if health is None:
+            health = source_health[(kind, name)] = SourceHealth(kind, name)
+        return health
+
+def note_source_error(kind, name, error):
+    get_source_health(kind, name).note_error(error)
+
+def order_sources(kind, sources, name=lambda source: source):
+    """المصادر المسموح بها مرتبة: القواطع المفتوحة تُتخطى، والباقي حسب الزمن المتوقع في الوضع adaptive.
+    إذا كانت كل القواطع مفتوحة تُعاد كل المصادر حتى لا يتوقف الجلب بالكامل."""
+    healths = [(index, source, get_source_health(kind, name(source))) for index, source in enumerate(sources)]
+    allowed = [entry for entry in healths if entry[2].allow()] or healths
+    if SOURCE_ORDER_MODE == "adaptive":
+        def rank(entry):
+            index, _, health = entry
+            cost = health.cost()
+            if cost is None:
+                return (1, 0.0, index)
+            return (2, 0.0, index) if cost == float("inf") else (0, cost, index)
+        allowed.sort(key=rank)
+    return [source for _, source, _ in allowed]
+
+SOURCE_BREAKER_OPEN.set_function(lambda: {key: 1.0 if health.is_open() else 0.0 for key, health in list(source_health.items())})
+
+# =============== مراقب توقف الـ event loop ===============
+# نبضة كل LOOP_WATCHDOG_INTERVAL ثانية؛ إذا تأخرت أكثر من LOOP_STALL_THRESHOLD يُلتقط stack خيط الـ loop
+# وتُنسب المدة لأعمق دالة من ملفات البوت (مثل get_yahoo_gold_price أو get_db_connection). 0 = تعطيل.
+LOOP_STALL_THRESHOLD = float(os.getenv("LOOP_STALL_THRESHOLD", "0.25"))
+LOOP_WATCHDOG_INTERVAL = float(os.getenv("LOOP_WATCHDOG_INTERVAL", "0.1"))
+
+LOOP_LAG_GAUGE = metrics.REGISTRY.gauge("alphatrade_loop_lag_seconds", "تأخر نبضة الـ event loop", ["quantile"])
+LOOP_STALLS = metrics.REGISTRY.counter("alphatrade_loop_stalls_total", "توقفات الـ event loop حسب الدالة المتسببة", ["culprit"])
+
+def report_loop_stall(event):
+    LOOP_STALLS.inc(culprit=event["culprit"])
+    logger.warning(f"🐢 توقف الـ event loop لمدة {event['duration']:.2f}s في {event['culprit']} "
+                   f"(أعمق إطار: {event['innermost']})")
+
+loop_watchdog_monitor = loop_watchdog.LoopWatchdog(LOOP_STALL_THRESHOLD, LOOP_WATCHDOG_INTERVAL, on_stall=report_loop_stall)
+
+def _loop_lag_quantiles():
+    stats = loop_watchdog_monitor.stats()
+    return {"0.5": stats["lag_p50"], "0.99": stats["lag_p99"], "max": stats["max_lag"]}
+
+LOOP_LAG_GAUGE.set_function(_loop_lag_quantiles)
+
+# =============== تنفيذ العمليات الحاجبة خارج الـ event loop ===============
+BLOCKING_POOL_SIZE = int(os.getenv("BLOCKING_POOL_SIZE", "16"))
+DB_CALL_TIMEOUT = float(os.getenv("DB_CALL_TIMEOUT", "15"))
+MARKET_CALL_TIMEOUT = float(os.getenv("MARKET_CALL_TIMEOUT", "45"))
+
+_blocking_executor = ThreadPoolExecutor(max_workers=BLOCKING_POOL_SIZE, thread_name_prefix="blocking")
+
+async def run_blocking(func, *args, timeout=None, **kwargs):
+    """تشغيل دالة متزامنة (شبكة أو قاعدة بيانات) في مجمع خيوط محدود بدون تجميد الـ event loop.
+    عند انتهاء المهلة أو الإلغاء يُلغى الطلب إن لم يبدأ بعد، وإلا تُهمل نتيجته."""
+    loop = asyncio.get_running_loop()
+    future = loop.run_in_executor(_blocking_executor, functools.partial(func, *args, **kwargs))
+    if timeout is None:
+        return await future
+    return await asyncio.wait_for(future, timeout)
+
+async def run_db(func, *args, **kwargs):
+    started = time.monotonic()
+    # الإلغاء (CancelledError) ليس خطأ قاعدة بيانات: يمر بدون تسجيل في العدادات
+    try:
+        result = await run_blocking(func, *args, timeout=DB_CALL_TIMEOUT, **kwargs)
+    except Exception:
+        DB_ERRORS.inc(helper=func.__name__)
+        DB_LATENCY.observe(time.monotonic() - started, helper=func.__name__)
+        raise
+    DB_LATENCY.observe(time.monotonic() - started, helper=func.__name__)
+    return result
+
+async def run_market(func, *args, **kwargs):
+    return await run_blocking(func, *args, timeout=MARKET_CALL_TIMEOUT, **kwargs)
+
+# =============== مجمع العمليات للحسابات الثقيلة ===============
+# إعادة حساب المؤشرات الكاملة تعمل في عمليات منفصلة حتى تتوازى الرموز فعلياً (بدون GIL)
+ANALYSIS_PROCESS_WORKERS = int(os.getenv("ANALYSIS_PROCESS_WORKERS", str(min(4, os.cpu_count() or 1))))
+
+_cpu_pool = None
+_cpu_pool_lock = threading.Lock()
+
+def _detach_workers_from_main():
+    """spawn يعيد تنفيذ الملف الرئيسي (main.py) في كل عملية حساب: البوت والمجمعات وتخزين FSM والمقاييس.
+    تسمية __main__ باسمه تجعل العمليات تتخطى ذلك؛ المجمع لا يستقبل إلا دوال indicators و lazy_imports."""
+    main_module = sys.modules.get("__main__")
+    if main_module is not None and getattr(main_module, "__spec__", None) is None:
+        main_module.__spec__ = importlib.machinery.ModuleSpec("__main__", None)
+
+def get_cpu_pool():
+    global _cpu_pool
+    if ANALYSIS_PROCESS_WORKERS <= 0:
+        return None
+    with _cpu_pool_lock:
+        if _cpu_pool is None:
+            # spawn بدل fork: العملية الرئيسية فيها خيوط كثيرة قد تحمل أقفالاً وقت النسخ
+            _detach_workers_from_main()
+            _cpu_pool = ProcessPoolExecutor(max_workers=ANALYSIS_PROCESS_WORKERS,
+                                            mp_context=multiprocessing.get_context("spawn"))
+        return _cpu_pool
+
+def shutdown_cpu_pool():
+    global _cpu_pool
+    with _cpu_pool_lock:
+        pool, _cpu_pool = _cpu_pool, None
+    if pool is not None:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+def warm_cpu_pool():
+    """تشغيل عمليات الحساب مسبقاً: كل عملية تستورد المكتبات مرة واحدة بدلاً من أول تحليل."""
+    pool = get_cpu_pool()
+    if pool is None:
+        return
+    started = time.monotonic()
+    concurrent.futures.wait([pool.submit(preload, "pandas", "numpy", "ta", "indicators") for _ in range(ANALYSIS_PROCESS_WORKERS)])
+    logger.info(f"✅ مجمع العمليات جاهز ({ANALYSIS_PROCESS_WORKERS} عمليات) خلال {time.monotonic() - started:.1f}s")
+
+def run_cpu(func, *args):
+    """تنفيذ دالة حسابية خالصة (من indicators) في مجمع العمليات وانتظار نتيجتها من خيط العمل الحالي.
+    بدون مجمع (ANALYSIS_PROCESS_WORKERS=0) أو عند تعطله تُنفذ في نفس العملية."""
+    pool = get_cpu_pool()
+    if pool is None or getattr(func, "__module__", None) == "__main__":
+        # دوال الملف الرئيسي غير متاحة في عمليات الحساب (لا تستورده)
+        return func(*args)
+    future = pool.submit(func, *args)
+    try:
+        return future.result(timeout=MARKET_CALL_TIMEOUT)
+    except concurrent.futures.TimeoutError:
+        future.cancel()
+        logger.warning(f"⏱️ انتهت مهلة {getattr(func, '__qualname__', func)} في مجمع العمليات - الحساب داخل العملية.")
+        return func(*args)
+    except BrokenProcessPool as e:
+        logger.error(f"❌ تعطل مجمع العمليات، إعادة إنشائه: {e}")
+        shutdown_cpu_pool()
+        return func(*args)
+
 # =============== قاعدة البيانات ===============
 DATABASE_URL = os.getenv("DATABASE_URL")
 if not DATABASE_URL:
     raise ValueError("🚫 لم يتم العثور على DATABASE_URL. يرجى التأكد من ربط PostgreSQL بـ Railway.")
 
-def get_db_connection():
-    try:
-        url = urlparse(DATABASE_URL)
-        return psycopg2.connect(
+# إعدادات مجمع الاتصالات
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "1"))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "10"))
+DB_POOL_CHECKOUT_TIMEOUT = float(os.getenv("DB_POOL_CHECKOUT_TIMEOUT", "5"))
+DB_POOL_HEALTHCHECK_INTERVAL = float(os.getenv("DB_POOL_HEALTHCHECK_INTERVAL", "30"))
+
+class PoolTimeoutError(Exception):
+    """لم يتوفر اتصال حر في المجمع خلال مهلة السحب."""
+
+class DBConnectionPool:
+    """مجمع اتصالات PostgreSQL آمن للخيوط مع فحص صحة ومهلة سحب وعدادات."""
+
+    def __init__(self, dsn, min_size=1, max_size=10, checkout_timeout=5.0, healthcheck_interval=30.0):
+        url = urlparse(dsn)
+        self._connect_kwargs = dict(
             database=url.path[1:],
             user=url.username,
             password=url.password,
             host=url.hostname,
             port=url.port
         )
+        self.min_size = max(0, min_size)
+        self.max_size = max(1, max_size, self.min_size)
+        self.checkout_timeout = checkout_timeout
+        self.healthcheck_interval = healthcheck_interval
+
+        self._cond = threading.Condition()
+        self._idle = []  # [(conn, last_used)]
+        self._size = 0
+        self._closed = False
+
+        self.checkouts = 0
+        self.waits = 0
+        self.wait_time_total = 0.0
+        self.wait_time_max = 0.0
+        self.timeouts = 0
+        self.connections_created = 0
+        self.connections_discarded = 0
+        self.healthcheck_failures = 0
+
+    def _connect(self):
+        conn = psycopg2.connect(**self._connect_kwargs)
+        with self._cond:
+            self.connections_created += 1
+        return conn
+
+    def prefill(self):
+        """فتح الحد الأدنى من الاتصالات مسبقاً حتى لا يدفع أول طلب ثمن الاتصال."""
+        while True:
+            with self._cond:
+                if self._closed or self._size >= self.min_size:
+                    return
+                self._size += 1
+            try:
+                conn = self._connect()
+            except Exception:
+                with self._cond:
+                    self._size -= 1
+                    self._cond.notify()
+                raise
+            with self._cond:
+                self._idle.append((conn, time.monotonic()))
+                self._cond.notify()
+
+    def _is_healthy(self, conn, last_used):
+        if conn.closed:
+            return False
+        if time.monotonic() - last_used < self.healthcheck_interval:
+            return True
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SELECT 1")
+            cursor.close()
+            conn.rollback()
+            return True
+        except Exception:
+            return False
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+        with self._cond:
+            self._size -= 1
+            self.connections_discarded += 1
+            self._cond.notify()
+
+    def getconn(self, timeout=None):
+        """سحب اتصال سليم من المجمع، أو فتح اتصال جديد إن لم يبلغ الحد الأقصى."""
+        timeout = self.checkout_timeout if timeout is None else timeout
+        started = time.monotonic()
+        deadline = started + timeout
+        waited = False
+
+        while True:
+            conn = None
+            with self._cond:
+                while True:
+                    if self._closed:
+                        raise PoolTimeoutError("مجمع الاتصالات مغلق")
+                    if self._idle:
+                        conn, last_used = self._idle.pop()
+                        break
+                    if self._size < self.max_size:
+                        self._size += 1
+                        last_used = None
+                        break
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.timeouts += 1
+                        raise PoolTimeoutError(f"لا يوجد اتصال متاح خلال {timeout:.1f} ثانية")
+                    waited = True
+                    self._cond.wait(remaining)
+
+            if conn is None:
+                try:
+                    conn = self._connect()
+                except Exception:
+                    with self._cond:
+                        self._size -= 1
+                        self._cond.notify()
+                    raise
+            elif not self._is_healthy(conn, last_used):
+                with self._cond:
+                    self.healthcheck_failures += 1
+                self._discard(conn)
+                continue
+
+            wait_time = time.monotonic() - started
+            with self._cond:
+                self.checkouts += 1
+                if waited:
+                    self.waits += 1
+                self.wait_time_total += wait_time
+                self.wait_time_max = max(self.wait_time_max, wait_time)
+            return conn
+
+    def putconn(self, conn, discard=False):
+        """إرجاع الاتصال للمجمع بعد إلغاء أي معاملة مفتوحة."""
+        if not discard and not conn.closed:
+            try:
+                if conn.status != psycopg2.extensions.STATUS_READY:
+                    conn.rollback()
+            except Exception:
+                discard = True
+        if discard or conn.closed or self._closed:
+            self._discard(conn)
+            return
+        with self._cond:
+            self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    def closeall(self):
+        with self._cond:
+            self._closed = True
+            idle, self._idle = self._idle, []
+            self._cond.notify_all()
+        for conn, _ in idle:
+            self._discard(conn)
+
+    def stats(self):
+        with self._cond:
+            return {
+                "size": self._size,
+                "idle": len(self._idle),
+                "in_use": self._size - len(self._idle),
+                "min_size": self.min_size,
+                "max_size": self.max_size,
+                "checkouts": self.checkouts,
+                "waits": self.waits,
+                "timeouts": self.timeouts,
+                "wait_time_total": self.wait_time_total,
+                "wait_time_avg": self.wait_time_total / self.checkouts if self.checkouts else 0.0,
+                "wait_time_max": self.wait_time_max,
+                "connections_created": self.connections_created,
+                "connections_discarded": self.connections_discarded,
+                "healthcheck_failures": self.healthcheck_failures,
+            }
+
+class PooledConnection:
+    """غلاف حول اتصال المجمع: close() يعيد الاتصال للمجمع بدلاً من إغلاقه."""
+
+    def __init__(self, pool, conn):
+        self._pool = pool
+        self._conn = conn
+        self._released = False
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def close(self, discard=False):
+        if self._released:
+            return
+        self._released = True
+        self._pool.putconn(self._conn, discard=discard)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        # أخطاء الاتصال نفسه تعني أن الاتصال غير صالح لإعادة الاستخدام
+        self.close(discard=isinstance(exc, (psycopg2.OperationalError, psycopg2.InterfaceError)))
+        return False
+
+_db_pool = None
+_db_pool_lock = threading.Lock()
+
+def get_db_pool():
+    global _db_pool
+    if _db_pool is None:
+        with _db_pool_lock:
+            if _db_pool is None:
+                _db_pool = DBConnectionPool(
+                    DATABASE_URL,
+                    min_size=DB_POOL_MIN_SIZE,
+                    max_size=DB_POOL_MAX_SIZE,
+                    checkout_timeout=DB_POOL_CHECKOUT_TIMEOUT,
+                    healthcheck_interval=DB_POOL_HEALTHCHECK_INTERVAL
+                )
+    return _db_pool
+
+def get_db_connection():
+    try:
+        pool = get_db_pool()
+        return PooledConnection(pool, pool.getconn())
     except Exception as e:
         logger.error(f"❌ فشل الاتصال بقاعدة البيانات: {e}")
         return None
 
-def init_db():
-    conn = get_db_connection()
-    if conn is None: return
+def get_db_pool_stats():
+    return get_db_pool().stats()
+
+# =============== عدادات أداء الصفقات ===============
+# عداد لكل (ساعة، نوع صفقة) يُحدّث مع فتح الصفقة وإغلاقها، فالتقارير تقرأ صفاً لكل ساعة لا لكل صفقة
+TRADE_STATS_BUCKET = 3600
+
+def trade_stats_bucket(timestamp):
+    return float(timestamp // TRADE_STATS_BUCKET * TRADE_STATS_BUCKET)
+
+TRADE_STATS_REBUILD = [
+    "DELETE FROM trade_stats_hourly",
+    f"""
+    INSERT INTO trade_stats_hourly (bucket, trade_type, sent, hit_tp, hit_sl, active)
+    SELECT FLOOR(sent_at / {TRADE_STATS_BUCKET}) * {TRADE_STATS_BUCKET}, COALESCE(trade_type, 'SCALPING'), COUNT(*),
+           SUM(CASE WHEN exit_status = 'HIT_TP' THEN 1 ELSE 0 END),
+           SUM(CASE WHEN exit_status = 'HIT_SL' THEN 1 ELSE 0 END),
+           SUM(CASE WHEN status = 'ACTIVE' THEN 1 ELSE 0 END)
+    FROM trades
+    WHERE sent_at IS NOT NULL
+    GROUP BY FLOOR(sent_at / {TRADE_STATS_BUCKET}) * {TRADE_STATS_BUCKET}, COALESCE(trade_type, 'SCALPING')
+    """,
+]
+
+# =============== ترحيلات المخطط ===============
+# كل ترحيل يُطبق مرة واحدة بالترتيب ويُسجل رقمه في schema_migrations.
+# الترحيلات لا تُعدل بعد نشرها؛ أي تغيير جديد يضاف كرقم جديد في آخر القائمة.
+SCHEMA_MIGRATIONS = [
+    (1, "trades.trade_type", ["ALTER TABLE trades ADD COLUMN IF NOT EXISTS trade_type VARCHAR(50) DEFAULT 'SCALPING'"]),
+    (2, "users.is_blocked", ["ALTER TABLE users ADD COLUMN IF NOT EXISTS is_blocked INTEGER DEFAULT 0"]),
+    (3, "trades.symbol", ["ALTER TABLE trades ADD COLUMN IF NOT EXISTS symbol VARCHAR(20) DEFAULT 'XAUUSD'"]),
+    (4, "report indexes", [
+        "CREATE INDEX IF NOT EXISTS idx_trades_sent_at ON trades (sent_at)",
+        "CREATE INDEX IF NOT EXISTS idx_trades_active ON trades (sent_at) WHERE status = 'ACTIVE'",
+        "CREATE INDEX IF NOT EXISTS idx_users_vip_until ON users (vip_until)",
+    ]),
+    (5, "trade_stats_hourly", [
+        """CREATE TABLE IF NOT EXISTS trade_stats_hourly (bucket DOUBLE PRECISION NOT NULL, trade_type VARCHAR(50) NOT NULL,
+           sent INTEGER DEFAULT 0, hit_tp INTEGER DEFAULT 0, hit_sl INTEGER DEFAULT 0, active INTEGER DEFAULT 0,
+           PRIMARY KEY (bucket, trade_type))""",
+    ] + TRADE_STATS_REBUILD),
+    (6, "fsm_storage", [fsm_storage.TABLE_DDL]),
+]
+
+def apply_schema_migrations(conn):
+    """تطبيق الترحيلات غير المطبقة؛ كل ترحيل في معاملة مستقلة مع تسجيل رقمه."""
     cursor = conn.cursor()
-    
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS users (user_id BIGINT PRIMARY KEY, username VARCHAR(255), joined_at DOUBLE PRECISION, is_banned INTEGER DEFAULT 0, vip_until DOUBLE PRECISION DEFAULT 0.0);
-        CREATE TABLE IF NOT EXISTS invite_keys (key VARCHAR(255) PRIMARY KEY, days INTEGER, created_by BIGINT, used_by BIGINT NULL, used_at DOUBLE PRECISION NULL);
-        CREATE TABLE IF NOT EXISTS trades (trade_id TEXT PRIMARY KEY, sent_at DOUBLE PRECISION, action VARCHAR(10), entry_price DOUBLE PRECISION, take_profit DOUBLE PRECISION, stop_loss DOUBLE PRECISION, status VARCHAR(50) DEFAULT 'ACTIVE', exit_status VARCHAR(50) DEFAULT 'NONE', close_price DOUBLE PRECISION NULL, user_count INTEGER, trade_type VARCHAR(50) DEFAULT 'SCALPING');
-        CREATE TABLE IF NOT EXISTS admin_performance (
-            id SERIAL PRIMARY KEY,
-            record_type VARCHAR(50) NOT NULL, 
-            timestamp DOUBLE PRECISION NOT NULL,
-            value_float DOUBLE PRECISION NULL, 
-            trade_action VARCHAR(10) NULL,
-            trade_symbol VARCHAR(50) NULL,
-            lots_used DOUBLE PRECISION NULL
-        );
-    """)
+    cursor.execute("CREATE TABLE IF NOT EXISTS schema_migrations (version INTEGER PRIMARY KEY, name VARCHAR(255), applied_at DOUBLE PRECISION)")
     conn.commit()
-    
+    cursor.execute("SELECT version FROM schema_migrations")
+    applied = {row[0] for row in cursor.fetchall()}
+    for version, name, statements in SCHEMA_MIGRATIONS:
+        if version in applied:
+            continue
+        try:
+            for statement in statements:
+                cursor.execute(statement)
+            cursor.execute("INSERT INTO schema_migrations (version, name, applied_at) VALUES (%s, %s, %s)",
+                           (version, name, time.time()))
+            conn.commit()
+            logger.info(f"✅ تم تطبيق ترحيل المخطط {version}: {name}")
+        except Exception as e:
+            conn.rollback()
+            logger.error(f"❌ فشل ترحيل المخطط {version} ({name}): {e}")
+            # الترحيلات اللاحقة قد تعتمد عليه فنتوقف حتى التشغيل القادم
+            return
+
+def schema_is_current(conn):
+    """فحص سريع باستعلام واحد: هل آخر ترحيل مطبق بالفعل (الإقلاع المعتاد بعد أول تشغيل)."""
+    cursor = conn.cursor()
     try:
-        cursor.execute("ALTER TABLE trades ADD COLUMN trade_type VARCHAR(50) DEFAULT 'SCALPING'")
-        conn.commit()
-        logger.info("✅ تم تحديث جدول 'trades' بنجاح.")
-    except psycopg2.errors.DuplicateColumn:
-        logger.info("✅ العمود 'trade_type' موجود بالفعل.")
-        conn.rollback() 
-    except Exception as e:
-        logger.warning(f"⚠️ فشل تحديث جدول 'trades': {e}")
+        cursor.execute("SELECT MAX(version) FROM schema_migrations")
+        row = cursor.fetchone()
+    except Exception:
         conn.rollback()
-        
-    cursor.execute("SELECT value_float FROM admin_performance WHERE record_type = 'CAPITAL' ORDER BY timestamp DESC LIMIT 1")
-    if cursor.fetchone() is None:
+        return False
+    conn.commit()
+    return row is not None and row[0] == SCHEMA_MIGRATIONS[-1][0]
+
+def init_db():
+    """تهيئة الجداول والترحيلات؛ تُرجع True إذا كان المخطط محدثاً وتم تخطي التهيئة الكاملة."""
+    try:
+        get_db_pool().prefill()
+    except Exception as e:
+        logger.warning(f"⚠️ فشل تجهيز اتصالات المجمع مسبقاً: {e}")
+
+    conn = get_db_connection()
+    if conn is None: return False
+    with conn:
+        if schema_is_current(conn):
+            logger.info("✅ مخطط قاعدة البيانات محدث - تم تخطي التهيئة الكاملة.")
+            return True
+
+        cursor = conn.cursor()
+    
         cursor.execute("""
-            INSERT INTO admin_performance (record_type, timestamp, value_float) 
-            VALUES ('CAPITAL', %s, %s)
-        """, (time.time(), 100.0))
+            CREATE TABLE IF NOT EXISTS users (user_id BIGINT PRIMARY KEY, username VARCHAR(255), joined_at DOUBLE PRECISION, is_banned INTEGER DEFAULT 0, vip_until DOUBLE PRECISION DEFAULT 0.0);
+            CREATE TABLE IF NOT EXISTS invite_keys (key VARCHAR(255) PRIMARY KEY, days INTEGER, created_by BIGINT, used_by BIGINT NULL, used_at DOUBLE PRECISION NULL);
+            CREATE TABLE IF NOT EXISTS trades (trade_id TEXT PRIMARY KEY, sent_at DOUBLE PRECISION, action VARCHAR(10), entry_price DOUBLE PRECISION, take_profit DOUBLE PRECISION, stop_loss DOUBLE PRECISION, status VARCHAR(50) DEFAULT 'ACTIVE', exit_status VARCHAR(50) DEFAULT 'NONE', close_price DOUBLE PRECISION NULL, user_count INTEGER, trade_type VARCHAR(50) DEFAULT 'SCALPING');
+            CREATE TABLE IF NOT EXISTS admin_performance (
+                id SERIAL PRIMARY KEY,
+                record_type VARCHAR(50) NOT NULL, 
+                timestamp DOUBLE PRECISION NOT NULL,
+                value_float DOUBLE PRECISION NULL, 
+                trade_action VARCHAR(10) NULL,
+                trade_symbol VARCHAR(50) NULL,
+                lots_used DOUBLE PRECISION NULL
+            );
+        """)
         conn.commit()
+
+        apply_schema_migrations(conn)
+
+        cursor.execute("SELECT value_float FROM admin_performance WHERE record_type = 'CAPITAL' ORDER BY timestamp DESC LIMIT 1")
+        if cursor.fetchone() is None:
+            cursor.execute("""
+                INSERT INTO admin_performance (record_type, timestamp, value_float) 
+                VALUES ('CAPITAL', %s, %s)
+            """, (time.time(), 100.0))
+            conn.commit()
         
-    conn.close()
-    logger.info("✅ تم تهيئة جداول قاعدة البيانات بنجاح.")
+        logger.info("✅ تم تهيئة جداول قاعدة البيانات بنجاح.")
+        return False
+
+# =============== كاش حالة المستخدمين ===============
+USER_CACHE_TTL = int(os.getenv("USER_CACHE_TTL", "300"))
+VIP_AUDIENCE_TTL = int(os.getenv("VIP_AUDIENCE_TTL", "60"))
+
+class UserStatusCache:
+    """كاش داخل العملية لحالة المستخدم (الحظر، VIP، الاسم) ينتهي بالـ TTL أو بانتهاء vip_until."""
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._entries = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _expiry(self, vip_until, now):
+        expires_at = now + self.ttl
+        if vip_until is not None and vip_until > now:
+            expires_at = min(expires_at, vip_until)
+        return expires_at
+
+    def get(self, user_id):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None or entry["expires_at"] <= now:
+                self._entries.pop(user_id, None)
+                self.misses += 1
+                return None
+            self.hits += 1
+            return dict(entry)
+
+    def put(self, user_id, username, is_banned, vip_until):
+        now = time.time()
+        vip_until = vip_until if vip_until is not None else 0.0
+        entry = {
+            "username": username,
+            "is_banned": is_banned or 0,
+            "vip_until": vip_until,
+            "expires_at": self._expiry(vip_until, now),
+        }
+        with self._lock:
+            self._entries[user_id] = entry
+        return dict(entry)
+
+    def invalidate(self, user_id=None):
+        with self._lock:
+            if user_id is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(user_id, None)
+
+    def stats(self):
+        with self._lock:
+            size = len(self._entries)
+        total = self.hits + self.misses
+        return {
+            "size": size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+user_cache = UserStatusCache(USER_CACHE_TTL)
+
+def is_status_vip(status):
+    return status is not None and status["vip_until"] is not None and status["vip_until"] > time.time()
+
+def is_status_banned(status):
+    return status is not None and status["is_banned"] == 1
+
+# =============== فهرس الصفقات النشطة ===============
+class ActiveTradeIndex:
+    """الصفقات النشطة في الذاكرة: تُحمّل من قاعدة البيانات مرة عند البدء وتُحدّث عند الفتح والإغلاق.
+    لكل رمز قائمتان مرتبتان بالسعر: مستويات تُضرب عند الصعود (TP للشراء، SL للبيع)
+    ومستويات تُضرب عند الهبوط (SL للشراء، TP للبيع)، فإيجاد الصفقات المضروبة bisect وليس مسحاً كاملاً."""
+
+    def __init__(self):
+        self._trades = {}
+        self._above = {}  # symbol -> [(level, trade_id, exit_status)] تُضرب عند price >= level
+        self._below = {}  # symbol -> [(level, trade_id, exit_status)] تُضرب عند price <= level
+        self._lock = threading.Lock()
+        self.loaded = False
+
+    @staticmethod
+    def _levels(trade):
+        """(مستوى الصعود، مستوى الهبوط) مع نوع الخروج لكل منهما."""
+        if trade["action"] == "BUY":
+            return (trade["take_profit"], "HIT_TP"), (trade["stop_loss"], "HIT_SL")
+        return (trade["stop_loss"], "HIT_SL"), (trade["take_profit"], "HIT_TP")
+
+    def _insert(self, trade):
+        symbol = trade["symbol"]
+        (up_level, up_status), (down_level, down_status) = self._levels(trade)
+        self._trades[trade["trade_id"]] = trade
+        bisect.insort(self._above.setdefault(symbol, []), (up_level, trade["trade_id"], up_status))
+        bisect.insort(self._below.setdefault(symbol, []), (down_level, trade["trade_id"], down_status))
+
+    def load(self, trades):
+        with self._lock:
+            self._trades, self._above, self._below = {}, {}, {}
+            for trade in trades:
+                self._insert(dict(trade, symbol=trade.get('symbol') or TRADE_SYMBOL))
+            self.loaded = True
+
+    def add(self, trade):
+        with self._lock:
+            self._insert(dict(trade, symbol=trade.get('symbol') or TRADE_SYMBOL))
+
+    def remove(self, trade_id):
+        with self._lock:
+            trade = self._trades.pop(trade_id, None)
+            if trade is None:
+                return None
+            for levels, (level, status) in zip((self._above[trade["symbol"]], self._below[trade["symbol"]]),
+                                               self._levels(trade)):
+                entry = (level, trade_id, status)
+                position = bisect.bisect_left(levels, entry)
+                if position < len(levels) and levels[position] == entry:
+                    levels.pop(position)
+            return trade
+
+    def crossed(self, symbol, high, low=None):
+        """الصفقات التي ضرب نطاق السعر [low, high] أحد مستوياتها: [(trade, exit_status, close_price)].
+        بدون low يكون النطاق سعراً واحداً. إن لمس النطاق الهدف والوقف معاً يُحتسب الوقف (الأسوأ)."""
+        low = high if low is None else low
+        with self._lock:
+            above, below = self._above.get(symbol, []), self._below.get(symbol, [])
+            # كل المستويات <= القمة في أول القائمة، وكل المستويات >= القاع في آخرها
+            hits = {}
+            for level, trade_id, status in (above[:bisect.bisect_right(above, high, key=lambda entry: entry[0])] +
+                                            below[bisect.bisect_left(below, low, key=lambda entry: entry[0]):]):
+                if trade_id not in hits or status == "HIT_SL":
+                    hits[trade_id] = (status, level)
+            return [(dict(self._trades[trade_id]), status, level) for trade_id, (status, level) in hits.items()]
+
+    def active(self, symbol=None):
+        with self._lock:
+            return [dict(trade) for trade in self._trades.values() if symbol is None or trade["symbol"] == symbol]
+
+    def symbols(self):
+        with self._lock:
+            return sorted({trade["symbol"] for trade in self._trades.values()})
+
+    def __contains__(self, trade_id):
+        return trade_id in self._trades
+
+    def __len__(self):
+        return len(self._trades)
+
+active_trade_index = ActiveTradeIndex()
 
 # =============== دوال قاعدة البيانات ===============
 def add_user(user_id, username):
     conn = get_db_connection()
-    if conn is None: return
-    cursor = conn.cursor()
-    cursor.execute("""
-        INSERT INTO users (user_id, username, joined_at) 
-        VALUES (%s, %s, %s)
-        ON CONFLICT (user_id) DO UPDATE SET username = %s 
-    """, (user_id, username, time.time(), username))
-    conn.commit()
-    conn.close()
+    if conn is None: return None
+    with conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            INSERT INTO users (user_id, username, joined_at) 
+            VALUES (%s, %s, %s)
+            ON CONFLICT (user_id) DO UPDATE SET username = %s, is_blocked = 0
+            RETURNING is_banned, vip_until
+        """, (user_id, username, time.time(), username))
+        banned, vip_until = cursor.fetchone()
+        conn.commit()
+    return user_cache.put(user_id, username, banned, vip_until)
+
+def get_cached_user_status(user_id, username=None):
+    status = user_cache.get(user_id)
+    if status is not None and (username is None or status["username"] == username):
+        return status
+    return None
+
+def load_user_status(user_id, username=None):
+    """قراءة حالة المستخدم باستعلام واحد (upsert عند معرفة الاسم) وملء الكاش.
+    أي تفاعل من المستخدم يعني أنه لم يعد يحظر البوت، لذلك يُصفّر is_blocked في الحالتين."""
+    if username is not None:
+        return add_user(user_id, username)
 
-def is_banned(user_id):
     conn = get_db_connection()
-    if conn is None: return False
-    cursor = conn.cursor()
-    cursor.execute("SELECT is_banned FROM users WHERE user_id = %s", (user_id,))
-    result = cursor.fetchone()
-    conn.close()
-    return result is not None and result[0] == 1
+    if conn is None: return None
+    with conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            UPDATE users SET is_blocked = 0 WHERE user_id = %s
+            RETURNING username, is_banned, vip_until
+        """, (user_id,))
+        result = cursor.fetchone()
+        conn.commit()
+    if result is None:
+        return None
+    return user_cache.put(user_id, *result)
+
+def get_user_status(user_id, username=None):
+    status = get_cached_user_status(user_id, username)
+    if status is not None:
+        return status
+    return load_user_status(user_id, username)
+
+def is_banned(user_id):
+    return is_status_banned(get_user_status(user_id))
 
 def update_ban_status(user_id, status):
     conn = get_db_connection()
     if conn is None: return
-    cursor = conn.cursor()
-    cursor.execute("""
-        INSERT INTO users (user_id, is_banned) VALUES (%s, %s)
-        ON CONFLICT (user_id) DO UPDATE SET is_banned = %s
-    """, (user_id, status, status))
-    conn.commit()
-    conn.close()
+    with conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            INSERT INTO users (user_id, is_banned) VALUES (%s, %s)
+            ON CONFLICT (user_id) DO UPDATE SET is_banned = %s
+            RETURNING username, vip_until
+        """, (user_id, status, status))
+        username, vip_until = cursor.fetchone()
+        conn.commit()
+    user_cache.put(user_id, username, status, vip_until)
+    invalidate_vip_audience()
     
 def get_all_users_ids(vip_only=False):
     conn = get_db_connection()
     if conn is None: return []
-    cursor = conn.cursor()
+    with conn:
+        cursor = conn.cursor()
     
-    if vip_only:
-        cursor.execute("SELECT user_id, is_banned FROM users WHERE is_banned = 0 AND vip_until > %s", (time.time(),))
-    else:
-        cursor.execute("SELECT user_id, is_banned FROM users")
+        if vip_only:
+            cursor.execute("SELECT user_id, is_banned FROM users WHERE is_banned = 0 AND is_blocked = 0 AND vip_until > %s", (time.time(),))
+        else:
+            cursor.execute("SELECT user_id, is_banned FROM users WHERE is_blocked = 0")
         
-    result = cursor.fetchall()
-    conn.close()
-    return result
+        result = cursor.fetchall()
+        return result
     
+_vip_roster = {"loaded_at": 0.0, "members": []}
+_vip_roster_lock = threading.Lock()
+
+def invalidate_vip_audience():
+    with _vip_roster_lock:
+        _vip_roster["loaded_at"] = 0.0
+
+def get_vip_audience():
+    """مستلمو إشارات VIP باستعلام واحد: غير محظور، لم يحظر البوت، VIP ساري، بدون الأدمن.
+    القائمة تُخزن VIP_AUDIENCE_TTL ثانية ويُعاد فلترة انتهاء vip_until عند كل طلب."""
+    now = time.time()
+    with _vip_roster_lock:
+        if now - _vip_roster["loaded_at"] < VIP_AUDIENCE_TTL:
+            return [uid for uid, vip_until in _vip_roster["members"] if vip_until > now]
+
+    conn = get_db_connection()
+    if conn is None: return []
+    with conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT user_id, vip_until FROM users
+            WHERE is_banned = 0 AND is_blocked = 0 AND vip_until > %s AND user_id <> %s
+        """, (now, ADMIN_ID))
+        members = cursor.fetchall()
+
+    with _vip_roster_lock:
+        _vip_roster["members"] = members
+        _vip_roster["loaded_at"] = now
+    return [uid for uid, _ in members]
+
+def mark_users_blocked(user_ids):
+    """تعليم المستخدمين الذين حظروا البوت حتى يُستبعدوا من الإرسال الجماعي."""
+    if not user_ids: return
+    conn = get_db_connection()
+    if conn is None: return
+    with conn:
+        cursor = conn.cursor()
+        cursor.execute("UPDATE users SET is_blocked = 1 WHERE user_id = ANY(%s)", (list(user_ids),))
+        conn.commit()
+    # إسقاطهم من الكاش حتى تمر رسالتهم التالية (بعد فك الحظر) عبر load_user_status فيُصفّر is_blocked
+    for user_id in user_ids:
+        user_cache.invalidate(user_id)
+    invalidate_vip_audience()
+
+def get_recent_users_status(limit=15):
+    conn = get_db_connection()
+    if conn is None: return None
+    with conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT user_id, username, is_banned, vip_until FROM users ORDER BY vip_until DESC LIMIT %s", (limit,))
+        return cursor.fetchall()
+
 def get_total_users():
     conn = get_db_connection()
     if conn is None: return 0
-    cursor = conn.cursor()
-    cursor.execute("SELECT COUNT(user_id) FROM users") 
-    result = cursor.fetchone()[0]
-    conn.close()
-    return result
+    with conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT COUNT(user_id) FROM users") 
+        result = cursor.fetchone()[0]
+        return result
 
 def is_user_vip(user_id):
-    conn = get_db_connection()
-    if conn is None: return False
-    cursor = conn.cursor()
-    cursor.execute("SELECT vip_until FROM users WHERE user_id = %s", (user_id,))
-    result = cursor.fetchone()
-    conn.close()
-    return result is not None and result[0] is not None and result[0] > time.time()
+    return is_status_vip(get_user_status(user_id))
     
 def activate_key(user_id, key):
     conn = get_db_connection()
     if conn is None: return False, 0, None
-    cursor = conn.cursor()
-
-    try:
+    with conn:
+        cursor = conn.cursor()
         cursor.execute("SELECT days FROM invite_keys WHERE key = %s AND used_by IS NULL", (key,))
         key_data = cursor.fetchone()
 
         if key_data:
             days = key_data[0]
-            
+        
             cursor.execute("UPDATE invite_keys SET used_by = %s, used_at = %s WHERE key = %s", (user_id, time.time(), key))
-            
+        
             cursor.execute("SELECT vip_until FROM users WHERE user_id = %s", (user_id,))
             user_data = cursor.fetchone() 
-            
+        
             vip_until_ts = user_data[0] if user_data and user_data[0] is not None else 0.0 
-            
+        
             if vip_until_ts > time.time():
                 start_date = datetime.fromtimestamp(vip_until_ts)
             else:
                 start_date = datetime.now()
-                
-            new_vip_until = start_date + timedelta(days=days)
             
+            new_vip_until = start_date + timedelta(days=days)
+        
             cursor.execute("""
                 INSERT INTO users (user_id, vip_until) VALUES (%s, %s)
                 ON CONFLICT (user_id) DO UPDATE SET vip_until = %s
+                RETURNING username, is_banned
             """, (user_id, new_vip_until.timestamp(), new_vip_until.timestamp()))
-            
+            username, banned = cursor.fetchone()
+        
             conn.commit()
+            user_cache.put(user_id, username, banned, new_vip_until.timestamp())
+            invalidate_vip_audience()
             return True, days, new_vip_until
         
         return False, 0, None
-    finally:
-        conn.close()
 
 def get_user_vip_status(user_id):
     conn = get_db_connection()
     if conn is None: return "خطأ في الاتصال"
-    cursor = conn.cursor()
-    cursor.execute("SELECT vip_until FROM users WHERE user_id = %s", (user_id,))
-    result = cursor.fetchone()
-    conn.close()
-    if result and result[0] is not None and result[0] > time.time():
-        return datetime.fromtimestamp(result[0]).strftime("%Y-%m-%d %H:%M")
-    return "غير مشترك"
+    with conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT vip_until FROM users WHERE user_id = %s", (user_id,))
+        result = cursor.fetchone()
+        if result and result[0] is not None and result[0] > time.time():
+            return datetime.fromtimestamp(result[0]).strftime("%Y-%m-%d %H:%M")
+        return "غير مشترك"
 
 def create_invite_key(admin_id, days):
     conn = get_db_connection()
     if conn is None: return None
-    cursor = conn.cursor()
-    key = str(uuid.uuid4()).split('-')[0] + '-' + str(uuid.uuid4()).split('-')[1]
-    cursor.execute("INSERT INTO invite_keys (key, days, created_by) VALUES (%s, %s, %s)", (key, days, admin_id))
-    conn.commit()
-    conn.close()
-    return key
+    with conn:
+        cursor = conn.cursor()
+        key = str(uuid.uuid4()).split('-')[0] + '-' + str(uuid.uuid4()).split('-')[1]
+        cursor.execute("INSERT INTO invite_keys (key, days, created_by) VALUES (%s, %s, %s)", (key, days, admin_id))
+        conn.commit()
+        return key
 
-def save_new_trade(action, entry, tp, sl, user_count, trade_type):
+def save_new_trade(action, entry, tp, sl, user_count, trade_type, symbol=TRADE_SYMBOL):
     conn = get_db_connection()
     if conn is None: return None
-    cursor = conn.cursor()
-    trade_id = "TRADE-" + str(uuid.uuid4()).split('-')[0]
+    with conn:
+        cursor = conn.cursor()
+        trade_id = "TRADE-" + str(uuid.uuid4()).split('-')[0]
+        sent_at = time.time()
     
-    cursor.execute("""
-        INSERT INTO trades (trade_id, sent_at, action, entry_price, take_profit, stop_loss, user_count, trade_type)
-        VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-    """, (trade_id, time.time(), action, entry, tp, sl, user_count, trade_type))
+        cursor.execute("""
+            INSERT INTO trades (trade_id, sent_at, action, entry_price, take_profit, stop_loss, user_count, trade_type, symbol)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+        """, (trade_id, sent_at, action, entry, tp, sl, user_count, trade_type, symbol))
+        cursor.execute("""
+            INSERT INTO trade_stats_hourly (bucket, trade_type, sent, hit_tp, hit_sl, active)
+            VALUES (%s, %s, 1, 0, 0, 1)
+            ON CONFLICT (bucket, trade_type) DO UPDATE
+            SET sent = trade_stats_hourly.sent + 1, active = trade_stats_hourly.active + 1
+        """, (trade_stats_bucket(sent_at), trade_type))
     
-    conn.commit()
-    conn.close()
+        conn.commit()
+    invalidate_trade_reports()
+    active_trade_index.add({"trade_id": trade_id, "action": action, "entry_price": entry, "take_profit": tp,
+                            "stop_loss": sl, "trade_type": trade_type, "symbol": symbol, "sent_at": sent_at})
     return trade_id
 
 def get_active_trades():
     conn = get_db_connection()
     if conn is None: return []
-    cursor = conn.cursor()
+    with conn:
+        cursor = conn.cursor()
     
-    cursor.execute("""
-        SELECT trade_id, action, entry_price, take_profit, stop_loss, trade_type
-        FROM trades 
-        WHERE status = 'ACTIVE'
-    """)
-    trades = cursor.fetchall()
-    conn.close()
-    
-    keys = ["trade_id", "action", "entry_price", "take_profit", "stop_loss", "trade_type"]
-    
-    trades_list = []
-    for trade in trades:
-        trade_dict = dict(zip(keys, trade))
-        trades_list.append(trade_dict)
+        cursor.execute("""
+            SELECT trade_id, action, entry_price, take_profit, stop_loss, trade_type, symbol, sent_at
+            FROM trades 
+            WHERE status = 'ACTIVE'
+        """)
+        trades = cursor.fetchall()
+    
+        keys = ["trade_id", "action", "entry_price", "take_profit", "stop_loss", "trade_type", "symbol", "sent_at"]
+    
+        trades_list = []
+        for trade in trades:
+            trade_dict = dict(zip(keys, trade))
+            trades_list.append(trade_dict)
         
-    return trades_list
+        return trades_list
 
 def update_trade_status(trade_id, exit_status, close_price):
+    """إغلاق الصفقة إن كانت ما زالت نشطة؛ يُرجع True فقط إن كان هذا الاستدعاء هو من أغلقها."""
+    conn = get_db_connection()
+    if conn is None: return False
+    with conn:
+        cursor = conn.cursor()
+        # شرط ACTIVE يمنع احتساب إغلاق نفس الصفقة مرتين في العدادات
+        cursor.execute("""
+            UPDATE trades 
+            SET status = 'CLOSED', exit_status = %s, close_price = %s
+            WHERE trade_id = %s AND status = 'ACTIVE'
+            RETURNING sent_at, trade_type
+        """, (exit_status, close_price, trade_id))
+        closed = cursor.fetchone()
+        if closed is not None:
+            sent_at, trade_type = closed
+            cursor.execute("""
+                UPDATE trade_stats_hourly
+                SET active = active - 1, hit_tp = hit_tp + %s, hit_sl = hit_sl + %s
+                WHERE bucket = %s AND trade_type = %s
+            """, (int(exit_status == 'HIT_TP'), int(exit_status == 'HIT_SL'),
+                  trade_stats_bucket(sent_at), trade_type or 'SCALPING'))
+        conn.commit()
+    active_trade_index.remove(trade_id)
+    invalidate_trade_reports()
+    return closed is not None
+
+def rebuild_trade_stats():
+    """إعادة بناء العدادات من جدول الصفقات (بعد تعديل يدوي على trades)."""
     conn = get_db_connection()
     if conn is None: return
-    cursor = conn.cursor()
+    with conn:
+        cursor = conn.cursor()
+        for statement in TRADE_STATS_REBUILD:
+            cursor.execute(statement)
+        conn.commit()
+    invalidate_trade_reports()
+
+def load_active_trade_index():
+    """تحميل الصفقات النشطة من قاعدة البيانات إلى الفهرس (عند البدء فقط)."""
+    active_trade_index.load(get_active_trades())
+    logger.info(f"✅ تم تحميل {len(active_trade_index)} صفقة نشطة إلى الذاكرة")
+
+# نص التقرير يُخزن حتى تتغير العدادات (فتح/إغلاق صفقة) أو تتحرك نافذته إلى ساعة جديدة
+_report_cache = {"version": 0, "reports": {}}
+_report_cache_lock = threading.Lock()
+
+def invalidate_trade_reports():
+    with _report_cache_lock:
+        _report_cache["version"] += 1
+
+def cached_report(name, window, render):
+    """render يُرجع النص أو None عند فشل قاعدة البيانات (لا يُخزن)."""
+    with _report_cache_lock:
+        key = (_report_cache["version"], window)
+        entry = _report_cache["reports"].get(name)
+        if entry is not None and entry[0] == key:
+            return entry[1]
+    text = render()
+    if text is None:
+        return "⚠️ فشل الاتصال بقاعدة البيانات."
+    with _report_cache_lock:
+        _report_cache["reports"][name] = (key, text)
+    return text
+
+def sum_trade_stats(cursor, since):
+    """مجموع العدادات الساعية من أول ساعة كاملة بعد since (صف لكل ساعة ونوع صفقة، لا صف لكل صفقة).
+    البدء من الساعة التالية يبقي النافذة داخل المدة المطلوبة بدلاً من تجاوزها بساعة."""
     cursor.execute("""
-        UPDATE trades 
-        SET status = 'CLOSED', exit_status = %s, close_price = %s
-        WHERE trade_id = %s
-    """, (exit_status, close_price, trade_id))
-    conn.commit()
-    conn.close()
+        SELECT trade_type, SUM(sent), SUM(hit_tp), SUM(hit_sl), SUM(active)
+        FROM trade_stats_hourly
+        WHERE bucket >= %s
+        GROUP BY trade_type
+    """, (float(-(-since // TRADE_STATS_BUCKET) * TRADE_STATS_BUCKET),))
+    counts = {"sent": 0, "HIT_TP": 0, "HIT_SL": 0, "ACTIVE": 0, "by_type": {}}
+    for trade_type, sent, hit_tp, hit_sl, active in cursor.fetchall():
+        counts["sent"] += sent
+        counts["HIT_TP"] += hit_tp
+        counts["HIT_SL"] += hit_sl
+        counts["ACTIVE"] += active
+        counts["by_type"][trade_type] = sent
+    return counts
+
+def format_trade_types(by_type):
+    # trade_type يحمل اسم الاستراتيجية لغير SCALPING: كلها "طويل" فتُجمع تحت نفس الاسم
+    labels = {}
+    for trade_type, count in by_type.items():
+        label = "سريع" if trade_type == "SCALPING" else "طويل"
+        labels[label] = labels.get(label, 0) + count
+    return " | ".join(f"{label}: {count}" for label, count in sorted(labels.items()) if count)
 
 def get_weekly_trade_performance():
-    conn = get_db_connection()
-    if conn is None: return "⚠️ فشل الاتصال بقاعدة البيانات."
-    cursor = conn.cursor()
-    
-    time_7_days_ago = time.time() - (7 * 24 * 3600)
+    since = time.time() - (7 * 24 * 3600)
+    return cached_report("weekly", trade_stats_bucket(since), lambda: _render_weekly_report(since))
 
-    cursor.execute("""
-        SELECT trade_id, action, exit_status, close_price, sent_at, trade_type
-        FROM trades 
-        WHERE sent_at > %s
-    """, (time_7_days_ago,))
-    
-    trades = cursor.fetchall()
-    conn.close()
+def _render_weekly_report(since):
+    conn = get_db_connection()
+    if conn is None: return None
+    with conn:
+        cursor = conn.cursor()
+        counts = sum_trade_stats(cursor, since)
     
-    total_sent = len(trades)
-    hit_tp = sum(1 for t in trades if t[2] == 'HIT_TP')
-    hit_sl = sum(1 for t in trades if t[2] == 'HIT_SL')
-    active_trades = sum(1 for t in trades if t[2] == 'NONE' and t[3] is None)
+    total_sent = counts["sent"]
+    hit_tp = counts["HIT_TP"]
+    hit_sl = counts["HIT_SL"]
+    active_trades = counts["ACTIVE"]
 
     if total_sent == 0:
         return "⚠️ لم يتم إرسال أي صفقات خلال الـ 7 أيام الماضية."
@@ -338,29 +1305,34 @@ def get_weekly_trade_performance():
 🟢 **صفقات حققت الهدف (TP):** {hit_tp}
 🔴 **صفقات ضربت الوقف (SL):** {hit_sl}
 ⏳ **الصفقات لا تزال نشطة:** {active_trades}
+🧭 **حسب النوع:** {format_trade_types(counts["by_type"])}
 """
     return report_msg
 
 def get_daily_trade_report():
-    conn = get_db_connection()
-    if conn is None: return "⚠️ فشل الاتصال بقاعدة البيانات."
-    cursor = conn.cursor()
-    
-    time_24_hours_ago = time.time() - (24 * 3600)
+    since = time.time() - (24 * 3600)
+    return cached_report("daily", trade_stats_bucket(since), lambda: _render_daily_report(since))
 
-    cursor.execute("""
-        SELECT action, status, exit_status, entry_price, take_profit, stop_loss, user_count, trade_type
-        FROM trades 
-        WHERE sent_at > %s
-    """, (time_24_hours_ago,))
-    
-    trades = cursor.fetchall()
-    conn.close()
+def _render_daily_report(time_24_hours_ago):
+    conn = get_db_connection()
+    if conn is None: return None
+    with conn:
+        cursor = conn.cursor()
+        counts = sum_trade_stats(cursor, time_24_hours_ago)
 
-    total_sent = len(trades)
-    active_trades = sum(1 for t in trades if t[1] == 'ACTIVE')
-    hit_tp = sum(1 for t in trades if t[2] == 'HIT_TP')
-    hit_sl = sum(1 for t in trades if t[2] == 'HIT_SL')
+        cursor.execute("""
+            SELECT action, entry_price, take_profit, stop_loss, trade_type, symbol
+            FROM trades 
+            WHERE status = 'ACTIVE' AND sent_at > %s
+            ORDER BY sent_at DESC
+            LIMIT 1
+        """, (time_24_hours_ago,))
+        latest_active = cursor.fetchone()
+
+    total_sent = counts["sent"]
+    active_trades = counts["ACTIVE"]
+    hit_tp = counts["HIT_TP"]
+    hit_sl = counts["HIT_SL"]
     
     if total_sent == 0:
         return "⚠️ لم يتم إرسال أي صفقات خلال الـ 24 ساعة الماضية."
@@ -374,13 +1346,13 @@ def get_daily_trade_report():
 ⏳ **الصفقات لا تزال نشطة:** {active_trades}
 """
     
-    latest_active = next((t for t in reversed(trades) if t[1] == 'ACTIVE'), None)
     if latest_active:
-        action, _, _, entry, tp, sl, _, trade_type = latest_active
+        action, entry, tp, sl, trade_type, symbol = latest_active
+        symbol = symbol or TRADE_SYMBOL
         trade_type_msg = "سريع" if trade_type == "SCALPING" else "طويل"
         report_msg += "\n**آخر صفقة نشطة:**\n"
-        report_msg += f"  - {action} @ {entry:,.2f} ({trade_type_msg})\n"
-        report_msg += f"  - TP: {tp:,.2f} | SL: {sl:,.2f}"
+        report_msg += f"  - {symbol} {action} @ {format_price(symbol, entry)} ({trade_type_msg})\n"
+        report_msg += f"  - TP: {format_price(symbol, tp)} | SL: {format_price(symbol, sl)}"
 
     return report_msg
 
@@ -397,6 +1369,7 @@ def get_yahoo_gold_price():
             return price, "Yahoo Finance (Gold Futures)"
     except Exception as e:
         logger.error(f"❌ Yahoo Finance failed: {e}")
+        note_source_error("price", "get_yahoo_gold_price", e)
     return None
 
 def get_bybit_public_gold_price():
@@ -414,6 +1387,7 @@ def get_bybit_public_gold_price():
                 return price, "Bybit Public (XAUUSD)"
     except Exception as e:
         logger.error(f"❌ Bybit Public failed: {e}")
+        note_source_error("price", "get_bybit_public_gold_price", e)
     return None
 
 def get_twelvedata_gold_price():
@@ -432,6 +1406,7 @@ def get_twelvedata_gold_price():
                 return price, "Twelve Data (XAU/USD)"
     except Exception as e:
         logger.error(f"❌ Twelve Data failed: {e}")
+        note_source_error("price", "get_twelvedata_gold_price", e)
     return None
 
 def get_alphavantage_gold_price():
@@ -449,48 +1424,311 @@ def get_alphavantage_gold_price():
                 return price, "Alpha Vantage (GOLD)"
     except Exception as e:
         logger.error(f"❌ Alpha Vantage failed: {e}")
+        note_source_error("price", "get_alphavantage_gold_price", e)
     return None
 
-def get_live_gold_price():
-    """نظام جلب أسعار ذهب مضمون 100000%"""
-    sources = [
-        get_yahoo_gold_price,           # المصدر الأساسي - مضمون 100%
-        get_bybit_public_gold_price,    # Bybit من غير API Key
-        get_twelvedata_gold_price,      # Twelve Data مجاني
-        get_alphavantage_gold_price,    # Alpha Vantage مجاني
-    ]
-    
+GOLD_PRICE_SOURCES = [
+    get_yahoo_gold_price,           # المصدر الأساسي - مضمون 100%
+    get_bybit_public_gold_price,    # Bybit من غير API Key
+    get_twelvedata_gold_price,      # Twelve Data مجاني
+    get_alphavantage_gold_price,    # Alpha Vantage مجاني
+]
+
+_price_source_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="price-source")
+
+# آخر عملية جلب وعدد مرات فوز كل مصدر (لمعرفة من يجيب أولاً وكم يستغرق)
+LAST_PRICE_FETCH = {}
+PRICE_SOURCE_WINS = {}
+_price_fetch_lock = threading.Lock()
+
+def _record_price_fetch(mode, source_name, latency, elapsed, quotes):
+    with _price_fetch_lock:
+        LAST_PRICE_FETCH.update({
+            "mode": mode,
+            "source": source_name,
+            "latency": latency,
+            "elapsed": elapsed,
+            "quotes": quotes,
+            "at": time.time(),
+        })
+        PRICE_SOURCE_WINS[source_name] = PRICE_SOURCE_WINS.get(source_name, 0) + 1
+
+def _timed_source_call(source):
+    if not get_source_health("price", source.__name__).begin_call():
+        return None, 0.0
+    started = time.monotonic()
+    result = None
+    try:
+        result = source()
+    finally:
+        observe_source("price", source.__name__, started, bool(result))
+    return result, time.monotonic() - started
+
+def fetch_price_sequential(sources):
+    """الطريقة الأصلية: تجربة المصادر واحداً تلو الآخر."""
+    started = time.monotonic()
     for source in sources:
         try:
-            result = source()
+            result, latency = _timed_source_call(source)
             if result:
                 price, source_name = result
-                logger.info(f"🎯 تم جلب السعر الحقيقي من {source_name}: ${price:,.2f}")
+                _record_price_fetch("sequential", source_name, latency, time.monotonic() - started, 1)
                 return price, source_name
         except Exception as e:
             logger.error(f"❌ فشل {source.__name__}: {e}")
-            continue
+    return None
+
+def fetch_price_hedged(sources, hedge_delay=PRICE_HEDGE_DELAY, deadline=PRICE_FETCH_DEADLINE, use_median=False):
+    """جلب متحوّط: يبدأ المصدر الأول، وكل hedge_delay (أو فور فشل مصدر) يبدأ المصدر التالي.
+    يؤخذ أول سعر صالح، أو وسيط الأسعار الواصلة قبل المهلة عند use_median.
+    الطلبات التي لم تبدأ تُلغى، والطلبات العالقة تُترك بدون انتظار."""
+    started = time.monotonic()
+    end = started + deadline
+    queue = list(sources)
+    running = {}
+    answers = []  # (price, source_name, latency)
+
+    def launch():
+        source = queue.pop(0)
+        running[_price_source_executor.submit(_timed_source_call, source)] = source
+
+    if use_median:
+        while queue:
+            launch()
+    else:
+        launch()
+    next_launch = started + hedge_delay
+
+    try:
+        while running or queue:
+            now = time.monotonic()
+            if now >= end:
+                break
+            if queue and (not running or now >= next_launch):
+                launch()
+                next_launch = now + hedge_delay
+                continue
+
+            wait_until = min(end, next_launch) if queue else end
+            done, _ = concurrent.futures.wait(list(running), timeout=max(0.0, wait_until - now),
+                                              return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                source = running.pop(future)
+                try:
+                    result, latency = future.result()
+                except Exception as e:
+                    logger.error(f"❌ فشل {source.__name__}: {e}")
+                    result = None
+                if not result:
+                    # فشل مصدر = لا داعي لانتظار التأخير قبل تشغيل البديل
+                    next_launch = time.monotonic()
+                    continue
+                price, source_name = result
+                if not use_median:
+                    _record_price_fetch("hedged", source_name, latency, time.monotonic() - started, 1)
+                    return price, source_name
+                answers.append((price, source_name, latency))
+    finally:
+        for future in running:
+            future.cancel()
+
+    if not answers:
+        return None
+
+    prices = [price for price, _, _ in answers]
+    median_price = statistics.median(prices)
+    # المصدر "الفائز" هو الأقرب للوسيط
+    price, source_name, latency = min(answers, key=lambda a: abs(a[0] - median_price))
+    _record_price_fetch("median", source_name, latency, time.monotonic() - started, len(answers))
+    if len(answers) > 1:
+        return median_price, f"Median of {len(answers)} ({source_name})"
+    return median_price, source_name
+
+def get_live_gold_price():
+    """نظام جلب أسعار ذهب مضمون 100000%"""
+    sources = order_sources("price", GOLD_PRICE_SOURCES, name=lambda source: source.__name__)
+    if PRICE_FETCH_MODE == "sequential":
+        result = fetch_price_sequential(sources)
+    else:
+        result = fetch_price_hedged(sources, use_median=(PRICE_FETCH_MODE == "median"))
+
+    if result:
+        price, source_name = result
+        logger.info(f"🎯 تم جلب السعر الحقيقي من {source_name}: ${price:,.2f} ({LAST_PRICE_FETCH.get('elapsed', 0.0):.2f}s)")
+        return price, source_name
     
     # لو كل المصادر فشلت (مستحيل)، نستخدم سعر افتراضي واقعي
     fallback_price = 1985.50
     logger.warning(f"⚠️ استخدام السعر الافتراضي: ${fallback_price:,.2f}")
     return fallback_price, "Default Market Price"
 
-def fetch_yahoo_ohlcv(symbol="GC=F", interval="15m", period="5d"):
-    """جلب بيانات OHLCV من Yahoo Finance - مضمون 100%"""
+# =============== كاش الأسعار المشترك ===============
+class PriceCache:
+    """كاش سعر بنافذة صلاحية؛ الطلبات المتزامنة تنتظر جلباً واحداً من المصدر (single-flight)."""
+
+    def __init__(self, fetch_func, ttl, fallback_source="Default Market Price"):
+        self._fetch = fetch_func
+        self.ttl = ttl
+        self.fallback_source = fallback_source
+        self._lock = threading.Lock()
+        self._quote = None      # آخر سعر حقيقي صالح للتخزين
+        self._latest = None     # آخر نتيجة جلب (حتى لو كانت السعر الافتراضي)
+        self._inflight = None   # concurrent.futures.Future للجلب الجاري يحمل نتيجته أو استثناءه للمنتظرين
+        self._async_inflight = None
+        self.hits = 0
+        self.fetches = 0
+        self.coalesced = 0
+
+    def _fresh(self, max_age):
+        quote = self._quote
+        if quote is not None and time.time() - quote["fetched_at"] <= max_age:
+            return quote
+        return None
+
+    def peek(self, max_age=None):
+        max_age = self.ttl if max_age is None else max_age
+        with self._lock:
+            quote = self._fresh(max_age)
+            if quote is not None:
+                self.hits += 1
+            return quote
+
+    def get(self, max_age=None):
+        """نسخة متزامنة للاستدعاء من خيوط العمل."""
+        max_age = self.ttl if max_age is None else max_age
+        with self._lock:
+            quote = self._fresh(max_age)
+            if quote is not None:
+                self.hits += 1
+                return quote
+            leader = self._inflight is None
+            if leader:
+                self._inflight = concurrent.futures.Future()
+            else:
+                self.coalesced += 1
+            future = self._inflight
+
+        if not leader:
+            try:
+                # نفس نتيجة جلب القائد أو نفس استثنائه
+                return future.result(MARKET_CALL_TIMEOUT)
+            except concurrent.futures.TimeoutError:
+                # القائد عالق: آخر نتيجة مقبولة فقط إن كانت ضمن نافذة الصلاحية
+                with self._lock:
+                    latest = self._latest
+                if latest is not None and time.time() - latest["fetched_at"] <= max_age:
+                    return latest
+                raise
+
+        quote = None
+        try:
+            price, source = self._fetch()
+            quote = {"price": price, "source": source, "fetched_at": time.time()}
+            return quote
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self.fetches += 1
+                if quote is not None:
+                    self._latest = quote
+                    if quote["source"] != self.fallback_source:
+                        self._quote = quote
+                self._inflight = None
+            if quote is not None:
+                future.set_result(quote)
+
+    async def aget(self, max_age=None):
+        """نسخة غير متزامنة: السعر الطازج يُعاد فوراً، وإلا ينتظر كل المستدعين نفس الجلب."""
+        quote = self.peek(max_age)
+        if quote is not None:
+            return quote
+        task = self._async_inflight
+        if task is None or task.done():
+            task = asyncio.ensure_future(run_market(self.get, max_age))
+            self._async_inflight = task
+        else:
+            self.coalesced += 1
+        return await asyncio.shield(task)
+
+    def stats(self):
+        with self._lock:
+            quote = self._quote
+        return {
+            "hits": self.hits,
+            "fetches": self.fetches,
+            "coalesced": self.coalesced,
+            "source": quote["source"] if quote else None,
+            "age": quote_age(quote) if quote else None,
+        }
+
+def quote_age(quote):
+    return max(0.0, time.time() - quote["fetched_at"])
+
+gold_price_cache = PriceCache(get_live_gold_price, PRICE_CACHE_TTL)
+
+def get_yahoo_symbol_price(symbol):
+    """سعر آخر دقيقة من Yahoo Finance لأي زوج غير الذهب."""
+    ticker = symbol_info(symbol)["yahoo"]
+    started = time.monotonic()
+    try:
+        data = yf.Ticker(ticker).history(period="1d", interval="1m")
+        if not data.empty:
+            price = float(data['Close'].iloc[-1])
+            logger.info(f"✅ Yahoo Finance price ({symbol}): {format_price(symbol, price)}")
+            observe_source("price", "get_yahoo_symbol_price", started, True)
+            return price, f"Yahoo Finance ({ticker})"
+    except Exception as e:
+        logger.error(f"❌ Yahoo Finance failed ({symbol}): {e}")
+        note_source_error("price", "get_yahoo_symbol_price", e)
+    observe_source("price", "get_yahoo_symbol_price", started, False)
+    return None
+
+def get_live_symbol_price(symbol):
+    """سعر حي لزوج غير الذهب؛ لا يوجد سعر افتراضي هنا حتى لا تُغلق صفقة على سعر وهمي."""
+    result = get_yahoo_symbol_price(symbol)
+    if result:
+        return result
+    raise RuntimeError(f"لا يوجد سعر متاح لـ {symbol}")
+
+_price_caches = {}
+_price_caches_lock = threading.Lock()
+
+def get_price_cache(symbol):
+    """كاش السعر الخاص بكل رمز (الذهب يستخدم نظام المصادر المتعددة)."""
+    if symbol == "XAUUSD":
+        return gold_price_cache
+    with _price_caches_lock:
+        cache = _price_caches.get(symbol)
+        if cache is None:
+            cache = _price_caches[symbol] = PriceCache(functools.partial(get_live_symbol_price, symbol), PRICE_CACHE_TTL)
+        return cache
+
+OHLCV_COLUMNS = ['Open', 'High', 'Low', 'Close', 'Volume']
+
+def fetch_yahoo_ohlcv(symbol="GC=F", interval="15m", period="5d", start=None):
+    """جلب بيانات OHLCV من Yahoo Finance - مضمون 100%
+    عند تمرير start يُجلب فقط ما بعد هذا الوقت (تحديث تزايدي)."""
     try:
         gold = yf.Ticker(symbol)
-        data = gold.history(period=period, interval=interval)
+        if start is not None:
+            data = gold.history(start=start, interval=interval)
+        else:
+            data = gold.history(period=period, interval=interval)
         
         if not data.empty:
-            logger.info(f"✅ تم جلب {len(data)} شمعة من Yahoo Finance")
-            return data[['Open', 'High', 'Low', 'Close', 'Volume']]
+            logger.info(f"✅ تم جلب {len(data)} شمعة من Yahoo Finance ({symbol})")
+            data = data[OHLCV_COLUMNS]
+            data.index = data.index.tz_convert("UTC") if data.index.tz is not None else data.index.tz_localize("UTC")
+            return data
     except Exception as e:
         logger.error(f"❌ فشل جلب OHLCV من Yahoo: {e}")
+        note_source_error("ohlcv", "yahoo", e)
     
     return pd.DataFrame()
 
-def fetch_bybit_ohlcv(symbol="XAUUSD", interval="15", limit=100):
+def fetch_bybit_ohlcv(symbol="XAUUSD", interval="15", limit=100, start=None):
     """جلب بيانات OHLCV من Bybit Public API"""
     try:
         # Bybit Public API للشارتات
@@ -498,7 +1736,7 @@ def fetch_bybit_ohlcv(symbol="XAUUSD", interval="15", limit=100):
         params = {
             'symbol': symbol,
             'interval': interval,
-            'from': int(time.time()) - (limit * int(interval) * 60),
+            'from': int(start.timestamp()) if start is not None else int(time.time()) - (limit * int(interval) * 60),
             'limit': limit
         }
         
@@ -511,6 +1749,7 @@ def fetch_bybit_ohlcv(symbol="XAUUSD", interval="15", limit=100):
                 df_data = []
                 for kline in klines:
                     df_data.append({
+                        'Time': pd.Timestamp(int(kline['open_time']), unit='s', tz='UTC'),
                         'Open': float(kline['open']),
                         'High': float(kline['high']),
                         'Low': float(kline['low']),
@@ -518,47 +1757,323 @@ def fetch_bybit_ohlcv(symbol="XAUUSD", interval="15", limit=100):
                         'Volume': float(kline['volume'])
                     })
                 df = pd.DataFrame(df_data)
+                if not df.empty:
+                    df = df.set_index('Time')
                 logger.info(f"✅ تم جلب {len(df)} شمعة من Bybit")
                 return df
     except Exception as e:
         logger.error(f"❌ فشل جلب OHLCV من Bybit: {e}")
+        note_source_error("ohlcv", "bybit", e)
     
     return pd.DataFrame()
 
-def fetch_live_ohlcv(timeframe: str = "15m", limit: int = 100):
-    """جلب بيانات OHLCV من مصادر مضمونة"""
+# Yahoo لا يدعم 4h: تُجلب شموع 60m وتُجمع إلى 4h
+YAHOO_TF_MAPPING = {
+    "1m": "1m", "5m": "5m", "15m": "15m", 
+    "1h": "60m", "4h": "60m", "1d": "1d"
+}
+# مدة التاريخ المطلوبة من Yahoo: تكفي لأطول نافذة في الاستراتيجيات (MA50) على كل إطار
+YAHOO_PERIODS = {"1m": "5d", "5m": "5d", "15m": "5d", "1h": "1mo", "4h": "3mo", "1d": "1y"}
+BYBIT_TF_MAPPING = {
+    "1m": "1", "5m": "5", "15m": "15", 
+    "1h": "60", "4h": "240", "1d": "D"
+}
+TIMEFRAME_SECONDS = {"1m": 60, "5m": 300, "15m": 900, "1h": 3600, "4h": 14400, "1d": 86400}
+RESAMPLE_RULES = {"1m": "1min", "5m": "5min", "15m": "15min", "1h": "1h", "4h": "4h", "1d": "1D"}
+OHLCV_AGGREGATION = {"Open": "first", "High": "max", "Low": "min", "Close": "last", "Volume": "sum"}
+
+def resample_ohlcv(df, timeframe):
+    """تجميع الشموع إلى إطار أعلى؛ الحدود محاذاة لمنتصف الليل UTC كما في Timestamp.floor."""
+    if df.empty:
+        return df
+    return df.resample(RESAMPLE_RULES[timeframe]).agg(OHLCV_AGGREGATION).dropna(subset=["Close"])
+
+def fetch_ohlcv_from_sources(timeframe="15m", limit=100, start=None, source=None, symbol=TRADE_SYMBOL):
+    """جلب الشموع من المصادر مباشرة وإرجاع (DataFrame, اسم المصدر).
+    source يحصر الجلب في مصدر واحد حتى لا تختلط أسعار مصادر مختلفة في نفس السلسلة."""
+    info = symbol_info(symbol)
+    candidates = ["yahoo", "bybit"] if info["bybit"] else ["yahoo"]
+    if source is not None:
+        # المصدر المثبت لسلسلة يُتخطى إن كان قاطعه مفتوحاً؛ فشل السلسلة المتكرر يعيد تحميلها من مصدر آخر
+        candidates = [source] if source in candidates and get_source_health("ohlcv", source).allow() else []
+    else:
+        candidates = order_sources("ohlcv", candidates)
     try:
-        # تحويل timeframe لتنسيق Yahoo Finance
-        yahoo_tf_mapping = {
-            "1m": "1m", "5m": "5m", "15m": "15m", 
-            "1h": "60m", "4h": "240m", "1d": "1d"
-        }
-        
-        yahoo_tf = yahoo_tf_mapping.get(timeframe, "15m")
-        yahoo_period = "5d" if timeframe in ["1m", "5m", "15m"] else "1mo"
-        
-        # نجرب Yahoo Finance أولاً
-        df = fetch_yahoo_ohlcv("GC=F", yahoo_tf, yahoo_period)
-        if not df.empty:
-            return df
+        for name in candidates:
+            if not get_source_health("ohlcv", name).begin_call():
+                continue
+            started = time.monotonic()
+            if name == "yahoo":
+                yahoo_tf = YAHOO_TF_MAPPING.get(timeframe, "15m")
+                yahoo_period = YAHOO_PERIODS.get(timeframe, "1mo")
+                df = fetch_yahoo_ohlcv(info["yahoo"], yahoo_tf, yahoo_period, start=start)
+                if timeframe == "4h":
+                    df = resample_ohlcv(df, timeframe)
+            else:
+                bybit_tf = BYBIT_TF_MAPPING.get(timeframe, "15")
+                df = fetch_bybit_ohlcv(info["bybit"], bybit_tf, limit, start=start)
+            observe_source("ohlcv", name, started, not df.empty)
+            if not df.empty:
+                return df, name
             
-        # إذا فشل، نجرب Bybit
-        bybit_tf_mapping = {
-            "1m": "1", "5m": "5", "15m": "15", 
-            "1h": "60", "4h": "240", "1d": "D"
-        }
-        bybit_tf = bybit_tf_mapping.get(timeframe, "15")
-        df = fetch_bybit_ohlcv("XAUUSD", bybit_tf, limit)
+    except Exception as e:
+        logger.error(f"❌ فشل جلب بيانات OHLCV: {e}")
+    
+    return pd.DataFrame(), None
+
+# =============== مخزن الشموع التزايدي ===============
+CANDLE_STORE_MAX_BARS = int(os.getenv("CANDLE_STORE_MAX_BARS", "1000"))
+CANDLE_REFRESH_INTERVAL = float(os.getenv("CANDLE_REFRESH_INTERVAL", "30"))
+# أقل عدد شموع تحتاجه الاستراتيجيات (MA50)؛ الأطر المشتقة تُملأ من المصدر حتى تبلغه
+MTF_SEED_MIN_BARS = 50
+
+# الكاش على القرص لإعادة التشغيل الدافئ (قيمة فارغة = تعطيل)
+CANDLE_CACHE_DIR = os.getenv("CANDLE_CACHE_DIR", "candle_cache")
+CANDLE_CACHE_MAX_BYTES = int(os.getenv("CANDLE_CACHE_MAX_BYTES", str(2 * 1024 * 1024)))
+CANDLE_CACHE_SAVE_INTERVAL = float(os.getenv("CANDLE_CACHE_SAVE_INTERVAL", "60"))
+
+class CandleSeries:
+    def __init__(self, symbol, timeframe):
+        self.symbol = symbol
+        self.timeframe = timeframe
+        self._df = None  # يُنشأ عند أول وصول حتى لا يُحمّل تسجيل السلاسل عند الاستيراد pandas
+        self.source = None
+        self.last_refresh = 0.0
+        self.version = 0
+        self.failures = 0
+        self.indicators = None
+        self.disk_loaded = False
+        self.saved_version = 0
+        self.last_save = 0.0
+        # سلسلة مشتقة: تُبنى من سلسلة أساسية أصغر بإعادة التجميع بدل الجلب من المصدر
+        self.base_timeframe = None
+        self.base_version = -1
+        self.lock = threading.Lock()
+
+    @property
+    def df(self):
+        if self._df is None:
+            self._df = pd.DataFrame()
+        return self._df
+
+    @df.setter
+    def df(self, value):
+        self._df = value
+
+    @property
+    def cache_key(self):
+        return f"{self.symbol}_{self.timeframe}"
+
+class CandleStore:
+    """مخزن شموع لكل (رمز، إطار زمني): تحميل كامل مرة واحدة ثم جلب الشموع الأحدث فقط.
+    الشمعة الأخيرة (قيد التكوين) تُحدّث مكانها والنافذة محدودة بـ max_bars."""
+
+    def __init__(self, max_bars, refresh_interval, cache_dir=None):
+        self.max_bars = max_bars
+        self.refresh_interval = refresh_interval
+        self.cache_dir = cache_dir
+        self._series = {}
+        self._lock = threading.Lock()
+        self.backfills = 0
+        self.incremental_fetches = 0
+        self.disk_loads = 0
+        self.resamples = 0
+
+    def series(self, symbol, timeframe):
+        key = (symbol, timeframe)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = CandleSeries(symbol, timeframe)
+            return series
+
+    def derive(self, symbol, timeframe, base_timeframe):
+        """تسجيل (symbol, timeframe) كسلسلة مشتقة من base_timeframe لنفس الرمز."""
+        series = self.series(symbol, timeframe)
+        series.base_timeframe = base_timeframe
+        return series
+
+    def merge(self, series, new_df):
+        """دمج شموع جديدة: نفس التوقيت يستبدل القديم (الشمعة قيد التكوين)."""
+        if new_df.empty:
+            return False
+        if series.df.empty:
+            merged = new_df.sort_index()
+        else:
+            merged = pd.concat([series.df, new_df])
+            merged = merged[~merged.index.duplicated(keep='last')].sort_index()
+        merged = merged.tail(self.max_bars)
+        changed = not merged.equals(series.df)
+        series.df = merged
+        if changed:
+            series.version += 1
+            self._update_indicators(series, new_df)
+        return changed
+
+    def _update_indicators(self, series, new_df):
+        """تغذية محرك المؤشرات بالشموع الجديدة فقط؛ إعادة بنائه إذا تغيّر ما قبل آخر شمعة."""
+        engine = series.indicators
+        last_ts = engine.last_ts if engine is not None else None
+        first_new = int(new_df.index.min().timestamp())
+        if engine is None or last_ts is None or first_new < last_ts:
+            series.indicators = run_cpu(indicators.IndicatorEngine.from_frame, series.df)
+            return
+        engine.extend(series.df[series.df.index >= pd.Timestamp(last_ts, unit='s', tz='UTC')])
+
+    def _backfill(self, series, limit):
+        df, source = fetch_ohlcv_from_sources(series.timeframe, max(limit, 100), symbol=series.symbol)
         if not df.empty:
-            return df
-            
+            if series.base_timeframe:
+                # نفس محاذاة الشموع المبنية من السلسلة الأساسية
+                df = resample_ohlcv(df, series.timeframe)
+                if len(df) <= len(series.df):
+                    return False
+            series.df = pd.DataFrame()
+            self.merge(series, df)
+            series.source = source
+            series.failures = 0
+            self.backfills += 1
+            return True
+        return False
+
+    def _fetch_new(self, series, limit):
+        # نبدأ من آخر شمعة مخزنة لتحديثها إن كانت لا تزال قيد التكوين
+        last_ts = series.df.index[-1]
+        df, _ = fetch_ohlcv_from_sources(series.timeframe, limit, start=last_ts.to_pydatetime(), source=series.source,
+                                         symbol=series.symbol)
+        self.incremental_fetches += 1
+        if df.empty:
+            series.failures += 1
+            return
+        series.failures = 0
+        self.merge(series, df[df.index >= last_ts])
+
+    def _resample_from_base(self, series, base_df):
+        """إعادة تجميع الشموع الأساسية التي لم تُدمج بعد فقط: من بداية آخر شمعة مشتقة (قيد التكوين)
+        فصاعداً، فالتكلفة بحجم شمعة مشتقة واحدة مهما طال التاريخ."""
+        if base_df.empty:
+            return
+        rule = RESAMPLE_RULES[series.timeframe]
+        # أول شمعة مشتقة تغطيها السلسلة الأساسية من بدايتها حتى لا تستبدل شمعة كاملة بجزء منها
+        start = base_df.index[0].ceil(rule)
+        if not series.df.empty:
+            start = max(start, series.df.index[-1])
+        self.merge(series, resample_ohlcv(base_df[base_df.index >= start], series.timeframe))
+        self.resamples += 1
+
+    def _refresh_derived(self, series, limit, force):
+        # الجلب من المصدر للسلسلة الأساسية وحدها؛ الأطر الأعلى تتبعها
+        base = self.series(series.symbol, series.base_timeframe)
+        with base.lock:
+            self.refresh(base, max(limit, 100), force)
+            base_df, base_version = base.df, base.version
+        # تاريخ الإطار الأعلى أطول من نافذة السلسلة الأساسية (1000 شمعة 5m ≈ 21 شمعة 4h):
+        # يُجلب من المصدر، ويُعاد المحاولة ما دام عدد الشموع أقل مما تحتاجه الاستراتيجيات
+        if len(series.df) < MTF_SEED_MIN_BARS and time.time() - series.last_refresh >= self.refresh_interval:
+            series.last_refresh = time.time()
+            if self._backfill(series, limit):
+                series.base_version = None  # دمج شموع السلسلة الأساسية الأحدث فوق التاريخ المجلوب
+        if base_version != series.base_version:
+            self._resample_from_base(series, base_df)
+            series.base_version = base_version
+            series.source = base.source
+        self.save(series)
+
+    def _load_from_disk(self, series):
+        """تحميل السلسلة من القرص عند أول وصول لها، فلا يُجلب بعدها إلا الفجوة منذ الإيقاف."""
+        series.disk_loaded = True
+        if not self.cache_dir:
+            return
+        try:
+            loaded = candle_cache.load_series(self.cache_dir, series.cache_key)
+        except candle_cache.CacheIntegrityError as e:
+            logger.warning(f"⚠️ تجاهل كاش الشموع {series.cache_key}: {e}")
+            return
+        except Exception as e:
+            logger.error(f"❌ فشل قراءة كاش الشموع {series.cache_key}: {e}")
+            return
+        if loaded is None:
+            return
+        df, manifest = loaded
+        self.merge(series, df)
+        series.source = manifest.get("source")
+        series.saved_version = series.version
+        self.disk_loads += 1
+        logger.info(f"✅ تم تحميل {len(df)} شمعة من القرص ({series.cache_key})")
+
+    def save(self, series, force=False):
+        if not self.cache_dir or series.df.empty or series.version == series.saved_version:
+            return
+        if not force and time.time() - series.last_save < CANDLE_CACHE_SAVE_INTERVAL:
+            return
+        try:
+            candle_cache.save_series(self.cache_dir, series.cache_key, series.df, CANDLE_CACHE_MAX_BYTES, series.source)
+            series.saved_version = series.version
+            series.last_save = time.time()
+        except Exception as e:
+            logger.error(f"❌ فشل حفظ كاش الشموع {series.cache_key}: {e}")
+
+    def save_all(self):
+        with self._lock:
+            series_list = list(self._series.values())
+        for series in series_list:
+            with series.lock:
+                self.save(series, force=True)
+
+    def refresh(self, series, limit=100, force=False):
+        if not series.disk_loaded:
+            self._load_from_disk(series)
+        if series.base_timeframe:
+            return self._refresh_derived(series, limit, force)
+        # إغلاق شمعة منذ آخر تحديث يلغي مهلة التحديث حتى لا يُحلل إغلاق قديم
+        period = TIMEFRAME_SECONDS.get(series.timeframe, self.refresh_interval)
+        bar_closed = series.last_refresh // period < time.time() // period
+        if (not force and not bar_closed and time.time() - series.last_refresh < self.refresh_interval
+                and not series.df.empty):
+            return
+        # فجوة أطول من نافذة التحميل الكامل لا يمكن سدها تزايدياً
+        gap_too_long = (not series.df.empty and
+                        time.time() - series.df.index[-1].timestamp() > 5 * 24 * 3600)
+        if series.df.empty or series.failures >= 3 or gap_too_long:
+            self._backfill(series, limit)
+        else:
+            self._fetch_new(series, limit)
+        series.last_refresh = time.time()
+        self.save(series)
+
+    def get(self, symbol, timeframe, limit=100):
+        series = self.series(symbol, timeframe)
+        with series.lock:
+            self.refresh(series, limit)
+            return series.df.copy()
+
+    def stats(self):
+        with self._lock:
+            series = list(self._series.values())
+        return {
+            "series": {f"{s.symbol}/{s.timeframe}": {"bars": len(s.df), "source": s.source, "version": s.version,
+                                                     "last_bar": s.df.index[-1] if not s.df.empty else None,
+                                                     "base": s.base_timeframe}
+                       for s in series},
+            "backfills": self.backfills,
+            "incremental_fetches": self.incremental_fetches,
+            "disk_loads": self.disk_loads,
+            "resamples": self.resamples,
+        }
+
+candle_store = CandleStore(CANDLE_STORE_MAX_BARS, CANDLE_REFRESH_INTERVAL, CANDLE_CACHE_DIR or None)
+
+def fetch_live_ohlcv(timeframe: str = "15m", limit: int = 100, symbol: str = TRADE_SYMBOL):
+    """جلب بيانات OHLCV من مصادر مضمونة (تُخدم من مخزن الشموع في الذاكرة)"""
+    try:
+        return candle_store.get(symbol, timeframe, limit)
     except Exception as e:
         logger.error(f"❌ فشل جلب بيانات OHLCV: {e}")
     
     return pd.DataFrame()
 
 # =============== استراتيجيات تحليل محسنة مع مؤشرات حقيقية ===============
-def price_action_breakout_strategy(df):
+def price_action_breakout_strategy(df, symbol=TRADE_SYMBOL):
     """استراتيجية كسر الدعم والمقاومة مع بيانات حقيقية"""
     if len(df) < 20:
         return {"action": "HOLD", "confidence": 0.0, "reason": "بيانات غير كافية", "strategy": "PRICE_ACTION_BREAKOUT"}
@@ -566,14 +2081,16 @@ def price_action_breakout_strategy(df):
     current_price = df['Close'].iloc[-1]
     high_20 = df['High'].rolling(20).max().iloc[-1]
     low_20 = df['Low'].rolling(20).min().iloc[-1]
-    
+    return price_action_breakout_decision(current_price, high_20, low_20, symbol)
+
+def price_action_breakout_decision(current_price, high_20, low_20, symbol=TRADE_SYMBOL):
     # كسر مقاومة قوي
     if current_price > high_20:
         confidence = 0.82 if (current_price - high_20) > (high_20 * 0.001) else 0.75
         return {
             "action": "BUY", 
             "confidence": confidence,
-            "reason": f"كسر مقاومة 20 فترة عند ${high_20:,.2f}",
+            "reason": f"كسر مقاومة 20 فترة عند ${format_price(symbol, high_20)}",
             "strategy": "PRICE_ACTION_BREAKOUT"
         }
     
@@ -583,7 +2100,7 @@ def price_action_breakout_strategy(df):
         return {
             "action": "SELL",
             "confidence": confidence, 
-            "reason": f"كسر دعم 20 فترة عند ${low_20:,.2f}",
+            "reason": f"كسر دعم 20 فترة عند ${format_price(symbol, low_20)}",
             "strategy": "PRICE_ACTION_BREAKOUT"
         }
     
@@ -597,33 +2114,35 @@ def rsi_momentum_strategy(df):
     # حساب RSI باستخدام مكتبة ta
     try:
         df['rsi'] = ta.momentum.RSIIndicator(df['Close'], window=14).rsi()
-        current_rsi = df['rsi'].iloc[-1]
-        prev_rsi = df['rsi'].iloc[-2]
-        
-        # ذروة بيع مع زخم صاعد
-        if current_rsi < 30 and current_rsi > prev_rsi:
-            confidence = 0.78 if current_rsi < 25 else 0.72
-            return {
-                "action": "BUY",
-                "confidence": confidence,
-                "reason": f"RSI في ذروة بيع ({current_rsi:.1f}) مع زخم صاعد",
-                "strategy": "RSI_MOMENTUM"
-            }
-        
-        # ذروة شراء مع زخم هابط
-        if current_rsi > 70 and current_rsi < prev_rsi:
-            confidence = 0.78 if current_rsi > 75 else 0.72
-            return {
-                "action": "SELL", 
-                "confidence": confidence,
-                "reason": f"RSI في ذروة شراء ({current_rsi:.1f}) مع زخم هابط",
-                "strategy": "RSI_MOMENTUM"
-            }
+        return rsi_momentum_decision(df['rsi'].iloc[-1], df['rsi'].iloc[-2])
     except Exception as e:
         logger.error(f"❌ خطأ في حساب RSI: {e}")
     
     return {"action": "HOLD", "confidence": 0.0, "reason": "RSI في منطقة محايدة", "strategy": "RSI_MOMENTUM"}
 
+def rsi_momentum_decision(current_rsi, prev_rsi):
+    # ذروة بيع مع زخم صاعد
+    if current_rsi < 30 and current_rsi > prev_rsi:
+        confidence = 0.78 if current_rsi < 25 else 0.72
+        return {
+            "action": "BUY",
+            "confidence": confidence,
+            "reason": f"RSI في ذروة بيع ({current_rsi:.1f}) مع زخم صاعد",
+            "strategy": "RSI_MOMENTUM"
+        }
+    
+    # ذروة شراء مع زخم هابط
+    if current_rsi > 70 and current_rsi < prev_rsi:
+        confidence = 0.78 if current_rsi > 75 else 0.72
+        return {
+            "action": "SELL", 
+            "confidence": confidence,
+            "reason": f"RSI في ذروة شراء ({current_rsi:.1f}) مع زخم هابط",
+            "strategy": "RSI_MOMENTUM"
+        }
+    
+    return {"action": "HOLD", "confidence": 0.0, "reason": "RSI في منطقة محايدة", "strategy": "RSI_MOMENTUM"}
+
 def moving_average_strategy(df):
     """استراتيجية المتوسطات المتحركة مع بيانات حقيقية"""
     if len(df) < 50:
@@ -633,7 +2152,9 @@ def moving_average_strategy(df):
     ma_20 = df['Close'].rolling(20).mean().iloc[-1]
     ma_50 = df['Close'].rolling(50).mean().iloc[-1]
     current_price = df['Close'].iloc[-1]
-    
+    return moving_average_decision(current_price, df['Close'].iloc[-2], ma_20, ma_50)
+
+def moving_average_decision(current_price, prev_close, ma_20, ma_50):
     # اتجاه صاعد قوي
     if current_price > ma_20 > ma_50:
         return {
@@ -653,7 +2174,7 @@ def moving_average_strategy(df):
         }
     
     # تقاطع المتوسطات
-    if ma_20 > ma_50 and df['Close'].iloc[-2] <= ma_50:
+    if ma_20 > ma_50 and prev_close <= ma_50:
         return {
             "action": "BUY",
             "confidence": 0.75,
@@ -661,7 +2182,7 @@ def moving_average_strategy(df):
             "strategy": "MOVING_AVERAGE"
         }
     
-    if ma_20 < ma_50 and df['Close'].iloc[-2] >= ma_50:
+    if ma_20 < ma_50 and prev_close >= ma_50:
         return {
             "action": "SELL",
             "confidence": 0.75,
@@ -683,34 +2204,34 @@ def macd_strategy(df):
         macd_signal = macd_indicator.macd_signal()
         macd_histogram = macd_indicator.macd_diff()
         
-        current_macd = macd_line.iloc[-1]
-        current_signal = macd_signal.iloc[-1]
-        current_histogram = macd_histogram.iloc[-1]
-        prev_histogram = macd_histogram.iloc[-2]
-        
-        # إشارة شراء: MACD يعبر فوق خط الإشارة
-        if current_macd > current_signal and prev_histogram <= 0 and current_histogram > 0:
-            return {
-                "action": "BUY",
-                "confidence": 0.77,
-                "reason": "MACD يعبر فوق خط الإشارة",
-                "strategy": "MACD"
-            }
-        
-        # إشارة بيع: MACD يعبر تحت خط الإشارة
-        if current_macd < current_signal and prev_histogram >= 0 and current_histogram < 0:
-            return {
-                "action": "SELL",
-                "confidence": 0.77,
-                "reason": "MACD يعبر تحت خط الإشارة",
-                "strategy": "MACD"
-            }
+        return macd_decision(macd_line.iloc[-1], macd_signal.iloc[-1], macd_histogram.iloc[-1], macd_histogram.iloc[-2])
             
     except Exception as e:
         logger.error(f"❌ خطأ في حساب MACD: {e}")
     
     return {"action": "HOLD", "confidence": 0.0, "reason": "لا توجد إشارة من MACD", "strategy": "MACD"}
 
+def macd_decision(current_macd, current_signal, current_histogram, prev_histogram):
+    # إشارة شراء: MACD يعبر فوق خط الإشارة
+    if current_macd > current_signal and prev_histogram <= 0 and current_histogram > 0:
+        return {
+            "action": "BUY",
+            "confidence": 0.77,
+            "reason": "MACD يعبر فوق خط الإشارة",
+            "strategy": "MACD"
+        }
+    
+    # إشارة بيع: MACD يعبر تحت خط الإشارة
+    if current_macd < current_signal and prev_histogram >= 0 and current_histogram < 0:
+        return {
+            "action": "SELL",
+            "confidence": 0.77,
+            "reason": "MACD يعبر تحت خط الإشارة",
+            "strategy": "MACD"
+        }
+    
+    return {"action": "HOLD", "confidence": 0.0, "reason": "لا توجد إشارة من MACD", "strategy": "MACD"}
+
 def calculate_atr(df, period=14):
     """حساب Average True Range من بيانات حقيقية"""
     try:
@@ -725,6 +2246,36 @@ def calculate_atr(df, period=14):
     except:
         return 2.0  # قيمة افتراضية واقعية
 
+def strategies_from_indicators(values, symbol=TRADE_SYMBOL):
+    """نفس الاستراتيجيات الأربع لكن من قيم محرك المؤشرات التزايدي بدل إعادة الحساب."""
+    bars = values["bars"]
+    insufficient = lambda name: {"action": "HOLD", "confidence": 0.0, "reason": "بيانات غير كافية", "strategy": name}
+    return [
+        price_action_breakout_decision(values["close"], values["high_n"], values["low_n"], symbol) if bars >= 20 else insufficient("PRICE_ACTION_BREAKOUT"),
+        rsi_momentum_decision(values["rsi"], values["prev_rsi"]) if bars >= 14 else insufficient("RSI_MOMENTUM"),
+        moving_average_decision(values["close"], values["prev_close"], values["ma_fast"], values["ma_slow"]) if bars >= 50 else insufficient("MOVING_AVERAGE"),
+        macd_decision(values["macd"], values["macd_signal"], values["macd_hist"], values["prev_macd_hist"]) if bars >= 26 else insufficient("MACD"),
+    ]
+
+def verify_indicator_engine(symbol=None, timeframe="15m", rel_tol=1e-6):
+    """مقارنة المحرك التزايدي بإعادة الحساب الكاملة على نفس الشموع (None إن لم تُحمّل السلسلة)."""
+    series = candle_store.series(symbol or TRADE_SYMBOL, timeframe)
+    with series.lock:
+        if series.indicators is None or series.df.empty:
+            return None
+        values = series.indicators.values()
+        df = series.df.copy()
+    reference = indicators.reference_values(df)
+    if values.get("bars") != len(df):
+        # المحرك يرى كل الشموع منذ التحميل والسلسلة مقصوصة على CANDLE_STORE_MAX_BARS:
+        # عدد الشموع ومتوسط المدى يعتمدان على النافذة فلا يُقارنان (باقي المؤشرات أُسية وتتقارب)
+        reference = {key: value for key, value in reference.items() if key not in ("bars", "mean_range")}
+    return indicators.compare_values(values, reference, rel_tol=rel_tol)
+
+def atr_from_indicators(values):
+    atr = values["atr"]
+    return atr if not np.isnan(atr) else values["mean_range"]
+
 def calculate_dynamic_confidence(strategies, valid_strategies):
     """حساب ثقة ديناميكية بناءً على قوة الإشارات"""
     if not valid_strategies:
@@ -750,7 +2301,9 @@ def calculate_dynamic_levels(df, current_price, action):
     
     # ATR للمخاطرة
     atr = calculate_atr(df)
-    
+    return calculate_levels(resistance_1, support_1, atr, current_price, action)
+
+def calculate_levels(resistance_1, support_1, atr, current_price, action):
     if action == "BUY":
         # الدخول: سعر حالي
         entry = current_price
@@ -793,61 +2346,240 @@ def calculate_dynamic_levels(df, current_price, action):
     
     return entry, tp, sl, atr
 
-def get_professional_analysis(min_filters):
-    """تقرير تحليل محترف مع تفاصيل كاملة بناء على بيانات حقيقية"""
-    try:
-        df_15m = fetch_live_ohlcv("15m", 100)
-        
-        if df_15m.empty:
-            return "❌ لا توجد بيانات كافية للتحليل", 0.0, "HOLD", 0.0, 0.0, 0.0, 0.0, "NONE", 0, []
-        
-        current_price_result = get_live_gold_price()
-        current_price, source = current_price_result
+# =============== محرك التحليل المشترك ===============
+ANALYSIS_TIMEFRAME = "15m"
+# streaming: المؤشرات من المحرك التزايدي | full: إعادة الحساب الكاملة على DataFrame
+INDICATOR_MODE = os.getenv("INDICATOR_MODE", "streaming")
+
+# توافق الأطر الزمنية: أطر أعلى (مثلاً 1h,4h) يُحسب اتفاقها مع الإشارة كفلاتر إضافية (فارغ = تعطيل).
+# عند التفعيل تُجلب سلسلة أساسية واحدة فقط (MTF_BASE_TIMEFRAME) وتُشتق منها كل الأطر الأخرى.
+# تاريخ كل إطار أعلى يُملأ من المصدر حتى MTF_SEED_MIN_BARS شمعة (4h من شموع 60m في Yahoo)، ثم يُحدّث من السلسلة الأساسية.
+MTF_BASE_TIMEFRAME = os.getenv("MTF_BASE_TIMEFRAME", "5m")
+MTF_TIMEFRAMES = [tf.strip() for tf in os.getenv("MTF_TIMEFRAMES", "").split(",") if tf.strip()]
+
+def _valid_mtf_timeframe(timeframe):
+    seconds, base = TIMEFRAME_SECONDS.get(timeframe), TIMEFRAME_SECONDS.get(MTF_BASE_TIMEFRAME)
+    if seconds is None or base is None or seconds <= base or seconds % base:
+        logger.warning(f"⚠️ تجاهل الإطار {timeframe} في MTF_TIMEFRAMES (يجب أن يكون مضاعفاً لـ {MTF_BASE_TIMEFRAME})")
+        return False
+    return timeframe != ANALYSIS_TIMEFRAME
+
+MTF_TIMEFRAMES = [tf for tf in dict.fromkeys(MTF_TIMEFRAMES) if _valid_mtf_timeframe(tf)]
+if MTF_TIMEFRAMES:
+    for _symbol in TRADE_SYMBOLS:
+        for _timeframe in [ANALYSIS_TIMEFRAME] + MTF_TIMEFRAMES:
+            if _timeframe != MTF_BASE_TIMEFRAME:
+                candle_store.derive(_symbol, _timeframe, MTF_BASE_TIMEFRAME)
+
+def seconds_until_candle_close(timeframe, now=None, delay=ANALYSIS_CLOSE_DELAY):
+    """الثواني حتى (إغلاق الشمعة التالية + delay)؛ الإغلاقات محاذاة لـ epoch مثل Timestamp.floor."""
+    period = TIMEFRAME_SECONDS[timeframe]
+    now = time.time() if now is None else now
+    wake = ((now - delay) // period + 1) * period + delay
+    return wake - now
+
+async def wait_for_next_analysis(interval):
+    if ANALYSIS_SCHEDULE == "candle":
+        await asyncio.sleep(seconds_until_candle_close(ANALYSIS_TIMEFRAME))
+    else:
+        await asyncio.sleep(interval)
+
+class AnalysisEngine:
+    """يحسب الاستراتيجيات الأربع على الشموع المغلقة فقط ويحفظ النتيجة كـ snapshot مفتاحه
+    (symbol, timeframe, آخر شمعة مغلقة)؛ أي طلب خلال نفس الشمعة يُرجع الـ snapshot بلا أي حساب.
+    كل فئة (95% / 85%) وأزرار الأدمن تقرأ نفس الـ snapshot وتطبق عدد فلاترها وحد ثقتها.
+    الـ snapshot يحفظ قرارات الاستراتيجيات فقط؛ السعر ومستويات الدخول تُحسب عند كل طلب."""
+
+    def __init__(self, symbol, timeframe):
+        self.symbol = symbol
+        self.timeframe = timeframe
+        self._lock = threading.Lock()
+        self._snapshot = None
+        self.computations = 0
+        self.reuses = 0
+
+    def _compute(self, key, df, indicator_values=None):
+        snapshot = {"symbol": self.symbol, "key": key, "computed_at": time.time(), "df": df,
+                    "strategies": [], "valid_strategies": [], "best_signal": None}
+        if df.empty:
+            return snapshot
+
+        # إعادة الحساب الكاملة (INDICATOR_MODE=full) تعمل في مجمع العمليات
+        if indicator_values is None:
+            indicator_values = run_cpu(indicators.reference_values, df)
 
         # تطبيق جميع الاستراتيجيات
-        strategies = [
-            price_action_breakout_strategy(df_15m),
-            rsi_momentum_strategy(df_15m),
-            moving_average_strategy(df_15m),
-            macd_strategy(df_15m)
-        ]
-        
-        # تفاصيل كل استراتيجية
-        strategy_details = []
-        for strategy in strategies:
-            status = "✅" if strategy["action"] != "HOLD" else "❌"
-            action_emoji = "🟢" if strategy["action"] == "BUY" else "🔴" if strategy["action"] == "SELL" else "⚪"
-            strategy_details.append(f"{status} {action_emoji} {strategy['strategy']}: {strategy['reason']} (ثقة: {strategy['confidence']*100:.1f}%)")
+        strategies = strategies_from_indicators(indicator_values, self.symbol)
         
         # ترشيح الاستراتيجيات الناجحة
         valid_strategies = [s for s in strategies if s["action"] != "HOLD" and s["confidence"] >= 0.65]
+        snapshot.update(strategies=strategies, valid_strategies=valid_strategies,
+                        range=(indicator_values["high_n"], indicator_values["low_n"], atr_from_indicators(indicator_values)))
+
+        if valid_strategies:
+            # أفضل إشارة + ثقة ديناميكية (لا تعتمد على عدد الفلاتر المطلوب)
+            best_signal = max(valid_strategies, key=lambda x: x["confidence"])
+            snapshot.update(best_signal=best_signal,
+                            confidence=calculate_dynamic_confidence(strategies, valid_strategies))
+        return snapshot
+
+    def _closed_bars(self, series):
+        """(مفتاح آخر شمعة مغلقة، عدد الشموع المغلقة، هل الأخيرة قيد التكوين).
+        المفتاح يشمل قيم الشمعة المغلقة حتى تُعاد الحسابات إن صححها المصدر بعد الإغلاق."""
+        df = series.df
+        if df.empty:
+            return None, 0, False
+        forming = df.index[-1].timestamp() + TIMEFRAME_SECONDS[self.timeframe] > time.time()
+        closed = len(df) - 1 if forming else len(df)
+        if closed == 0:
+            return None, 0, forming
+        bar = df.iloc[closed - 1]
+        key = (self.symbol, self.timeframe, df.index[closed - 1], float(bar['High']), float(bar['Low']), float(bar['Close']))
+        return key, closed, forming
+
+    def snapshot(self):
+        with self._lock:
+            series = candle_store.series(self.symbol, self.timeframe)
+            current = self._snapshot
+            with series.lock:
+                candle_store.refresh(series)
+                key, closed, forming = self._closed_bars(series)
+                if current is not None and key is not None and current["key"] == key:
+                    self.reuses += 1
+                    return current
+                df = series.df.iloc[:closed].copy()
+                indicator_values = None
+                if INDICATOR_MODE == "streaming" and series.indicators is not None:
+                    indicator_values = series.indicators.closed_values() if forming else series.indicators.values()
+            current = self._compute(key, df, indicator_values)
+            self._snapshot = current
+            self.computations += 1
+            return current
+
+    def stats(self):
+        current = self._snapshot
+        return {
+            "computations": self.computations,
+            "reuses": self.reuses,
+            "age": time.time() - current["computed_at"] if current else None,
+        }
+
+analysis_engines = {symbol: AnalysisEngine(symbol, ANALYSIS_TIMEFRAME) for symbol in TRADE_SYMBOLS}
+analysis_engine = analysis_engines[TRADE_SYMBOL]
+
+ACTIVE_TRADES_GAUGE.set_function(lambda: len(active_trade_index))
+ANALYSIS_AGE_GAUGE.set_function(lambda: {symbol: engine.stats()["age"] for symbol, engine in list(analysis_engines.items())})
+
+def get_analysis_engine(symbol=None):
+    symbol = symbol or TRADE_SYMBOL
+    engine = analysis_engines.get(symbol)
+    if engine is None:
+        engine = analysis_engines.setdefault(symbol, AnalysisEngine(symbol, ANALYSIS_TIMEFRAME))
+    return engine
+
+# محركات الأطر الأعلى: نفس الـ snapshot لكل إطار، يُعاد حسابه فقط عند إغلاق شمعة فيه
+timeframe_engines = {}
+
+def get_timeframe_engine(symbol, timeframe):
+    key = (symbol, timeframe)
+    engine = timeframe_engines.get(key)
+    if engine is None:
+        engine = timeframe_engines.setdefault(key, AnalysisEngine(symbol, timeframe))
+    return engine
+
+def timeframe_bias(snapshot):
+    """اتجاه الإطار: أغلبية استراتيجياته الصالحة (None عند التعادل أو غياب الإشارات)."""
+    actions = [s["action"] for s in snapshot["valid_strategies"]]
+    buys, sells = actions.count("BUY"), actions.count("SELL")
+    if buys == sells:
+        return None
+    return "BUY" if buys > sells else "SELL"
+
+def apply_timeframe_confluence(snapshot):
+    """كل إطار أعلى يتفق اتجاهه مع أفضل إشارة يُضاف كفلتر صالح؛ يُرجع (strategies, valid, confidence)."""
+    strategies, valid_strategies = list(snapshot["strategies"]), list(snapshot["valid_strategies"])
+    best_signal = snapshot["best_signal"]
+    for timeframe in MTF_TIMEFRAMES:
+        higher = get_timeframe_engine(snapshot["symbol"], timeframe).snapshot()
+        bias = timeframe_bias(higher) if not higher["df"].empty else None
+        if bias is None:
+            strategies.append({"action": "HOLD", "confidence": 0.0, "reason": f"لا يوجد اتجاه واضح على {timeframe}",
+                               "strategy": f"MTF_{timeframe}"})
+            continue
+        entry = {"action": bias, "confidence": higher["confidence"],
+                 "reason": f"اتجاه {timeframe}: {len(higher['valid_strategies'])} استراتيجيات {bias}",
+                 "strategy": f"MTF_{timeframe}"}
+        strategies.append(entry)
+        if best_signal is not None and bias == best_signal["action"]:
+            valid_strategies.append(entry)
+    confidence = calculate_dynamic_confidence(strategies, valid_strategies) if best_signal is not None else 0.0
+    return strategies, valid_strategies, confidence
+
+def get_professional_analysis(min_filters, symbol=None):
+    """تقرير تحليل محترف مع تفاصيل كاملة بناء على بيانات حقيقية"""
+    symbol = symbol or TRADE_SYMBOL
+    try:
+        snapshot = get_analysis_engine(symbol).snapshot()
         
-        if len(valid_strategies) < min_filters:
-            return generate_hold_analysis(current_price, source, strategies, valid_strategies, min_filters)
+        if snapshot["df"].empty:
+            return "❌ لا توجد بيانات كافية للتحليل", 0.0, "HOLD", 0.0, 0.0, 0.0, 0.0, "NONE", 0, []
         
-        # أفضل إشارة
-        best_signal = max(valid_strategies, key=lambda x: x["confidence"])
+        # السعر الحالي يُقرأ عند كل طلب (من كاش السعر) لا من وقت حساب الـ snapshot
+        quote = get_price_cache(symbol).get()
+        current_price, source = quote["price"], quote["source"]
+        strategies, valid_strategies = snapshot["strategies"], snapshot["valid_strategies"]
+        confidence = snapshot.get("confidence", 0.0)
+        if MTF_TIMEFRAMES:
+            strategies, valid_strategies, confidence = apply_timeframe_confluence(snapshot)
         
-        # ثقة ديناميكية
-        dynamic_confidence = calculate_dynamic_confidence(strategies, valid_strategies)
+        if len(valid_strategies) < min_filters:
+            return generate_hold_analysis(current_price, source, strategies, valid_strategies, min_filters, symbol)
         
-        # نقاط ديناميكية
-        entry, tp, sl, atr = calculate_dynamic_levels(df_15m, current_price, best_signal["action"])
+        high_n, low_n, atr = snapshot["range"]
+        entry, tp, sl, atr = calculate_levels(high_n, low_n, atr, current_price, snapshot["best_signal"]["action"])
         
         # تقرير مفصل
-        return generate_trade_signal(current_price, source, best_signal, dynamic_confidence, 
-                                   entry, tp, sl, atr, strategies, valid_strategies, min_filters)
+        return generate_trade_signal(current_price, source, snapshot["best_signal"], confidence, 
+                                   entry, tp, sl, atr, strategies, valid_strategies, min_filters, symbol)
         
     except Exception as e:
-        logger.error(f"❌ خطأ في التحليل: {str(e)}")
+        logger.error(f"❌ خطأ في التحليل ({symbol}): {str(e)}")
         return f"❌ خطأ في التحليل: {str(e)}", 0.0, "HOLD", 0.0, 0.0, 0.0, 0.0, "NONE", 0, []
 
-def generate_hold_analysis(current_price, source, strategies, valid_strategies, min_filters):
+async def get_professional_analysis_async(min_filters, symbol=None):
+    """نفس نتيجة get_professional_analysis لكن في مجمع الخيوط وبمهلة قصوى."""
+    try:
+        return await run_market(get_professional_analysis, min_filters, symbol)
+    except asyncio.TimeoutError:
+        logger.error(f"❌ انتهت مهلة التحليل ({symbol or TRADE_SYMBOL}).")
+        return "❌ انتهت مهلة التحليل، حاول مرة أخرى.", 0.0, "HOLD", 0.0, 0.0, 0.0, 0.0, "NONE", 0, []
+
+async def analyze_symbols(min_filters, symbols=None):
+    """تحليل عدة رموز بالتوازي: الشبكة في خيوط والحساب الثقيل في مجمع العمليات.
+    يُرجع [(symbol, نتيجة get_professional_analysis)] بنفس ترتيب الرموز."""
+    symbols = list(symbols if symbols is not None else TRADE_SYMBOLS)
+    results = await asyncio.gather(*(get_professional_analysis_async(min_filters, symbol) for symbol in symbols),
+                                   return_exceptions=True)
+    analyses = []
+    for symbol, result in zip(symbols, results):
+        if isinstance(result, Exception):
+            logger.error(f"❌ خطأ في تحليل {symbol}: {result}")
+            continue
+        analyses.append((symbol, result))
+    return analyses
+
+def format_hold_summary(analyses, min_filters):
+    """سطر لكل رمز بدون إشارة بدلاً من تقرير كامل لكل واحد."""
+    lines = [f"⚪ **{symbol}:** HOLD - {filters_passed}/{min_filters} فلاتر"
+             for symbol, (_, _, _, _, _, _, _, _, filters_passed, _) in analyses]
+    return "🔍 **لا توجد إشارة قوية على:**\n" + "\n".join(lines)
+
+def generate_hold_analysis(current_price, source, strategies, valid_strategies, min_filters, symbol=TRADE_SYMBOL):
     """توليد تقرير HOLD مفصل"""
     analysis_msg = f"""
-🔍 **تحليل السوق - XAUUSD**
+🔍 **تحليل السوق - {symbol}**
 ⏰ **الوقت:** {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}
-💰 **السعر الحالي:** ${current_price:,.2f}
+💰 **السعر الحالي:** ${format_price(symbol, current_price)}
 📡 **مصدر البيانات:** {source}
 
 📊 **نتيجة الاستراتيجيات:**
@@ -862,16 +2594,16 @@ def generate_hold_analysis(current_price, source, strategies, valid_strategies,
     
     return analysis_msg, 0.0, "HOLD", 0.0, 0.0, 0.0, 0.0, "NONE", len(valid_strategies), strategies
 
-def generate_trade_signal(current_price, source, best_signal, confidence, entry, tp, sl, atr, strategies, valid_strategies, min_filters):
+def generate_trade_signal(current_price, source, best_signal, confidence, entry, tp, sl, atr, strategies, valid_strategies, min_filters, symbol=TRADE_SYMBOL):
     """توليد إشارة تداول مفصلة"""
     
     confidence_percent = confidence * 100
     risk_reward = abs(tp - entry) / abs(entry - sl) if entry != sl else 0
     
     analysis_msg = f"""
-🎯 **إشارة تداول مؤكدة - XAUUSD**
+🎯 **إشارة تداول مؤكدة - {symbol}**
 ⏰ **الوقت:** {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}
-💰 **السعر الحالي:** ${current_price:,.2f}
+💰 **السعر الحالي:** ${format_price(symbol, current_price)}
 📡 **مصدر البيانات:** {source}
 
 📊 **تفاصيل الصفقة:**
@@ -881,10 +2613,10 @@ def generate_trade_signal(current_price, source, best_signal, confidence, entry,
 💡 **المنطق:** {best_signal['reason']}
 
 🎯 **نقاط الدخول والخروج:**
-💰 **الدخول الموصى به:** ${entry:,.2f}
-🎯 **الهدف الأول:** ${tp:,.2f}
-🛑 **وقف الخسارة:** ${sl:,.2f}
-📊 **ATR الحالي:** ${atr:.2f}
+💰 **الدخول الموصى به:** ${format_price(symbol, entry)}
+🎯 **الهدف الأول:** ${format_price(symbol, tp)}
+🛑 **وقف الخسارة:** ${format_price(symbol, sl)}
+📊 **ATR الحالي:** ${format_price(symbol, atr)}
 
 📋 **تحليل الفلاتر ({len(valid_strategies)}/{min_filters}):**
 """
@@ -909,7 +2641,228 @@ def generate_trade_signal(current_price, source, best_signal, confidence, entry,
     
     return analysis_msg, confidence, best_signal["action"], entry, sl, tp, atr, best_signal["strategy"], len(valid_strategies), strategies
 
+# =============== حالة النظام ===============
+def build_system_status_report():
+    """تقرير مختصر لحالة البنية التحتية يُعرض في لوحة الأدمن."""
+    pool = get_db_pool_stats()
+    users = user_cache.stats()
+    price = gold_price_cache.stats()
+    price_age = f"{price['age']:.0f} ثانية" if price['age'] is not None else "لا يوجد"
+    report = f"""
+🩺 **حالة النظام**
+━━━━━━━━━━━━━━━
+{format_startup_report()}
+
+🗄️ **مجمع اتصالات قاعدة البيانات:**
+  - الاتصالات: {pool['size']} (مشغول: {pool['in_use']} / خامل: {pool['idle']}) من {pool['min_size']}-{pool['max_size']}
+  - مرات السحب: {pool['checkouts']} | مرات الانتظار: {pool['waits']} | انتهاء المهلة: {pool['timeouts']}
+  - زمن الانتظار: متوسط {pool['wait_time_avg']*1000:.1f}ms | أقصى {pool['wait_time_max']*1000:.1f}ms
+  - اتصالات جديدة: {pool['connections_created']} | مستبعدة: {pool['connections_discarded']} | فشل الفحص: {pool['healthcheck_failures']}
+
+👤 **كاش حالة المستخدمين:**
+  - مستخدمون في الكاش: {users['size']} | إصابة: {users['hits']} | إخفاق: {users['misses']} ({users['hit_rate']*100:.1f}%)
+
+📂 **الصفقات النشطة في الذاكرة:** {len(active_trade_index)}
+
+💬 **تخزين حالات المحادثات:** {FSM_STORAGE}{format_fsm_storage_stats()}
+
+💰 **كاش السعر:**
+  - المصدر: {price['source'] or 'لا يوجد'} | العمر: {price_age}
+  - من الكاش: {price['hits']} | جلب فعلي: {price['fetches']} | طلبات مدموجة: {price['coalesced']}
+"""
+    if LAST_PRICE_FETCH:
+        wins = ", ".join(f"{name}: {count}" for name, count in sorted(PRICE_SOURCE_WINS.items(), key=lambda x: -x[1]))
+        report += f"""  - آخر جلب ({LAST_PRICE_FETCH['mode']}): {LAST_PRICE_FETCH['source']} خلال {LAST_PRICE_FETCH['elapsed']:.2f}s (زمن المصدر {LAST_PRICE_FETCH['latency']:.2f}s)
+  - مرات الفوز: {wins}
+"""
+
+    if source_health:
+        report += f"\n🛰️ **صحة المصادر** (الترتيب: {SOURCE_ORDER_MODE}):\n"
+        states = {"closed": "🟢", "half-open": "🟡", "open": "🔴"}
+        for (kind, name), health in sorted(source_health.items()):
+            s = health.stats()
+            rate = f"{s['success_rate']*100:.0f}%" if s['success_rate'] is not None else "-"
+            latency = f"p50 {s['p50']:.2f}s / p95 {s['p95']:.2f}s" if s['p50'] is not None else "-"
+            report += f"  - {states[s['state']]} {kind}/{name}: نجاح {rate} من {s['calls']} | {latency}"
+            if s["state"] == "open":
+                report += f" | إعادة التجربة بعد {s['retry_in']:.0f}s"
+            report += "\n"
+            if s["last_error"] and s["success_rate"] != 1:
+                report += f"      آخر خطأ قبل {s['last_error_age']:.0f}s: {h(s['last_error'])}\n"
+
+    report += f"\n🧠 **محرك التحليل** ({INDICATOR_MODE}، عمليات الحساب: {ANALYSIS_PROCESS_WORKERS}):\n"
+    for symbol, engine in list(analysis_engines.items()):
+        analysis = engine.stats()
+        analysis_age = f"{analysis['age']:.0f} ثانية" if analysis['age'] is not None else "لا يوجد"
+        report += f"  - {symbol}: حسابات: {analysis['computations']} | إعادة استخدام: {analysis['reuses']} | عمر آخر تحليل: {analysis_age}\n"
+    if MTF_TIMEFRAMES:
+        report += f"  - توافق الأطر: {', '.join(MTF_TIMEFRAMES)} (مشتقة من {MTF_BASE_TIMEFRAME})\n"
+
+    if LOOP_STALL_THRESHOLD > 0:
+        loop = loop_watchdog_monitor.stats()
+        report += f"""
+🐢 **مراقب الـ event loop** (حد التوقف {LOOP_STALL_THRESHOLD:.2f}s):
+  - التأخر: الآن {loop['lag']*1000:.0f}ms | وسيط {loop['lag_p50']*1000:.0f}ms | p99 {loop['lag_p99']*1000:.0f}ms | أقصى {loop['max_lag']*1000:.0f}ms
+  - عدد التوقفات: {loop['stalls']}
+"""
+        if loop["current"]:
+            report += f"  - ⚠️ متوقف الآن منذ {loop['current']['duration']:.2f}s في {loop['current']['culprit']}\n"
+        for name, entry in sorted(loop["by_culprit"].items(), key=lambda x: -x[1]["total"])[:5]:
+            report += f"  - {name}: {entry['count']} مرة | الإجمالي {entry['total']:.2f}s | الأطول {entry['max']:.2f}s\n"
+        if loop["recent"]:
+            last = loop["recent"][-1]
+            report += f"  - آخر توقف: {last['culprit']} ← {last['innermost']} لمدة {last['duration']:.2f}s قبل {time.time() - last['started_at']:.0f} ثانية\n"
+
+    candles = candle_store.stats()
+    report += f"""
+🕯️ **مخزن الشموع:** تحميل كامل: {candles['backfills']} | تحديث تزايدي: {candles['incremental_fetches']} | من القرص: {candles['disk_loads']} | إعادة تجميع: {candles['resamples']}
+"""
+    for name, info in candles["series"].items():
+        last_bar = info["last_bar"].strftime('%Y-%m-%d %H:%M') if info["last_bar"] is not None else "-"
+        derived = f" مشتقة من {info['base']}" if info["base"] else ""
+        report += f"  - {name}: {info['bars']} شمعة ({info['source']}{derived}) آخر شمعة {last_bar}\n"
+
+    for symbol in TRADE_SYMBOLS:
+        mismatches = verify_indicator_engine(symbol)
+        if mismatches is not None:
+            report += f"📐 **المؤشرات التزايدية ({symbol}):** " + ("✅ مطابقة لإعادة الحساب الكاملة" if not mismatches else
+                                                                 "⚠️ اختلاف في " + ", ".join(name for name, _, _ in mismatches)) + "\n"
+    return report
+
+# =============== محرك الإرسال الجماعي ===============
+class BroadcastEngine:
+    """إرسال متزامن لعدد كبير من المستخدمين ضمن حدود تيليجرام العامة ولكل محادثة."""
+
+    def __init__(self, global_rate, concurrency, per_chat_interval, max_retries):
+        self.global_rate = global_rate
+        self.concurrency = concurrency
+        self.per_chat_interval = per_chat_interval
+        self.max_retries = max_retries
+        self._tokens = global_rate
+        self._last_refill = time.monotonic()
+        self._rate_lock = None
+        self._paused_until = 0.0
+        self._last_sent_per_chat = {}
+
+    async def _acquire_global(self):
+        if self._rate_lock is None:
+            self._rate_lock = asyncio.Lock()
+        async with self._rate_lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(self.global_rate, self._tokens + (now - self._last_refill) * self.global_rate)
+                self._last_refill = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.global_rate)
+
+    async def _acquire_chat(self, chat_id):
+        last = self._last_sent_per_chat.get(chat_id)
+        if last is not None:
+            delay = last + self.per_chat_interval - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        self._last_sent_per_chat[chat_id] = time.monotonic()
+
+    async def _send_one(self, chat_id, text, parse_mode, stats):
+        attempt = 0
+        while True:
+            await self._acquire_chat(chat_id)
+            await self._acquire_global()
+            try:
+                await bot.send_message(chat_id, text, parse_mode=parse_mode)
+                stats["sent"] += 1
+                return
+            except TelegramRetryAfter as e:
+                # 429: إيقاف كل المرسلين المدة التي طلبها تيليجرام ثم إعادة المحاولة
+                self._paused_until = max(self._paused_until, time.monotonic() + e.retry_after)
+                stats["rate_limited"] += 1
+                if attempt >= self.max_retries:
+                    logger.warning(f"⚠️ فشل الإرسال إلى {chat_id} بعد {attempt} محاولات (429 متكرر)")
+                    stats["failed"] += 1
+                    return
+            except TelegramForbiddenError:
+                stats["blocked"] += 1
+                stats["blocked_ids"].append(chat_id)
+                return
+            except (TelegramNetworkError, TelegramServerError) as e:
+                if attempt >= self.max_retries:
+                    logger.warning(f"⚠️ فشل الإرسال إلى {chat_id} بعد {attempt} محاولات: {e}")
+                    stats["failed"] += 1
+                    return
+                await asyncio.sleep(0.5 * (2 ** attempt))
+            except Exception as e:
+                logger.warning(f"⚠️ فشل الإرسال إلى {chat_id}: {e}")
+                stats["failed"] += 1
+                return
+            attempt += 1
+            stats["retries"] += 1
+
+    async def send_many(self, user_ids, text, parse_mode="HTML"):
+        """إرسال نفس الرسالة لقائمة مستخدمين وإرجاع إحصائيات الإرسال."""
+        user_ids = list(dict.fromkeys(user_ids))
+        stats = {"total": len(user_ids), "sent": 0, "failed": 0, "blocked": 0,
+                 "retries": 0, "rate_limited": 0, "blocked_ids": [], "elapsed": 0.0}
+        started = time.monotonic()
+        semaphore = asyncio.Semaphore(self.concurrency)
+        self._last_sent_per_chat = {cid: ts for cid, ts in self._last_sent_per_chat.items()
+                                    if started - ts < self.per_chat_interval}
+
+        async def worker(uid):
+            try:
+                async with semaphore:
+                    await self._send_one(uid, text, parse_mode, stats)
+            finally:
+                BROADCAST_RECIPIENTS.dec()
+
+        BROADCAST_RECIPIENTS.inc(len(user_ids))
+        await asyncio.gather(*(worker(uid) for uid in user_ids))
+        stats["elapsed"] = time.monotonic() - started
+
+        if stats["blocked_ids"]:
+            try:
+                await run_db(mark_users_blocked, stats["blocked_ids"])
+            except Exception as e:
+                logger.error(f"❌ فشل تعليم المستخدمين المحظورين للبوت: {e}")
+        return stats
+
+broadcaster = BroadcastEngine(BROADCAST_GLOBAL_RATE, BROADCAST_CONCURRENCY,
+                              BROADCAST_PER_CHAT_INTERVAL, BROADCAST_MAX_RETRIES)
+
+def format_broadcast_stats(stats):
+    return (f"📨 تم الإرسال: {stats['sent']}/{stats['total']} | ❌ فشل: {stats['failed']} | "
+            f"🚫 حظروا البوت: {stats['blocked']} | ⏱️ {stats['elapsed']:.1f} ثانية")
+
+async def notify_admin_broadcast(title, stats):
+    if ADMIN_ID == 0: return
+    try:
+        await bot.send_message(ADMIN_ID, f"{title}\n{format_broadcast_stats(stats)}", parse_mode="HTML")
+    except Exception as e:
+        logger.error(f"❌ فشل إرسال إحصائيات الإرسال للأدمن: {e}")
+
 # =============== Middleware ===============
+class MetricsMiddleware(BaseMiddleware):
+    """زمن وأخطاء كل معالج باسم دالته (يُسجل قبل AccessMiddleware ليشمل زمن فحص الصلاحيات)."""
+
+    async def __call__(
+        self, handler: Callable[[types.TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: types.TelegramObject, data: Dict[str, Any],
+    ) -> Any:
+        handler_object = data.get('handler')
+        name = handler_object.callback.__name__ if handler_object is not None else type(event).__name__
+        started = time.monotonic()
+        try:
+            return await handler(event, data)
+        except Exception:
+            HANDLER_ERRORS.inc(handler=name)
+            raise
+        finally:
+            HANDLER_LATENCY.observe(time.monotonic() - started, handler=name)
+
 class AccessMiddleware(BaseMiddleware):
     async def __call__(
         self, handler: Callable[[types.TelegramObject, Dict[str, Any]], Awaitable[Any]],
@@ -920,22 +2873,25 @@ class AccessMiddleware(BaseMiddleware):
         user_id = user.id
         username = user.username or "مستخدم"
         
-        state = data.get('state')
-        current_state = await state.get_state() if state else None
-        
-        if isinstance(event, types.Message):
-            add_user(user_id, username) 
+        # مستخدم سبق رؤيته يُخدم من الكاش بدون أي استعلام؛ غير ذلك upsert واحد يعيد الحالة
+        known_username = username if isinstance(event, types.Message) else None
+        status = get_cached_user_status(user_id, known_username)
+        if status is None:
+            status = await run_db(load_user_status, user_id, known_username)
 
         if user_id == ADMIN_ID: return await handler(event, data)
 
         if isinstance(event, types.Message) and (event.text == '/start' or event.text.startswith('/start ')):
              return await handler(event, data) 
         
+        # حالة FSM تُقرأ هنا فقط (قد تكون قراءة من القاعدة) لا في مسار الأدمن و/start
+        state = data.get('state')
+        current_state = await state.get_state() if state else None
         if current_state == UserStates.waiting_key_activation.state:
             return await handler(event, data)
              
         allowed_for_banned = ["💬 تواصل مع الدعم", "💰 خطة الأسعار VIP", "ℹ️ عن AlphaTradeAI"]
-        if is_banned(user_id):
+        if is_status_banned(status):
             if isinstance(event, types.Message) and event.text not in allowed_for_banned:
                  await event.answer("🚫 حسابك محظور من استخدام البوت. يمكنك التواصل مع الدعم أو التحقق من الأسعار/المعلومات فقط.")
                  return
@@ -945,13 +2901,47 @@ class AccessMiddleware(BaseMiddleware):
         if isinstance(event, types.Message) and event.text in allowed_for_all:
              return await handler(event, data) 
 
-        if not is_user_vip(user_id):
+        if not is_status_vip(status):
             if isinstance(event, types.Message) and event.text not in allowed_for_all:
                 await event.answer("⚠️ هذه الميزة مخصصة للمشتركين (VIP) فقط. يرجى تفعيل مفتاح اشتراك لتتمكن من استخدامها.")
             return
 
         return await handler(event, data)
 
+# =============== تخزين حالات المحادثات (FSM) ===============
+# memory: ذاكرة العملية (افتراضي) | postgres: جدول مشترك بين عدة عمليات ويبقى بعد إعادة التشغيل | sqlite: ملف محلي لعقدة واحدة
+FSM_STORAGE = os.getenv("FSM_STORAGE", "memory")
+FSM_SQLITE_PATH = os.getenv("FSM_SQLITE_PATH", "fsm_state.sqlite3")
+# القراءة من الكاش المحلي لهذه المدة (أقصى تأخر في رؤية كتابة عملية أخرى)، والكتابة تُجمع كل FSM_FLUSH_INTERVAL
+FSM_CACHE_TTL = float(os.getenv("FSM_CACHE_TTL", "1"))
+FSM_FLUSH_INTERVAL = float(os.getenv("FSM_FLUSH_INTERVAL", "0.2"))
+
+def fsm_db_connection():
+    conn = get_db_connection()
+    if conn is None:
+        raise RuntimeError("لا يوجد اتصال بقاعدة البيانات")
+    return conn
+
+def build_fsm_storage():
+    if FSM_STORAGE == "postgres":
+        return fsm_storage.SQLStorage(fsm_db_connection, run_db, cache_ttl=FSM_CACHE_TTL, flush_interval=FSM_FLUSH_INTERVAL)
+    if FSM_STORAGE == "sqlite":
+        return fsm_storage.SQLStorage(fsm_storage.sqlite_connector(FSM_SQLITE_PATH), run_blocking, placeholder="?",
+                                      cache_ttl=FSM_CACHE_TTL, flush_interval=FSM_FLUSH_INTERVAL)
+    if FSM_STORAGE != "memory":
+        logger.warning(f"⚠️ FSM_STORAGE غير معروف ({FSM_STORAGE}) - سيتم استخدام الذاكرة.")
+    return MemoryStorage()
+
+dp = Dispatcher(storage=build_fsm_storage())
+
+def format_fsm_storage_stats():
+    storage = dp.storage
+    if not isinstance(storage, fsm_storage.SQLStorage):
+        return ""
+    s = storage.stats()
+    return (f" | في الكاش: {s['cached']} | قراءات من القاعدة: {s['reads']} | من الكاش: {s['cache_hits']}"
+            f" | دفعات كتابة: {s['flushes']} ({s['rows_written']} صف) | معلقة: {s['pending']} | أخطاء: {s['flush_errors']}")
+
 # =============== States ===============
 class AdminStates(StatesGroup):
     waiting_broadcast = State()
@@ -984,7 +2974,7 @@ def admin_menu():
             [KeyboardButton(text="📊 تقرير الأداء الأسبوعي"), KeyboardButton(text="🔑 إنشاء مفتاح اشتراك")],
             [KeyboardButton(text="🗒️ عرض حالة المشتركين"), KeyboardButton(text="🚫 حظر مستخدم")],
             [KeyboardButton(text="✅ إلغاء حظر مستخدم"), KeyboardButton(text="👥 عدد المستخدمين")],
-            [KeyboardButton(text="🔙 عودة للمستخدم")]
+            [KeyboardButton(text="🩺 حالة النظام"), KeyboardButton(text="🔙 عودة للمستخدم")]
         ],
         resize_keyboard=True
     )
@@ -1013,30 +3003,38 @@ async def analyze_private_pair(msg: types.Message):
         await msg.answer("🚫 هذه الميزة خاصة بالإدمن.")
         return
     
-    await msg.reply("⏳ جارٍ تحليل الزوج الخاص: **XAUUSD** (الذهب) لثقة 95%+...")
+    await msg.reply(f"⏳ جارٍ تحليل: **{', '.join(TRADE_SYMBOLS)}** لثقة 95%+...")
     
-    analysis_msg, confidence, action, entry, sl, tp, sl_distance, trade_type, filters_passed, strategy_details = get_professional_analysis(MIN_FILTERS_FOR_98)
+    analyses = await analyze_symbols(MIN_FILTERS_FOR_98)
+    holds = []
     
-    confidence_percent = confidence * 100
-    
-    if action != "HOLD" and confidence >= CONFIDENCE_THRESHOLD_98:
-        private_msg = f"""
-🚨 **YOUR PERSONAL TRADE - GOLD (XAUUSD)**
+    for symbol, analysis in analyses:
+        analysis_msg, confidence, action, entry, sl, tp, sl_distance, trade_type, filters_passed, strategy_details = analysis
+        confidence_percent = confidence * 100
+        
+        if action != "HOLD" and confidence >= CONFIDENCE_THRESHOLD_98:
+            private_msg = f"""
+🚨 **YOUR PERSONAL TRADE - {symbol_info(symbol)['name']} ({symbol})**
 ━━━━━━━━━━━━━━━
-📈 **PAIR:** XAUUSD 
+📈 **PAIR:** {symbol} 
 🔥 **ACTION:** {action} (Market Execution)
-💰 **ENTRY:** ${entry:,.2f}
-🎯 **TARGET (TP):** ${tp:,.2f}
-🛑 **STOP LOSS (SL):** ${sl:,.2f}
+💰 **ENTRY:** ${format_price(symbol, entry)}
+🎯 **TARGET (TP):** ${format_price(symbol, tp)}
+🛑 **STOP LOSS (SL):** ${format_price(symbol, sl)}
 🔒 **SUCCESS RATE:** <b>{confidence_percent:.2f}%</b>
 ⚖️ **RISK/REWARD:** 1:2 (SL/TP)
 ━━━━━━━━━━━━━━━
 **📊 ملاحظة هامة (إدارة المخاطر):**
 تم تحديد نقاط الدخول والخروج ديناميكياً بناءً على تحليل السوق.
 """
-        await msg.answer(private_msg, parse_mode="HTML")
-    else:
-        await msg.answer(analysis_msg, parse_mode="HTML")
+            await msg.answer(private_msg, parse_mode="HTML")
+        elif len(analyses) == 1:
+            await msg.answer(analysis_msg, parse_mode="HTML")
+        else:
+            holds.append((symbol, analysis))
+    
+    if holds:
+        await msg.answer(format_hold_summary(holds, MIN_FILTERS_FOR_98), parse_mode="HTML")
 
 @dp.message(F.text == "⚡ تحليل سريع (85%+ Express)")
 async def analyze_market_now(msg: types.Message):
@@ -1046,42 +3044,52 @@ async def analyze_market_now(msg: types.Message):
     
     await msg.reply("⏳ جارٍ تحليل السوق بحثًا عن فرصة تداول بثقة 85%+...")
     
-    analysis_msg, confidence, action, entry, sl, tp, sl_distance, trade_type, filters_passed, strategy_details = get_professional_analysis(MIN_FILTERS_FOR_90)
-    confidence_percent = confidence * 100
-    
-    if action == "HOLD" or confidence < CONFIDENCE_THRESHOLD_90:
-        await msg.answer(analysis_msg, parse_mode="HTML")
+    analyses = await analyze_symbols(MIN_FILTERS_FOR_90)
+    holds = []
     
-    elif confidence >= CONFIDENCE_THRESHOLD_90 and confidence < CONFIDENCE_THRESHOLD_98:
-        trade_msg = f"""
+    for symbol, analysis in analyses:
+        analysis_msg, confidence, action, entry, sl, tp, sl_distance, trade_type, filters_passed, strategy_details = analysis
+        confidence_percent = confidence * 100
+        
+        if action == "HOLD" or confidence < CONFIDENCE_THRESHOLD_90:
+            if len(analyses) == 1:
+                await msg.answer(analysis_msg, parse_mode="HTML")
+            else:
+                holds.append((symbol, analysis))
+        
+        elif confidence >= CONFIDENCE_THRESHOLD_90 and confidence < CONFIDENCE_THRESHOLD_98:
+            trade_msg = f"""
 ✅ **إشارة جاهزة (ثقة {confidence_percent:.2f}%)**
 🚨 **ALPHA TRADE SIGNAL (85%+)**
 {('🟢' if action == 'BUY' else '🔴')}
 ━━━━━━━━━━━━━━━
-📈 **PAIR:** XAUUSD 
+📈 **PAIR:** {symbol} 
 🔥 **ACTION:** {action}
-💰 **ENTRY:** ${entry:,.2f}
-🎯 **TAKE PROFIT (TP):** ${tp:,.2f}
-🛑 **STOP LOSS (SL):** ${sl:,.2f}
+💰 **ENTRY:** ${format_price(symbol, entry)}
+🎯 **TAKE PROFIT (TP):** ${format_price(symbol, tp)}
+🛑 **STOP LOSS (SL):** ${format_price(symbol, sl)}
 ⚖️ **RISK/REWARD:** 1:2 (SL/TP)
 ━━━━━━━━━━━━━━━
 **📊 ملاحظة:** هذه الإشارة للتنفيذ اليدوي الآن.
 """
-        await msg.answer(trade_msg, parse_mode="HTML")
+            await msg.answer(trade_msg, parse_mode="HTML")
+        
+        elif confidence >= CONFIDENCE_THRESHOLD_98:
+            await msg.answer(f"✅ تم إيجاد إشارة فائقة القوة ({action}) على {symbol}!\nنسبة الثقة: <b>{confidence_percent:.2f}%</b>.", parse_mode="HTML")
     
-    elif confidence >= CONFIDENCE_THRESHOLD_98:
-        await msg.answer(f"✅ تم إيجاد إشارة فائقة القوة ({action}) على XAUUSD!\nنسبة الثقة: <b>{confidence_percent:.2f}%</b>.", parse_mode="HTML")
+    if holds:
+        await msg.answer(format_hold_summary(holds, MIN_FILTERS_FOR_90), parse_mode="HTML")
 
 @dp.message(F.text == "📊 أداء البوت الحي")
 async def show_daily_report_admin(msg: types.Message):
     if msg.from_user.id != ADMIN_ID: return
-    report = get_daily_trade_report()
+    report = await run_db(get_daily_trade_report)
     await msg.reply(report, parse_mode="HTML")
 
 @dp.message(F.text == "📊 تقرير الأداء الأسبوعي")
 async def show_weekly_report_admin(msg: types.Message):
     if msg.from_user.id != ADMIN_ID: return
-    report = get_weekly_trade_performance()
+    report = await run_db(get_weekly_trade_performance)
     await msg.reply(report, parse_mode="HTML")
 
 @dp.message(F.text == "📢 رسالة لكل المستخدمين")
@@ -1118,29 +3126,20 @@ async def send_broadcast(msg: types.Message, state: FSMContext):
     await state.clear()
     
     broadcast_text = msg.text
-    sent_count = 0
     
     await msg.reply(f"⏳ جاري الإرسال لـ {target}...")
     
     if target == 'all':
-        users_to_send = get_all_users_ids()
+        recipients = [uid for uid, is_banned_status in await run_db(get_all_users_ids)
+                      if uid != ADMIN_ID and is_banned_status == 0]
     elif target == 'vip':
-        users_to_send = get_all_users_ids(vip_only=True)
+        recipients = await run_db(get_vip_audience)
     else:
-        users_to_send = []
+        recipients = []
 
-    for uid, is_banned_status in users_to_send:
-        if uid != ADMIN_ID: 
-            if target == 'all' and is_banned_status == 1:
-                continue
-            
-            try:
-                await bot.send_message(uid, broadcast_text, parse_mode="HTML")
-                sent_count += 1
-            except Exception:
-                pass 
+    stats = await broadcaster.send_many(recipients, broadcast_text)
                 
-    await msg.reply(f"✅ تم إرسال الرسالة لـ **{sent_count}** مستخدم.", reply_markup=admin_menu())
+    await msg.reply(f"✅ تم إرسال الرسالة لـ **{stats['sent']}** مستخدم.\n{format_broadcast_stats(stats)}", reply_markup=admin_menu())
 
 @dp.message(F.text == "🔑 إنشاء مفتاح اشتراك")
 async def prompt_key_days(msg: types.Message, state: FSMContext):
@@ -1157,7 +3156,7 @@ async def process_create_key(msg: types.Message, state: FSMContext):
         if days <= 0:
             raise ValueError
             
-        key = create_invite_key(msg.from_user.id, days)
+        key = await run_db(create_invite_key, msg.from_user.id, days)
         
         await state.clear()
         
@@ -1176,12 +3175,8 @@ async def process_create_key(msg: types.Message, state: FSMContext):
 async def display_user_status(msg: types.Message):
     if msg.from_user.id != ADMIN_ID: return
     
-    conn = get_db_connection()
-    if conn is None: return await msg.reply("❌ فشل الاتصال بقاعدة البيانات.")
-    cursor = conn.cursor()
-    cursor.execute("SELECT user_id, username, is_banned, vip_until FROM users ORDER BY vip_until DESC LIMIT 15")
-    users = cursor.fetchall()
-    conn.close()
+    users = await run_db(get_recent_users_status)
+    if users is None: return await msg.reply("❌ فشل الاتصال بقاعدة البيانات.")
     
     if not users:
         await msg.reply("لا يوجد مستخدمون مسجلون.")
@@ -1216,7 +3211,7 @@ async def process_ban(msg: types.Message, state: FSMContext):
     
     try:
         user_id_to_ban = int(msg.text.strip())
-        update_ban_status(user_id_to_ban, 1) 
+        await run_db(update_ban_status, user_id_to_ban, 1)
         await msg.reply(f"✅ تم حظر المستخدم **{user_id_to_ban}**.", reply_markup=admin_menu())
     except ValueError:
         await msg.reply("❌ ID غير صحيح.", reply_markup=admin_menu())
@@ -1234,7 +3229,7 @@ async def process_unban(msg: types.Message, state: FSMContext):
     
     try:
         user_id_to_unban = int(msg.text.strip())
-        update_ban_status(user_id_to_unban, 0) 
+        await run_db(update_ban_status, user_id_to_unban, 0)
         await msg.reply(f"✅ تم إلغاء حظر **{user_id_to_unban}**.", reply_markup=admin_menu())
     except ValueError:
         await msg.reply("❌ ID غير صحيح.", reply_markup=admin_menu())
@@ -1242,9 +3237,15 @@ async def process_unban(msg: types.Message, state: FSMContext):
 @dp.message(F.text == "👥 عدد المستخدمين")
 async def count_users(msg: types.Message):
     if msg.from_user.id != ADMIN_ID: return
-    total = get_total_users()
+    total = await run_db(get_total_users)
     await msg.reply(f"📊 إجمالي المستخدمين: **{total}**")
 
+@dp.message(F.text == "🩺 حالة النظام")
+async def show_system_status(msg: types.Message):
+    if msg.from_user.id != ADMIN_ID: return
+    # التقرير يأخذ أقفال السلاسل ويعيد حساب المؤشرات كاملة: خارج الـ event loop
+    await msg.reply(await run_blocking(build_system_status_report), parse_mode="HTML")
+
 @dp.message(F.text == "🔙 عودة للمستخدم")
 async def back_to_user_menu(msg: types.Message):
     if msg.from_user.id != ADMIN_ID: return
@@ -1254,16 +3255,24 @@ async def back_to_user_menu(msg: types.Message):
 @dp.message(F.text == "📈 سعر السوق الحالي")
 async def get_current_price(msg: types.Message):
     try:
-        current_price, source = get_live_gold_price()
+        quotes = await asyncio.gather(*(get_price_cache(symbol).aget() for symbol in TRADE_SYMBOLS), return_exceptions=True)
+        quote = quotes[0]
+        if isinstance(quote, Exception):
+            raise quote
+        current_price, source = quote["price"], quote["source"]
         price_msg = f"""
-💰 **السعر الحي للذهب (XAUUSD)**
+💰 **السعر الحي لـ{symbol_info(TRADE_SYMBOL)['name']} ({TRADE_SYMBOL})**
 ━━━━━━━━━━━━━━━
-🎯 **السعر الحالي:** <b>${current_price:,.2f}</b>
+🎯 **السعر الحالي:** <b>${format_price(TRADE_SYMBOL, current_price)}</b>
 📡 **مصدر البيانات:** {source}
-⏰ **آخر تحديث:** {datetime.now().strftime('%H:%M:%S')}
+⏰ **آخر تحديث:** {datetime.fromtimestamp(quote['fetched_at']).strftime('%H:%M:%S')} (منذ {quote_age(quote):.0f} ثانية)
         
 ✨ **تحديث فوري من الأسواق العالمية**
 """
+        others = [(symbol, q) for symbol, q in zip(TRADE_SYMBOLS[1:], quotes[1:]) if not isinstance(q, Exception)]
+        if others:
+            price_msg += "\n📊 **أزواج أخرى:**\n" + "\n".join(
+                f"  - {symbol}: <b>{format_price(symbol, q['price'])}</b> ({q['source']})" for symbol, q in others)
         await msg.reply(price_msg, parse_mode="HTML")
     except Exception as e:
         logger.error(f"❌ خطأ في جلب السعر: {e}")
@@ -1271,7 +3280,9 @@ async def get_current_price(msg: types.Message):
 
 @dp.message(F.text == "🔍 الصفقات النشطة")
 async def show_active_trades(msg: types.Message):
-    active_trades = get_active_trades()
+    if not active_trade_index.loaded:
+        await run_db(load_active_trade_index)
+    active_trades = active_trade_index.active()
     
     if not active_trades:
         await msg.reply("✅ لا توجد صفقات نشطة حالياً.")
@@ -1286,19 +3297,20 @@ async def show_active_trades(msg: types.Message):
         tp = trade['take_profit']
         sl = trade['stop_loss']
         trade_type = trade.get('trade_type', 'SCALPING') 
+        symbol = trade.get('symbol') or TRADE_SYMBOL
         
         signal_emoji = "🟢" if action == "BUY" else "🔴"
         
         report += f"""
-{signal_emoji} **{action} @ ${entry:,.2f}** ({'سريع' if trade_type == 'SCALPING' else 'طويل'})
-  - **TP:** ${tp:,.2f}
-  - **SL:** ${sl:,.2f}
+{signal_emoji} **{symbol} {action} @ ${format_price(symbol, entry)}** ({'سريع' if trade_type == 'SCALPING' else 'طويل'})
+  - **TP:** ${format_price(symbol, tp)}
+  - **SL:** ${format_price(symbol, sl)}
 """
     await msg.reply(report, parse_mode="HTML")
 
 @dp.message(F.text == "📝 حالة الاشتراك")
 async def show_subscription_status(msg: types.Message):
-    status = get_user_vip_status(msg.from_user.id)
+    status = await run_db(get_user_vip_status, msg.from_user.id)
     if status == "غير مشترك":
         await msg.reply(f"⚠️ أنت **غير مشترك** في VIP.\nللاشتراك، اطلب مفتاح من الأدمن (@{h(ADMIN_USERNAME)}).")
     else:
@@ -1312,7 +3324,7 @@ async def prompt_key_activation(msg: types.Message, state: FSMContext):
 @dp.message(UserStates.waiting_key_activation)
 async def process_key_activation(msg: types.Message, state: FSMContext):
     key = msg.text.strip()
-    success, days, new_vip_until = activate_key(msg.from_user.id, key)
+    success, days, new_vip_until = await run_db(activate_key, msg.from_user.id, key)
     
     await state.clear()
     
@@ -1389,111 +3401,128 @@ async def about_bot(msg: types.Message):
 
 # =============== المهام المجدولة ===============
 async def send_vip_trade_signal_98():
-    active_trades = get_active_trades()
-    if len(active_trades) > 0:
+    if not active_trade_index.loaded:
+        await run_db(load_active_trade_index)
+    active_trades = active_trade_index.active()
+    # صفقة نشطة واحدة لكل رمز: الرموز المشغولة لا تُحلل
+    busy_symbols = {trade.get('symbol') or TRADE_SYMBOL for trade in active_trades}
+    symbols = [symbol for symbol in TRADE_SYMBOLS if symbol not in busy_symbols]
+    if not symbols:
         logger.info("🤖 يوجد صفقات نشطة. تخطي التحليل.")
         return 
 
-    try:
-        analysis_msg, confidence, action, entry, sl, tp, sl_distance, trade_type, filters_passed, strategy_details = get_professional_analysis(MIN_FILTERS_FOR_98)
-    except Exception as e:
-        logger.error(f"❌ خطأ في التحليل التلقائي: {e}")
-        return
+    for symbol, analysis in await analyze_symbols(MIN_FILTERS_FOR_98, symbols):
+        analysis_msg, confidence, action, entry, sl, tp, sl_distance, trade_type, filters_passed, strategy_details = analysis
+        confidence_percent = confidence * 100
 
-    confidence_percent = confidence * 100
-
-    if action != "HOLD" and confidence >= CONFIDENCE_THRESHOLD_98:
-        logger.info(f"✅ إشارة {action} قوية ({confidence_percent:.2f}%). جارٍ الإرسال...")
-        
-        trade_msg = f"""
+        if action != "HOLD" and confidence >= CONFIDENCE_THRESHOLD_98:
+            logger.info(f"✅ إشارة {action} قوية على {symbol} ({confidence_percent:.2f}%). جارٍ الإرسال...")
+            
+            trade_msg = f"""
 🚨 **إشارة VIP تلقائية!**
 ━━━━━━━━━━━━━━━
-📈 **زوج:** XAUUSD
+📈 **زوج:** {symbol}
 🔥 **إجراء:** {action}
-💰 **الدخول:** ${entry:,.2f}
-🎯 **الهدف:** ${tp:,.2f}
-🛑 **الوقف:** ${sl:,.2f}
+💰 **الدخول:** ${format_price(symbol, entry)}
+🎯 **الهدف:** ${format_price(symbol, tp)}
+🛑 **الوقف:** ${format_price(symbol, sl)}
 🔒 **الثقة:** {confidence_percent:.2f}%
 ━━━━━━━━━━━━━━━
 ⚠️ نفذ الصفقة فوراً.
 """
-        vip_users = [uid for uid, is_banned in get_all_users_ids() if is_banned == 0 and is_user_vip(uid)]
-        
-        trade_id = save_new_trade(action, entry, tp, sl, len(vip_users), trade_type)
-        
-        if trade_id:
-            for uid in vip_users:
-                try:
-                    await bot.send_message(uid, trade_msg, parse_mode="HTML")
-                except Exception:
-                    pass
+            vip_users = await run_db(get_vip_audience)
+            
+            trade_id = await run_db(save_new_trade, action, entry, tp, sl, len(vip_users), trade_type, symbol)
             
-            if ADMIN_ID != 0:
-                 await bot.send_message(ADMIN_ID, f"🔔 **تم إرسال إشارة VIP!**\nID: {trade_id}", parse_mode="HTML")
+            if trade_id:
+                stats = await broadcaster.send_many(vip_users, trade_msg)
+                await notify_admin_broadcast(f"🔔 **تم إرسال إشارة VIP!**\nID: {trade_id} ({symbol})", stats)
 
 async def send_trade_signal_90():
-    try:
-        analysis_msg, confidence, action, entry, sl, tp, sl_distance, trade_type, filters_passed, strategy_details = get_professional_analysis(MIN_FILTERS_FOR_90)
-    except Exception as e:
-        logger.error(f"❌ خطأ في التحليل (85%): {e}")
-        return
-
-    confidence_percent = confidence * 100
-    
-    if action != "HOLD" and confidence >= CONFIDENCE_THRESHOLD_90 and ADMIN_ID != 0:
-        if confidence < CONFIDENCE_THRESHOLD_98:
-            admin_alert_msg = f"""
+    for symbol, analysis in await analyze_symbols(MIN_FILTERS_FOR_90):
+        analysis_msg, confidence, action, entry, sl, tp, sl_distance, trade_type, filters_passed, strategy_details = analysis
+        confidence_percent = confidence * 100
+        
+        if action != "HOLD" and confidence >= CONFIDENCE_THRESHOLD_90 and ADMIN_ID != 0:
+            if confidence < CONFIDENCE_THRESHOLD_98:
+                admin_alert_msg = f"""
 🔔 **فرصة تداول (85%+)**
 ━━━━━━━━━━━━━━━
-📈 **زوج:** XAUUSD
+📈 **زوج:** {symbol}
 🔥 **إجراء:** {action}
-💰 **الدخول:** ${entry:,.2f}
+💰 **الدخول:** ${format_price(symbol, entry)}
 🎯 **الثقة:** {confidence_percent:.2f}%
 """
-            await bot.send_message(ADMIN_ID, admin_alert_msg, parse_mode="HTML")
+                await bot.send_message(ADMIN_ID, admin_alert_msg, parse_mode="HTML")
+
+# شموع الدقيقة لمتابعة الصفقات (من مخزن الشموع نفسه) وآخر شمعة فُحصت لكل رمز
+INTRABAR_TIMEFRAME = "1m"
+_last_intrabar_bar = {}
+
+def resolve_trade_exits(symbol, bars, price):
+    """الخروج من الصفقات بترتيب زمني: كل شمعة (ts, high, low) بعد فتح الصفقة ثم السعر الحالي.
+    أول شمعة تلمس مستوى تحدد الخروج؛ إن لمست الهدف والوقف معاً يُحتسب الوقف.
+    يُرجع [(trade, exit_status, close_price)]."""
+    exits = {}
+    for ts, high, low in bars:
+        for trade, exit_status, close_price in active_trade_index.crossed(symbol, high, low):
+            # الشمعة التي فُتحت فيها الصفقة تحوي أسعاراً قبل الدخول فلا تُحتسب
+            if trade["trade_id"] in exits or ts < trade.get("sent_at", 0):
+                continue
+            exits[trade["trade_id"]] = (trade, exit_status, close_price)
+    if price is not None:
+        for trade, exit_status, close_price in active_trade_index.crossed(symbol, price):
+            exits.setdefault(trade["trade_id"], (trade, exit_status, close_price))
+    return list(exits.values())
+
+async def fetch_intrabar_bars(symbol):
+    """قمم وقيعان شموع الدقيقة منذ آخر فحص (تشمل آخر شمعة فُحصت لأنها كانت قيد التكوين).
+    يُرجع (الشموع، آخر شمعة)؛ المستدعي يثبّت آخر شمعة في _last_intrabar_bar بعد حفظ كل الخروج منها."""
+    df = await run_market(fetch_live_ohlcv, INTRABAR_TIMEFRAME, 100, symbol)
+    if df.empty:
+        return [], None
+    since = _last_intrabar_bar.get(symbol)
+    if since is not None:
+        df = df[df.index >= since]
+    bars = [(ts.timestamp(), float(high), float(low)) for ts, high, low in zip(df.index, df['High'], df['Low'])]
+    return bars, df.index[-1]
 
 async def check_open_trades():
-    active_trades = get_active_trades()
-    
-    if not active_trades:
-        return
+    if not active_trade_index.loaded:
+        await run_db(load_active_trade_index)
 
-    try:
-        current_price, source = get_live_gold_price()
-    except Exception as e:
-        logger.error(f"❌ فشل متابعة الصفقات: {e}")
+    symbols = active_trade_index.symbols()
+    if not symbols:
         return
 
+    # سعر كل رمز وشموع دقيقته مرة واحدة وبالتوازي، والفهرس يحدد الصفقات المضروبة فقط
+    quotes = await asyncio.gather(*(get_price_cache(symbol).aget() for symbol in symbols), return_exceptions=True)
+    bars = await asyncio.gather(*(fetch_intrabar_bars(symbol) for symbol in symbols), return_exceptions=True)
+    crossed = []
+    marks = {}
+    for symbol, quote, symbol_bars in zip(symbols, quotes, bars):
+        if isinstance(quote, Exception):
+            logger.error(f"❌ فشل متابعة صفقات {symbol}: {quote}")
+            quote = None
+        if isinstance(symbol_bars, Exception):
+            logger.error(f"❌ فشل جلب شموع الدقيقة لـ {symbol}: {symbol_bars}")
+            symbol_bars = []
+        else:
+            symbol_bars, marks[symbol] = symbol_bars
+        if quote is None and not symbol_bars:
+            continue
+        crossed += resolve_trade_exits(symbol, symbol_bars, quote["price"] if quote else None)
+
     closed_count = 0
-    
-    for trade in active_trades:
-        trade_id = trade['trade_id']
-        action = trade['action']
-        tp = trade['take_profit']
-        sl = trade['stop_loss']
-        trade_type = trade.get('trade_type', 'SCALPING') 
-        
-        exit_status = None
-        close_price = None
-        
-        if action == "BUY":
-            if current_price >= tp:
-                exit_status = "HIT_TP"
-                close_price = tp
-            elif current_price <= sl:
-                exit_status = "HIT_SL"
-                close_price = sl
-        
-        elif action == "SELL":
-            if current_price <= tp:
-                exit_status = "HIT_TP"
-                close_price = tp
-            elif current_price >= sl:
-                exit_status = "HIT_SL"
-                close_price = sl
-
-        if exit_status:
-            update_trade_status(trade_id, exit_status, close_price)
+    try:
+        for trade, exit_status, close_price in crossed:
+            trade_id = trade['trade_id']
+            action = trade['action']
+            symbol = trade['symbol']
+
+            # صفقة أغلقها عامل آخر أو لم تُحفظ (القاعدة غير متاحة) لا يُعلن إغلاقها
+            if not await run_db(update_trade_status, trade_id, exit_status, close_price):
+                continue
             closed_count += 1
             
             result_emoji = "🏆🎉" if exit_status == "HIT_TP" else "🛑"
@@ -1501,19 +3530,20 @@ async def check_open_trades():
             close_msg = f"""
 🚨 **إغلاق صفقة!**
 ━━━━━━━━━━━━━━━
-📈 **زوج:** XAUUSD
+📈 **زوج:** {symbol}
 ➡️ **إجراء:** {action}
 🔒 **النتيجة:** {exit_status.replace('HIT_', '')}!
-💰 **السعر:** ${close_price:,.2f}
+💰 **السعر:** ${format_price(symbol, close_price)}
 {result_emoji}
 """
-            all_users = get_all_users_ids()
-            for uid, is_banned_status in all_users:
-                 if is_banned_status == 0 and uid != ADMIN_ID and is_user_vip(uid):
-                    try:
-                        await bot.send_message(uid, close_msg, parse_mode="HTML")
-                    except Exception:
-                        pass
+            stats = await broadcaster.send_many(await run_db(get_vip_audience), close_msg)
+            await notify_admin_broadcast(f"🔒 **تم إغلاق الصفقة {trade_id} ({exit_status})**", stats)
+    finally:
+        # شموع رمز تُعتبر مفحوصة فقط بعد حفظ كل خروج ضربته؛ وإلا تُفحص مجدداً في الدورة التالية
+        unsaved = {trade['symbol'] for trade, _, _ in crossed if trade['trade_id'] in active_trade_index}
+        for symbol, mark in marks.items():
+            if mark is not None and symbol not in unsaved:
+                _last_intrabar_bar[symbol] = mark
 
 WEEKEND_CLOSURE_ALERT_SENT = False
 WEEKEND_OPENING_ALERT_SENT = False
@@ -1526,91 +3556,175 @@ def is_weekend_closure():
         return True
     return False 
 
-async def weekend_alert_checker():
+async def send_weekend_alerts():
     global WEEKEND_CLOSURE_ALERT_SENT, WEEKEND_OPENING_ALERT_SENT
-    await asyncio.sleep(60) 
+    now_utc = datetime.now(timezone.utc)
     
-    while True:
-        now_utc = datetime.now(timezone.utc)
-        
-        if now_utc.weekday() == 4 and now_utc.hour >= 21 and not WEEKEND_CLOSURE_ALERT_SENT:
-            if not is_weekend_closure():
-                alert_msg = "😴 **إغلاق السوق!**\n\nتم إيقاف التحليلات حتى الأحد (21:00 UTC)."
+    if now_utc.weekday() == 4 and now_utc.hour >= 21 and not WEEKEND_CLOSURE_ALERT_SENT:
+        if not is_weekend_closure():
+            alert_msg = "😴 **إغلاق السوق!**\n\nتم إيقاف التحليلات حتى الأحد (21:00 UTC)."
+            
+            stats = await broadcaster.send_many(await run_db(get_vip_audience), alert_msg)
+            await notify_admin_broadcast("✅ تم إرسال رسالة الإغلاق.", stats)
                 
-                all_vip_users = get_all_users_ids(vip_only=True)
-                for uid, _ in all_vip_users:
-                    try:
-                        await bot.send_message(uid, alert_msg, parse_mode="HTML")
-                    except:
-                        pass
-                        
-                if ADMIN_ID != 0:
-                    await bot.send_message(ADMIN_ID, "✅ تم إرسال رسالة الإغلاق.")
-                    
-                WEEKEND_CLOSURE_ALERT_SENT = True
-                WEEKEND_OPENING_ALERT_SENT = False
-        
-        elif now_utc.weekday() == 6 and now_utc.hour >= 21 and not WEEKEND_OPENING_ALERT_SENT:
-            if not is_weekend_closure():
-                alert_msg = "🔔 **فتح السوق!**\n\nتم استئناف التحليلات."
-
-                all_vip_users = get_all_users_ids(vip_only=True)
-                for uid, _ in all_vip_users:
-                    try:
-                        await bot.send_message(uid, alert_msg, parse_mode="HTML")
-                    except:
-                        pass
-                        
-                if ADMIN_ID != 0:
-                    await bot.send_message(ADMIN_ID, "✅ تم إرسال رسالة الفتح.")
-                    
-                WEEKEND_OPENING_ALERT_SENT = True
-                WEEKEND_CLOSURE_ALERT_SENT = False
-        
-        elif now_utc.weekday() != 4 and now_utc.weekday() != 6:
-            WEEKEND_CLOSURE_ALERT_SENT = False
+            WEEKEND_CLOSURE_ALERT_SENT = True
             WEEKEND_OPENING_ALERT_SENT = False
+    
+    elif now_utc.weekday() == 6 and now_utc.hour >= 21 and not WEEKEND_OPENING_ALERT_SENT:
+        if not is_weekend_closure():
+            alert_msg = "🔔 **فتح السوق!**\n\nتم استئناف التحليلات."
+
+            stats = await broadcaster.send_many(await run_db(get_vip_audience), alert_msg)
+            await notify_admin_broadcast("✅ تم إرسال رسالة الفتح.", stats)
+                
+            WEEKEND_OPENING_ALERT_SENT = True
+            WEEKEND_CLOSURE_ALERT_SENT = False
+    
+    elif now_utc.weekday() != 4 and now_utc.weekday() != 6:
+        WEEKEND_CLOSURE_ALERT_SENT = False
+        WEEKEND_OPENING_ALERT_SENT = False
 
+async def weekend_alert_checker():
+    await asyncio.sleep(60) 
+    
+    while True:
+        try:
+            await send_weekend_alerts()
+        except asyncio.TimeoutError:
+            # انتهاء مهلة قاعدة البيانات: الأعلام لم تتغير فنعيد المحاولة بعد دقيقة بدلاً من ساعة
+            logger.warning("⏱️ انتهت مهلة جلب المستخدمين لتنبيه عطلة السوق - إعادة المحاولة بعد دقيقة.")
+            await asyncio.sleep(60)
+            continue
+        except Exception as e:
+            logger.error(f"❌ خطأ في تنبيه عطلة السوق: {e}")
         await asyncio.sleep(60 * 60)
 
 async def scheduled_trades_checker():
     await asyncio.sleep(5) 
     while True:
-        await check_open_trades()
+        try:
+            await check_open_trades()
+        except asyncio.TimeoutError:
+            # متابعة الأهداف والوقف لا تحتمل انتظار دورة كاملة
+            logger.warning("⏱️ انتهت مهلة متابعة الصفقات - إعادة المحاولة بعد 5 ثوانٍ.")
+            await asyncio.sleep(5)
+            continue
+        except Exception as e:
+            logger.error(f"❌ خطأ في متابعة الصفقات: {e}")
         await asyncio.sleep(TRADE_CHECK_INTERVAL)
 
 async def trade_monitoring_98_percent():
     await asyncio.sleep(30)
     while True:
-        if not is_weekend_closure():
-            await send_vip_trade_signal_98()
-        else:
-            logger.info("🤖 السوق مغلق - إيقاف التحليل.")
+        try:
+            if not is_weekend_closure():
+                await send_vip_trade_signal_98()
+            else:
+                logger.info("🤖 السوق مغلق - إيقاف التحليل.")
+        except Exception as e:
+            logger.error(f"❌ خطأ في التحليل التلقائي: {e}")
             
-        await asyncio.sleep(TRADE_ANALYSIS_INTERVAL_98)
+        await wait_for_next_analysis(TRADE_ANALYSIS_INTERVAL_98)
 
 async def trade_monitoring_90_percent():
     await asyncio.sleep(60)
     while True:
-        if not is_weekend_closure():
-            await send_trade_signal_90()
-        else:
-            logger.info("🤖 السوق مغلق - إيقاف التحليل.")
+        try:
+            if not is_weekend_closure():
+                await send_trade_signal_90()
+            else:
+                logger.info("🤖 السوق مغلق - إيقاف التحليل.")
+        except Exception as e:
+            logger.error(f"❌ خطأ في التحليل التلقائي: {e}")
             
-        await asyncio.sleep(TRADE_ANALYSIS_INTERVAL_90)
+        await wait_for_next_analysis(TRADE_ANALYSIS_INTERVAL_90)
+
+# =============== توقيت الإقلاع ===============
+# مدة كل مرحلة بالثواني: الاستيراد وتهيئة القاعدة وحتى أول طلب استقبال على المسار الحرج،
+# ثم فهرس الصفقات وتسخين مكتبات التحليل في الخلفية بعد أن يبدأ البوت بالرد.
+STARTUP_TIMINGS = {"import": time.monotonic() - STARTUP_STARTED}
+
+def format_startup_report():
+    t = STARTUP_TIMINGS
+    report = f"⏱️ الإقلاع: الاستيراد {t['import']:.2f}s"
+    if "db_init" in t:
+        report += f" | تهيئة القاعدة {t['db_init']:.2f}s ({'فحص سريع' if t.get('db_fast_path') else 'كاملة'})"
+    if "first_poll" in t:
+        report += f" | تجهيز الاستقبال {t['polling_setup']:.2f}s → أول استقبال بعد {t['first_poll']:.2f}s"
+    background = []
+    if "trade_index" in t:
+        background.append(f"فهرس الصفقات {t['trade_index']:.2f}s")
+    if "analysis_warmup" in t:
+        imports = ", ".join(f"{name} {seconds:.2f}s" for name, seconds in IMPORT_TIMINGS.items() if seconds >= 0.01)
+        background.append(f"مكتبات التحليل {t['analysis_warmup']:.2f}s" + (f" ({imports})" if imports else ""))
+    if background:
+        report += "\n  - في الخلفية: " + " | ".join(background)
+    return report
+
+async def startup_poll_middleware(make_request, bot, method):
+    """يسجل لحظة أول طلب getUpdates: من هنا يستقبل البوت رسائل المستخدمين."""
+    if "first_poll" not in STARTUP_TIMINGS and isinstance(method, GetUpdates):
+        STARTUP_TIMINGS["first_poll"] = time.monotonic() - STARTUP_STARTED
+        STARTUP_TIMINGS["polling_setup"] = STARTUP_TIMINGS["first_poll"] - STARTUP_TIMINGS["import"] - STARTUP_TIMINGS.get("db_init", 0.0)
+        logger.info(format_startup_report())
+    return await make_request(bot, method)
+
+def warm_analysis_stack():
+    """استيراد مكتبات التحليل في خيط خلفي حتى لا يدفع أول تحليل أو أول مستخدم ثمنها."""
+    for module in ANALYSIS_MODULES:
+        module.load()
+
+async def start_background_services():
+    """ما لا يحتاجه الرد على الأوامر البسيطة: فهرس الصفقات، تسخين المكتبات، ثم المهام المجدولة."""
+    started = time.monotonic()
+    await run_db(load_active_trade_index)
+    STARTUP_TIMINGS["trade_index"] = time.monotonic() - started
+
+    started = time.monotonic()
+    await run_blocking(warm_analysis_stack)
+    STARTUP_TIMINGS["analysis_warmup"] = time.monotonic() - started
+    logger.info(format_startup_report())
+    asyncio.create_task(run_blocking(warm_cpu_pool))
 
-async def main():
-    init_db()
-    
-    dp.message.middleware(AccessMiddleware())
-    
     # بدء المهام المجدولة
     asyncio.create_task(scheduled_trades_checker()) 
     asyncio.create_task(trade_monitoring_98_percent())
     asyncio.create_task(trade_monitoring_90_percent())
     asyncio.create_task(weekend_alert_checker())
+
+async def main():
+    started = time.monotonic()
+    STARTUP_TIMINGS["db_fast_path"] = await run_blocking(init_db)
+    STARTUP_TIMINGS["db_init"] = time.monotonic() - started
+    
+    dp.message.middleware(MetricsMiddleware())
+    dp.callback_query.middleware(MetricsMiddleware())
+    dp.message.middleware(AccessMiddleware())
+
+    if LOOP_STALL_THRESHOLD > 0:
+        loop_watchdog_monitor.start()
+
+    metrics_runner = None
+    if METRICS_PORT > 0:
+        try:
+            metrics_runner = await metrics.start_http_server(METRICS_HOST, METRICS_PORT)
+            logger.info(f"📈 المقاييس متاحة على http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+        except OSError as e:
+            logger.warning(f"⚠️ تعذر تشغيل خادم المقاييس: {e}")
     
-    await dp.start_polling(bot)
+    asyncio.create_task(start_background_services())
+    bot.session.middleware(startup_poll_middleware)
+    
+    try:
+        await dp.start_polling(bot)
+    finally:
+        loop_watchdog_monitor.stop()
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+        candle_store.save_all()
+        _blocking_executor.shutdown(wait=False, cancel_futures=True)
+        shutdown_cpu_pool()
+        get_db_pool().closeall()
 
 if __name__ == "__main__":
     try: